@@ -0,0 +1,135 @@
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional
+
+
+logger = logging.getLogger(__name__)
+
+
+class AttachmentTextCache:
+    """
+    Кэш извлечённого текста вложений по хэшу содержимого.
+
+    Первый уровень - LRU в памяти, ограниченный суммарным числом символов.
+    Второй (необязательный) уровень - каталог на диске, который могут
+    разделять несколько процессов-парсеров.
+    """
+
+    def __init__(self, max_chars: int = 50_000_000, cache_dir: Optional[str] = None):
+        self.max_chars = max_chars
+        self.cache_dir = cache_dir
+        self._entries: "OrderedDict[str, str]" = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(file: bytes, filename: str, settings: str = '') -> str:
+        """
+        Ключ кэша: SHA-256 содержимого, расширение файла (от него зависит способ извлечения)
+        и отпечаток настроек парсера, влияющих на извлечённый текст
+        """
+        ext = os.path.splitext(filename)[1].lower()
+        key = f"{hashlib.sha256(file).hexdigest()}{ext}"
+        if settings:
+            key += f".{hashlib.sha1(settings.encode('utf-8')).hexdigest()[:12]}"
+        return key
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], f"{key}.txt")
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        Возвращает текст из кэша или None
+        """
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+
+        if self.cache_dir:
+            try:
+                with open(self._disk_path(key), 'r', encoding='utf-8') as f:
+                    text = f.read()
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.warning(f"Ошибка чтения кэша вложений {key}: {e}")
+            else:
+                with self._lock:
+                    self.disk_hits += 1
+                self._put_memory(key, text)
+                return text
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key: str, text: str):
+        """
+        Сохраняет текст в память и, если задан каталог, на диск
+        """
+        self._put_memory(key, text)
+        if self.cache_dir:
+            path = self._disk_path(key)
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                # Пишем во временный файл и атомарно переименовываем,
+                # чтобы другие процессы не прочитали недописанный текст
+                fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+                with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                    f.write(text)
+                os.replace(tmp_path, path)
+            except OSError as e:
+                logger.warning(f"Ошибка записи кэша вложений {key}: {e}")
+
+    def _put_memory(self, key: str, text: str):
+        if len(text) > self.max_chars:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._size -= len(self._entries.pop(key))
+            self._entries[key] = text
+            self._size += len(text)
+            while self._size > self.max_chars:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+    def clear(self):
+        """
+        Очищает кэш в памяти и счётчики (дисковый уровень не затрагивается)
+        """
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+            self.hits = self.disk_hits = self.misses = 0
+
+    def stats(self) -> Dict:
+        """
+        Метрики кэша: попадания, промахи и доля попаданий
+        """
+        with self._lock:
+            requests = self.hits + self.disk_hits + self.misses
+            return {
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_rate': (self.hits + self.disk_hits) / requests if requests else 0.0,
+                'entries': len(self._entries),
+                'chars': self._size,
+            }
+
+
+# Общий кэш для всех экземпляров EmailParser в процессе
+default_attachment_cache = AttachmentTextCache(
+    cache_dir=os.environ.get("MAILLENS_ATTACHMENT_CACHE_DIR") or None,
+)
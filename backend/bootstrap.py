@@ -0,0 +1,227 @@
+import argparse
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from typing import Callable, Dict, List, Optional
+
+from backend.email_parser import parse_email, prepare_for_classification
+
+
+logger = logging.getLogger(__name__)
+
+# Каталог с примерами писем стандартных категорий
+DEFAULT_EXAMPLES_PATH = "emails_by_catrgories"
+
+# Стандартные категории: папка с примерами и описание
+DEFAULT_CATEGORIES = {
+    'Техническая поддержка': {
+        'folder_with_examples': 'Technical support',
+        'description': 'Письма от клиентов или сотрудников с запросами о работе систем, программ, оборудования: ошибки, сбои, вопросы по функционалу, просьбы о помощи, инциденты.',
+        },
+    'Финансовые операции, чеки и счета': {
+        'folder_with_examples': 'Financial transactions, checks and invoices',
+        'description': 'Счета на оплату, выставленные/полученные счета-фактуры, чеки, платёжные уведомления, запросы на возврат средств, подтверждения транзакций.',
+        },
+    'Вакансии и карьера': {
+        'folder_with_examples': 'Vacancies and careers',
+        'description': 'Резюме соискателей, письма от рекрутинговых агентств, запросы на стажировки, внутренние анонсы вакансий, приглашения на собеседования, запросы на оценку кандидатов.',
+        },
+    'Рекламная рассылка': {
+        'folder_with_examples': 'Promotional mailing',
+        'description': 'Письма с коммерческими предложениями, акциями, скидками, презентациями продуктов и услуг от внешних компаний или собственного маркетинга.',
+        },
+    'Новостные рассылки': {
+        'folder_with_examples': 'Newsletters',
+        'description': 'Информационные бюллетени: отраслевые новости, обновления законодательства, корпоративные анонсы, аналитика, обзоры рынка — без прямого призыва к действию.',
+        },
+    'Регистрация и подтверждение': {
+        'folder_with_examples': 'Registration and confirmation',
+        'description': 'Письма, связанные с созданием или верификацией аккаунтов: подтверждение email, сброс пароля, двухфакторная аутентификация, привязка устройств.',
+        },
+    'Транспорт и путешествия': {
+        'folder_with_examples': 'Transport and travel',
+        'description': 'Бронирование билетов и отелей, уведомления о перелётах/поездах на такси, запросы на командировки.',
+        },
+    'Неприемлемый контент': {
+        'folder_with_examples': 'Harm content',
+        'description': 'Спам с порнографией, насилием, лотереями, экстремизмом',
+        },
+    'Бизнес-корреспонденция': {
+        'folder_with_examples': 'Business and correspondence',
+        'description': 'Официальные письма от партнёров, поставщиков, клиентов и госорганов: предложения сотрудничества, переговоры, юридические запросы, договоры, претензии.',
+        },
+    'Системные и сервисные уведомления': {
+        'folder_with_examples': 'System and service notifications',
+        'description': 'Автоматические сообщения от IT-систем: отчёты, алерты, уведомления о бэкапах, обновлениях, ошибках в интеграциях, статусы задач из CRM/ERP и т.п.',
+        },
+}
+
+# Папка с письмами, не относящимися ни к одной стандартной категории
+UNKNOWN_EXAMPLES_FOLDER = 'Other'
+
+# progress(этап, выполнено, всего), этапы: 'parse' и 'encode'
+ProgressCallback = Callable[[str, int, int], None]
+
+# С какого числа файлов парсить в пуле процессов: spawn-процесс заново
+# импортирует парсеры (PyPDF2, docx, openpyxl, extract_msg), и на десятках
+# примеров это дольше самого парсинга в потоках
+PROCESS_POOL_MIN_FILES = 500
+
+
+def collect_example_files(base_path: str = DEFAULT_EXAMPLES_PATH,
+                          categories: Dict[str, Dict] = None) -> Dict[str, List[str]]:
+    """
+    Находит файлы примеров для каждой категории, у которой есть папка с письмами
+    """
+    categories = DEFAULT_CATEGORIES if categories is None else categories
+    files_by_category = {}
+    if not os.path.isdir(base_path):
+        return files_by_category
+    for category, info in categories.items():
+        category_path = os.path.join(base_path, info['folder_with_examples'])
+        if not os.path.isdir(category_path):
+            continue
+        files = [os.path.join(category_path, f) for f in os.listdir(category_path)
+                 if f.endswith(('.eml', '.msg'))]
+        if files:
+            files_by_category[category] = files
+    return files_by_category
+
+
+def _parse_example(path: str) -> str:
+    """
+    Парсит пример письма и готовит текст для модели (выполняется в отдельном процессе)
+    """
+    with open(path, 'rb') as f:
+        parsed = parse_email(f.read(), os.path.basename(path))
+    return prepare_for_classification(parsed)
+
+
+def parse_examples(files_by_category: Dict[str, List[str]], max_workers: Optional[int] = None,
+                   use_processes: Optional[bool] = None,
+                   progress: Optional[ProgressCallback] = None) -> Dict[str, List[str]]:
+    """
+    Параллельно парсит примеры писем всех категорий сразу.
+
+    Парсинг упирается в процессор и GIL, но пул процессов окупается только
+    на больших наборах: при use_processes=None процессы берутся начиная
+    с PROCESS_POOL_MIN_FILES файлов, иначе потоки. Порядок примеров внутри
+    категории сохраняется, письма с ошибками парсинга пропускаются.
+
+    Returns:
+        {категория: [тексты примеров]}
+    """
+    jobs = [(category, index, path)
+            for category, paths in files_by_category.items()
+            for index, path in enumerate(paths)]
+    texts = {category: [None] * len(paths) for category, paths in files_by_category.items()}
+    if not jobs:
+        return {}
+
+    if use_processes is None:
+        use_processes = len(jobs) >= PROCESS_POOL_MIN_FILES
+    if use_processes:
+        # spawn не наследует от родителя потоки и состояние CUDA
+        executor = ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn'))
+    else:
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+    with executor:
+        futures = {executor.submit(_parse_example, path): (category, index, path) for category, index, path in jobs}
+        for done, future in enumerate(as_completed(futures), start=1):
+            category, index, path = futures[future]
+            try:
+                texts[category][index] = future.result()
+            except Exception as e:
+                logger.error(f"Ошибка при обработке примера {path}: {e}")
+            if progress is not None:
+                progress('parse', done, len(jobs))
+
+    return {category: [text for text in category_texts if text is not None]
+            for category, category_texts in texts.items()}
+
+
+def load_unknown_texts(base_path: str = DEFAULT_EXAMPLES_PATH, max_workers: Optional[int] = None,
+                       use_processes: Optional[bool] = None) -> List[str]:
+    """
+    Тексты писем вне категорий (папка Other) - негативы для калибровки и класс «Не определена»
+    """
+    folder = os.path.join(base_path, UNKNOWN_EXAMPLES_FOLDER)
+    if not os.path.isdir(folder):
+        return []
+    files = [os.path.join(folder, f) for f in sorted(os.listdir(folder)) if f.endswith(('.eml', '.msg'))]
+    texts = parse_examples({UNKNOWN_EXAMPLES_FOLDER: files}, max_workers=max_workers, use_processes=use_processes)
+    return texts.get(UNKNOWN_EXAMPLES_FOLDER, [])
+
+
+def load_default_categories(classifier, base_path: str = DEFAULT_EXAMPLES_PATH,
+                            categories: Dict[str, Dict] = None, max_workers: Optional[int] = None,
+                            use_processes: Optional[bool] = None,
+                            progress: Optional[ProgressCallback] = None) -> List[str]:
+    """
+    Загружает стандартные категории в классификатор: параллельный парсинг
+    всех примеров и один общий проход энкодера по промптам всех категорий
+
+    Returns:
+        Список загруженных категорий
+    """
+    categories = DEFAULT_CATEGORIES if categories is None else categories
+    started = time.perf_counter()
+    examples = parse_examples(
+        collect_example_files(base_path, categories),
+        max_workers=max_workers,
+        use_processes=use_processes,
+        progress=progress,
+    )
+    parsed = time.perf_counter()
+
+    encode_progress = (lambda done, total: progress('encode', done, total)) if progress is not None else None
+    loaded = classifier.add_categories(
+        {
+            category: {'description': categories[category]['description'], 'example_texts': texts}
+            for category, texts in examples.items() if texts
+        },
+        progress=encode_progress,
+    )
+    logger.info(
+        f"Загружено категорий: {len(loaded)}, парсинг {parsed - started:.1f} с, "
+        f"кодирование {time.perf_counter() - parsed:.1f} с"
+    )
+    return loaded
+
+
+def _print_progress(stage: str, done: int, total: int):
+    label = {'parse': "Парсинг примеров", 'encode': "Кодирование промптов"}[stage]
+    print(f"\r{label}: {done}/{total}", end="\n" if done == total else "", flush=True)
+
+
+def main():
+    from backend.classifier import MailClassifier
+
+    arg_parser = argparse.ArgumentParser(description="Загрузка стандартных категорий из примеров писем")
+    arg_parser.add_argument("--examples", default=DEFAULT_EXAMPLES_PATH, help="Каталог с папками примеров категорий")
+    arg_parser.add_argument("--output", required=True, help="Файл набора категорий (.npz)")
+    arg_parser.add_argument("--workers", type=int, default=None, help="Число потоков или процессов для парсинга")
+    pool = arg_parser.add_mutually_exclusive_group()
+    pool.add_argument("--threads", dest="use_processes", action="store_false", default=None,
+                      help="Всегда парсить в потоках")
+    pool.add_argument("--processes", dest="use_processes", action="store_true", default=None,
+                      help="Всегда парсить в процессах")
+    args = arg_parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    classifier = MailClassifier()
+    loaded = load_default_categories(
+        classifier,
+        args.examples,
+        max_workers=args.workers,
+        use_processes=args.use_processes,
+        progress=_print_progress,
+    )
+    classifier.save_category_set(args.output)
+    print(f"Сохранено категорий: {len(loaded)} в {args.output}")
+
+
+if __name__ == "__main__":
+    main()
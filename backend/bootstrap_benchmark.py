@@ -0,0 +1,69 @@
+import argparse
+import logging
+import time
+from typing import Dict, List
+
+from backend.bootstrap import DEFAULT_CATEGORIES, DEFAULT_EXAMPLES_PATH, collect_example_files, parse_examples
+
+
+logger = logging.getLogger(__name__)
+
+
+def time_parse(files_by_category: Dict[str, List[str]], use_processes: bool, max_workers: int = None) -> float:
+    """
+    Время параллельного парсинга примеров в потоках или в процессах, с
+    """
+    started = time.perf_counter()
+    parse_examples(files_by_category, max_workers=max_workers, use_processes=use_processes)
+    return time.perf_counter() - started
+
+
+def time_encode(model, examples: Dict[str, List[str]], batched: bool) -> float:
+    """
+    Время кодирования промптов категорий: одним проходом add_categories
+    или отдельным вызовом add_category на каждую категорию, с
+    """
+    from backend.classifier import MailClassifier
+
+    classifier = MailClassifier(model=model)
+    categories = {
+        category: {'description': DEFAULT_CATEGORIES[category]['description'], 'example_texts': texts}
+        for category, texts in examples.items()
+    }
+    started = time.perf_counter()
+    if batched:
+        classifier.add_categories(categories)
+    else:
+        for category, info in categories.items():
+            classifier.add_category(category, info['description'], info['example_texts'])
+    return time.perf_counter() - started
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Время загрузки стандартных категорий по этапам")
+    arg_parser.add_argument("--examples", default=DEFAULT_EXAMPLES_PATH, help="Каталог с папками примеров категорий")
+    arg_parser.add_argument("--workers", type=int, default=None, help="Число потоков или процессов для парсинга")
+    arg_parser.add_argument("--stub", action="store_true", help="Детерминированная заглушка вместо модели")
+    arg_parser.add_argument("--repeat", type=int, default=3, help="Число повторов, берётся лучший")
+    args = arg_parser.parse_args()
+
+    files_by_category = collect_example_files(args.examples)
+    print(f"Примеров: {sum(len(paths) for paths in files_by_category.values())}, категорий: {len(files_by_category)}")
+    for label, use_processes in (("потоки", False), ("процессы", True)):
+        elapsed = min(time_parse(files_by_category, use_processes, args.workers) for _ in range(args.repeat))
+        print(f"Парсинг, {label}: {elapsed:.2f} с")
+
+    if args.stub:
+        from backend.loadtest import StubEncoder
+        model = StubEncoder()
+    else:
+        from backend.classifier import load_encoder
+        model = load_encoder()
+    examples = parse_examples(files_by_category, max_workers=args.workers, use_processes=False)
+    for label, batched in (("add_category по одной", False), ("add_categories одним проходом", True)):
+        elapsed = min(time_encode(model, examples, batched) for _ in range(args.repeat))
+        print(f"Кодирование, {label}: {elapsed:.2f} с")
+
+
+if __name__ == "__main__":
+    main()
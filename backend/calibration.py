@@ -0,0 +1,154 @@
+import logging
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+# Сетки порогов и отрывов, по которым идёт перебор
+THRESHOLD_GRID = np.linspace(0.0, 1.0, 201)
+MARGIN_GRID = np.linspace(0.0, 0.1, 21)
+# Минимальная близость пересчитанного промпта примера к сохранённой строке,
+# при которой строка считается промптом того же примера (с учётом квантизации)
+SAME_ROW_SIMILARITY = 0.99
+
+
+def leave_one_out_scores(classifier, examples: Dict[str, List[str]],
+                         batch_size: int = 32) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Близости примеров ко всем категориям по схеме leave-one-out.
+
+    Каждый пример кодируется как письмо (encode_emails), то есть так же,
+    как входящие письма при предсказании. Его близость к своей категории
+    считается без строки-промпта этого же примера: эмбеддинг промпта
+    пересчитывается и вычитается из суммы по категории.
+
+    Вычитать можно, только если примеры - ровно те, из которых построена
+    категория, и в том же порядке: пересчитанные промпты сверяются
+    с сохранёнными строками. Иначе (например, категория набора с тем же
+    названием, но своими примерами) тексты оцениваются как отложенные письма.
+
+    Returns:
+        Tuple[матрица близостей (число примеров, число категорий), индексы истинных категорий]
+    """
+    store = classifier.categories
+    names = store.keys()
+    counts = np.diff(store.offsets)
+    texts, prompts, labels = [], [], []
+    for index, name in enumerate(names):
+        category_texts = examples.get(name) or []
+        texts.extend(category_texts)
+        # Первый промпт - описание категории, остальные - промпты примеров
+        prompts.extend(classifier._category_prompts(name, '', category_texts)[1:])
+        labels.extend([index] * len(category_texts))
+    labels = np.asarray(labels, dtype=int)
+    if not texts:
+        return np.zeros((0, len(names)), dtype=np.float32), np.zeros(0, dtype=int)
+
+    queries = classifier.encode_emails(texts, batch_size=batch_size)
+    own_rows = classifier.model.encode(
+        prompts, batch_size=batch_size, normalize_embeddings=True, convert_to_numpy=True, show_progress_bar=False
+    )
+    # Категории, строки которых построены ровно из этих примеров
+    own_category = np.zeros(len(names), dtype=bool)
+    for index, name in enumerate(names):
+        category_rows = np.flatnonzero(labels == index)
+        if not len(category_rows) or counts[index] != len(category_rows) + 1:
+            continue
+        stored = store.get_embeddings(name)[1:]
+        similarity = np.einsum('ij,ij->i', stored, own_rows[category_rows])
+        own_category[index] = bool((similarity >= SAME_ROW_SIMILARITY).all())
+        if not own_category[index]:
+            logger.info(f"Примеры категории {name} не совпадают с её строками: оцениваются как отложенные письма")
+
+    sums = store.category_scores(queries) * counts[None, :]
+    # Исключаем сам пример из суммы по его категории
+    rows = np.flatnonzero(own_category[labels])
+    sums[rows, labels[rows]] -= np.einsum('ij,ij->i', queries[rows], own_rows[rows])
+    sizes = np.broadcast_to(counts, sums.shape).astype(np.float32).copy()
+    sizes[rows, labels[rows]] -= 1
+    return sums / np.maximum(sizes, 1), labels
+
+
+def sweep_category(scores: np.ndarray, labels: np.ndarray, category: int) -> Optional[Tuple[float, float, float]]:
+    """
+    Подбирает порог и отрыв категории перебором по сетке, максимизируя F1.
+    Письма с меткой -1 (вне категорий) и примеры других категорий служат негативами
+
+    Returns:
+        Tuple[порог, отрыв, F1] или None, если у категории нет примеров
+    """
+    positives = int((labels == category).sum())
+    if not positives:
+        return None
+
+    order = np.sort(scores, axis=1)
+    best = scores.argmax(axis=1)
+    runner_up = order[:, -2] if scores.shape[1] > 1 else np.full(len(scores), -1.0)
+    assigned = best == category
+    top = scores[:, category]
+    gap = top - runner_up
+
+    # Матрица решений (примеры × пороги × отрывы)
+    accepted = (
+        assigned[:, None, None]
+        & (top[:, None, None] >= THRESHOLD_GRID[None, :, None])
+        & (gap[:, None, None] >= MARGIN_GRID[None, None, :])
+    )
+    is_positive = (labels == category)[:, None, None]
+    tp = (accepted & is_positive).sum(axis=0)
+    fp = (accepted & ~is_positive).sum(axis=0)
+    f1 = 2 * tp / np.maximum(2 * tp + fp + (positives - tp), 1)
+
+    # Из равноценных вариантов берём наименьший отрыв и наибольший порог:
+    # нижняя часть диапазона одинаковых F1 ничем не ограничена снизу
+    best_f1 = f1.max()
+    margin_index = int(np.flatnonzero((f1 == best_f1).any(axis=0))[0])
+    tied = np.flatnonzero(f1[:, margin_index] == best_f1)
+    threshold = float(THRESHOLD_GRID[tied].max())
+    return threshold, float(MARGIN_GRID[margin_index]), float(best_f1)
+
+
+def calibrate_thresholds(classifier, examples: Dict[str, List[str]],
+                         negatives: Optional[List[str]] = None) -> Dict[str, Dict[str, float]]:
+    """
+    Калибрует пороги «Не определена» и отрывы для каждой категории
+    и сохраняет их в наборе категорий классификатора.
+
+    Args:
+        classifier: MailClassifier с загруженными категориями
+        examples: тексты примеров писем по категориям (те же, что использовались
+            при добавлении категорий), оцениваются по схеме leave-one-out
+        negatives: тексты писем, не относящихся ни к одной категории (например, папка Other)
+
+    Returns:
+        Словарь {категория: {'threshold', 'margin', 'f1'}}
+    """
+    store = classifier.categories
+    if not store:
+        raise ValueError("Нет категорий для калибровки")
+    names = store.keys()
+
+    scores, labels = leave_one_out_scores(classifier, examples)
+    if negatives:
+        scores = np.concatenate([scores, store.category_scores(classifier.encode_emails(negatives))])
+        labels = np.concatenate([labels, np.full(len(negatives), -1)])
+    else:
+        logger.warning("Калибровка без писем вне категорий: пороги подбираются только по примерам других категорий")
+
+    report, thresholds, margins = {}, {}, {}
+    for index, name in enumerate(names):
+        calibrated = sweep_category(scores, labels, index)
+        if calibrated is None:
+            logger.info(f"Категория {name} не откалибрована: нет отложенных примеров")
+            continue
+        if calibrated[2] == 0:
+            logger.info(f"Категория {name} не откалибрована: ни один порог не даёт F1 больше нуля")
+            continue
+        thresholds[name], margins[name], f1 = calibrated
+        report[name] = {'threshold': thresholds[name], 'margin': margins[name], 'f1': f1}
+
+    store.set_calibration(thresholds, margins)
+    logger.info(f"Откалиброваны пороги для {len(thresholds)} категорий")
+    return report
@@ -1,62 +1,90 @@
-import torch
 import numpy as np
+import copy
 import os
 import random
-from sentence_transformers import SentenceTransformer
 from collections import Counter
 import re
 
+from backend.embedding_store import CompactEmbeddingStore
+from backend.linear_head import UNKNOWN_CLASS
+
+
+MODEL_NAME = "intfloat/multilingual-e5-large"
+
+
+def load_encoder() -> 'SentenceTransformer':
+    """
+    Функция загрузки модели-энкодера на доступное устройство.
+    torch и sentence_transformers импортируются только здесь: классификатор
+    с переданной моделью (например, заглушкой энкодера) работает без них
+    """
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+        device = "cuda"
+    else:
+        device = "cpu"
+    return SentenceTransformer(MODEL_NAME, device=device)
+
 
 class MailClassifier:
     """
     Класс классификатор писем
     """
-    def __init__(self, threshold=0.7):
+    def __init__(self, threshold=0.7, embedding_dtype='float16', model: 'SentenceTransformer' = None):
         self.threshold = threshold
-        if torch.cuda.is_available():
-            torch.cuda.empty_cache()
-            self.device = "cuda" 
-        else:
-            self.device = "cpu"
-        self.model = SentenceTransformer(
-            "intfloat/multilingual-e5-large",
-            device=self.device
-        )
-        self.categories = {}
+        # Применять ли откалиброванные пороги категорий вместо общего
+        self.use_calibration = True
+        # Способ оценки: 'similarity' - средняя близость к категориям,
+        # 'head' - обученная голова (если она есть в наборе категорий)
+        self.scorer = 'similarity'
+        # Модель может быть общей для нескольких классификаторов
+        self.model = model if model is not None else load_encoder()
+        self.device = str(self.model.device)
+        # Эмбеддинги всех категорий хранятся в одной компактной матрице
+        self.categories = CompactEmbeddingStore(dtype=embedding_dtype)
 
         self.category_prefix = "Категория писем:" 
         self.email_prefix = "Классифицируй это письмо:"  
 
     
+    def _category_prompts(self, category: str, description: str = '', example_texts: list[str] = None) -> list[str]:
+        """
+        Функция формирования промптов категории: описание и примеры писем
+        """
+        prompts = []
+        if description:
+            prompts.append(f"{self.category_prefix} {category}. Описание категории: {description}")
+        else:
+            prompts.append(f"{self.category_prefix} {category}")
+
+        # Подумать над улучшением на будущее, для большего разраничения между письмами
+        # if example_texts:
+        #     # Извлекаем частые слова из примеров
+        #     all_words = []
+        #     for example in example_texts:
+        #         words = re.findall(r'\b[а-яa-z]{3,}\b', example.lower())
+        #         all_words.extend(words)
+            # common_words = Counter(all_words).most_common(20)
+            # # common_words = common_words[int(len(common_words)*0.2):int(len(common_words)*0.8)]
+            # if common_words:
+            #     keywords = ', '.join([word for word, _ in common_words])
+            #     prompts.append(f"Ключевые слова категории '{category}': {keywords}")
+
+        if example_texts:
+            for i, example in enumerate(example_texts):
+                prompt = f"Пример письма только для категории '{category}' #{i+1}: {example}."
+                prompts.append(prompt)
+        return prompts
+
     def add_category(self, category: str, description: str = '', example_texts: list[str] = None):
         """
         Функция добавления новой категории с описанием и примерами писем
         """
         if category:
-            prompts = []
-            if description:
-                prompts.append(f"{self.category_prefix} {category}. Описание категории: {description}")
-            else:
-                prompts.append(f"{self.category_prefix} {category}")
-            
-            # Подумать над улучшением на будущее, для большего разраничения между письмами
-            # if example_texts:
-            #     # Извлекаем частые слова из примеров
-            #     all_words = []
-            #     for example in example_texts:
-            #         words = re.findall(r'\b[а-яa-z]{3,}\b', example.lower())
-            #         all_words.extend(words)
-                # common_words = Counter(all_words).most_common(20)
-                # # common_words = common_words[int(len(common_words)*0.2):int(len(common_words)*0.8)]
-                # if common_words:
-                #     keywords = ', '.join([word for word, _ in common_words])
-                #     prompts.append(f"Ключевые слова категории '{category}': {keywords}")
-
-            if example_texts:
-                for i, example in enumerate(example_texts):
-                    prompt = f"Пример письма только для категории '{category}' #{i+1}: {example}."
-                    prompts.append(prompt)
-            
+            prompts = self._category_prompts(category, description, example_texts)
             # Кодируем все промпты категории в эмбеддинги
             category_embeddings = self.model.encode(
                 prompts,
@@ -64,14 +92,88 @@ class MailClassifier:
                 convert_to_numpy=True,
                 show_progress_bar=False
             )
-            # Сохраняем категорию со всей информацией
-            category_data = {
-                'embeddings': category_embeddings,
-            }
-            self.categories[category] = category_data
+            # Сохраняем категорию в компактном хранилище
+            self.categories.add(category, category_embeddings)
         else:
             raise ValueError("Не была передана категория")
 
+    def add_categories(self, categories: dict[str, dict], batch_size: int = 32, chunk_size: int = 256,
+                       progress=None) -> list[str]:
+        """
+        Функция добавления сразу нескольких категорий за один проход энкодера.
+
+        Промпты всех категорий сортируются по длине и кодируются общими пачками,
+        после чего эмбеддинги раскладываются обратно по категориям.
+
+        Args:
+            categories: {название: {'description': ..., 'example_texts': [...]}}
+            chunk_size: число промптов между вызовами progress
+            progress: функция progress(закодировано промптов, всего промптов)
+
+        Returns:
+            Список добавленных категорий
+        """
+        names, prompts, owners = [], [], []
+        for category, info in categories.items():
+            if not category:
+                raise ValueError("Не была передана категория")
+            category_prompts = self._category_prompts(
+                category, info.get('description', ''), info.get('example_texts')
+            )
+            owners.extend([len(names)] * len(category_prompts))
+            prompts.extend(category_prompts)
+            names.append(category)
+        if not prompts:
+            return []
+
+        # Промпты близкой длины попадают в одну пачку и меньше дополняются паддингом
+        order = np.argsort([len(prompt) for prompt in prompts], kind='stable')
+        embeddings = None
+        for start in range(0, len(order), chunk_size):
+            chunk = order[start:start + chunk_size]
+            chunk_embeddings = self.model.encode(
+                [prompts[i] for i in chunk],
+                batch_size=batch_size,
+                normalize_embeddings=True,
+                convert_to_numpy=True,
+                show_progress_bar=False
+            )
+            if embeddings is None:
+                embeddings = np.empty((len(prompts), chunk_embeddings.shape[1]), dtype=chunk_embeddings.dtype)
+            embeddings[chunk] = chunk_embeddings
+            if progress is not None:
+                progress(min(start + chunk_size, len(order)), len(order))
+
+        owners = np.asarray(owners)
+        for index, category in enumerate(names):
+            self.categories.add(category, embeddings[owners == index])
+        return names
+
+    def session_view(self) -> 'MailClassifier':
+        """
+        Функция создания представления классификатора для одной сессии: модель и набор
+        категорий общие с исходным, а порог и способ оценки можно менять независимо
+        """
+        return copy.copy(self)
+
+    def save_category_set(self, path: str, name: str = None):
+        """
+        Функция сохранения набора категорий и порога в .npz файл
+        """
+        arrays = self.categories.to_arrays()
+        if name is not None:
+            # Исходное имя набора: имя файла приводится к безопасному виду и его не восстановить
+            arrays['set_name'] = np.array(name)
+        np.savez(path, threshold=np.array(self.threshold), **arrays)
+
+    def load_category_set(self, path: str):
+        """
+        Функция загрузки набора категорий и порога из .npz файла
+        """
+        with np.load(path) as arrays:
+            self.threshold = float(arrays['threshold'])
+            self.categories = CompactEmbeddingStore.from_arrays(arrays)
+
     def predict(self, text):
         """
         Функция предсказания категории письма по переданным текстовым данным
@@ -79,20 +181,64 @@ class MailClassifier:
         if not self.categories:
             return {"error": "Нет категорий для классификации!"}
         
-        mail_emb = self.model.encode(f"{self.email_prefix} {text}", normalize_embeddings=True)
-        category_scores = {}
-        
-        # Для каждой категории считаем близость эмбеддингами
-        for category, category_data in self.categories.items():
-            cat_embeddings = category_data['embeddings']
-            
-            # Считаем косинусную близость со всеми эмбеддингами категории
-            similarities = np.dot(cat_embeddings, mail_emb.T).flatten()
-            
-            # Выбираем max близость
-            category_scores[category] = float(np.mean(similarities))
-        
-        similarities = np.array(list(category_scores.values()))
+        mail_emb = self.encode_emails([text])
+        return self.predict_embeddings(mail_emb)[0]
+
+    def encode_emails(self, texts: list[str], batch_size: int = 32) -> np.ndarray:
+        """
+        Функция кодирования текстов писем в нормализованные эмбеддинги
+        """
+        return self.model.encode(
+            [f"{self.email_prefix} {text}" for text in texts],
+            batch_size=batch_size,
+            normalize_embeddings=True,
+            convert_to_numpy=True,
+            show_progress_bar=False
+        )
+
+    def predict_embeddings(self, mail_embs: np.ndarray) -> list[dict]:
+        """
+        Функция предсказания категорий по уже посчитанным эмбеддингам писем.
+        Позволяет переоценить историю при смене порога или категорий без энкодера
+        """
+        if not self.categories:
+            return [{"error": "Нет категорий для классификации!"} for _ in range(len(mail_embs))]
+        if not len(mail_embs):
+            return []
+
+        # Голова, не знающая какой-то категории, никогда её не предскажет - тогда оценка по близости
+        if self.scorer == 'head' and self.categories.head_ready:
+            probabilities = self.categories.head.predict_proba(mail_embs)
+            return [self._build_head_prediction(row) for row in probabilities]
+
+        # Считаем среднюю косинусную близость со всеми категориями одним умножением
+        scores = self.categories.category_scores(mail_embs)
+        return [self._build_prediction(row) for row in scores]
+
+    def _build_head_prediction(self, probabilities: np.ndarray) -> dict:
+        """
+        Функция формирования результата по вероятностям классов обученной головы
+        """
+        classes = self.categories.head.classes
+        results = [
+            {"category": category, "similarity": float(probability)}
+            for category, probability in zip(classes, probabilities)
+            if category != UNKNOWN_CLASS
+        ]
+        results.sort(key=lambda x: x["similarity"], reverse=True)
+
+        predicted = classes[int(np.argmax(probabilities))]
+        return {
+            "predicted_category": predicted,
+            "best_similarity": float(results[0]["similarity"]),
+            "all_scores": results,
+        }
+
+    def _build_prediction(self, scores: np.ndarray) -> dict:
+        """
+        Функция формирования результата по близостям письма ко всем категориям
+        """
+        category_scores = dict(zip(self.categories.keys(), scores))
         
         # Формируем результаты
         results = []
@@ -104,9 +250,14 @@ class MailClassifier:
         
         results.sort(key=lambda x: x["similarity"], reverse=True)
         
-        # Применяем порог
+        # Применяем порог: откалиброванный для категории или общий
         best_result = results[0]
-        if best_result["similarity"] < self.threshold:
+        threshold, margin = self.threshold, 0.0
+        if self.use_calibration:
+            threshold = self.categories.thresholds.get(best_result["category"], self.threshold)
+            margin = self.categories.margins.get(best_result["category"], 0.0)
+        runner_up = results[1]["similarity"] if len(results) > 1 else -1.0
+        if best_result["similarity"] < threshold or best_result["similarity"] - runner_up < margin:
             predicted = "Не определена"
         else:
             predicted = best_result["category"]
@@ -116,4 +267,3 @@ class MailClassifier:
             "best_similarity": float(best_result["similarity"]),
             "all_scores": results,
         }
-    
\ No newline at end of file
@@ -0,0 +1,468 @@
+import logging
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+# Блокировка файла индекса между процессами (приложение и watcher --index)
+try:
+    import fcntl
+    FILE_LOCK_SUPPORT = True
+except ImportError:
+    FILE_LOCK_SUPPORT = False
+    logging.warning("fcntl not available. Only one process may write to an email index directory at a time.")
+
+
+logger = logging.getLogger(__name__)
+
+# Поля метаданных письма в индексе
+INDEX_FIELDS = [
+    'file_name',
+    'file_size',
+    'sha256',
+    'subject',
+    'sender',
+    'predicted_category',
+    'best_similarity',
+    'tenant',
+    'timestamp',
+]
+
+# Векторы хранятся в половинной точности, как эмбеддинги в ResultsStore
+VECTOR_DTYPE = np.float16
+VECTORS_FILENAME = 'vectors.f16'
+METADATA_FILENAME = 'metadata.sqlite'
+LOCK_FILENAME = 'index.lock'
+
+# Эскиз индекса: проекции векторов на главные компоненты для грубого отбора кандидатов
+SKETCH_BASIS_FILENAME = 'sketch_basis.npz'
+SKETCH_FILENAME = 'sketch.f32'
+SKETCH_DIM = 64
+# Эскиз строится, когда в индексе набирается SKETCH_MIN_ROWS писем
+SKETCH_MIN_ROWS = 10_000
+SKETCH_SAMPLE_ROWS = 20_000
+# Число кандидатов эскиза, которые переоцениваются по полным векторам
+SKETCH_CANDIDATES = 1024
+
+
+def _top_rows(scores: np.ndarray, k: int) -> np.ndarray:
+    """
+    Индексы k наибольших оценок без полной сортировки
+    """
+    if len(scores) <= k:
+        return np.arange(len(scores))
+    return np.argpartition(-scores, k)[:k]
+
+
+class EmailIndex:
+    """
+    Постоянный индекс эмбеддингов классифицированных писем.
+
+    Векторы дописываются в конец плоского файла float16 и читаются через
+    memmap, метаданные (файл, категория, оценка, тема, отправитель)
+    хранятся в SQLite под тем же номером строки.
+
+    Полный просмотр упирается в чтение 2 КБ на письмо, поэтому в больших
+    индексах поиск двухэтапный: кандидаты отбираются по эскизу - проекциям
+    векторов на SKETCH_DIM главных компонент, - а затем переоцениваются
+    по полным векторам. Энкодер для истории повторно не запускается.
+
+    Каталог индекса могут одновременно использовать несколько процессов:
+    запись идёт под исключительной блокировкой файла index.lock, а перед
+    каждой операцией состояние объекта сверяется с файлами, которые мог
+    дописать другой процесс. Без fcntl писать в индекс может только один процесс.
+    """
+
+    def __init__(self, path: str, dim: Optional[int] = None):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.vectors_path = os.path.join(path, VECTORS_FILENAME)
+        self.sketch_path = os.path.join(path, SKETCH_FILENAME)
+        self.sketch_basis_path = os.path.join(path, SKETCH_BASIS_FILENAME)
+        self._lock = threading.Lock()
+        self._lock_file = open(os.path.join(path, LOCK_FILENAME), 'a+b') if FILE_LOCK_SUPPORT else None
+        self._conn = sqlite3.connect(os.path.join(path, METADATA_FILENAME), check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        with self._conn:
+            self._conn.execute(
+                f"CREATE TABLE IF NOT EXISTS emails (row INTEGER PRIMARY KEY, {', '.join(INDEX_FIELDS)})"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS emails_category ON emails (predicted_category)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS emails_sha256 ON emails (sha256)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS emails_tenant ON emails (tenant, predicted_category)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS info (key TEXT PRIMARY KEY, value TEXT)")
+        self.dim = None
+        self._count = 0
+        self._vectors: Optional[np.memmap] = None
+        # Эскиз: среднее, базис главных компонент и проекции всех векторов
+        self._sketch_mean: Optional[np.ndarray] = None
+        self._sketch_basis: Optional[np.ndarray] = None
+        self._sketch_basis_mtime = None
+        self._sketch: Optional[np.memmap] = None
+        self._sketch_rows = 0
+        with self._locked(exclusive=True):
+            if dim is not None and self.dim is not None and self.dim != dim:
+                raise ValueError(
+                    f"Размерность индекса {path} ({self.dim}) не совпадает с размерностью эмбеддингов ({dim})"
+                )
+            if self.dim is None:
+                self.dim = dim
+
+    @contextmanager
+    def _locked(self, exclusive: bool):
+        """
+        Блокировка индекса внутри процесса и между процессами. Под блокировкой
+        состояние объекта сверяется с файлами индекса; исправлять файлы после
+        прерванной записи можно только под исключительной блокировкой
+        """
+        with self._lock:
+            if self._lock_file is not None:
+                fcntl.flock(self._lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                self._sync(repair=exclusive)
+                yield
+            finally:
+                if self._lock_file is not None:
+                    fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def _sync(self, repair: bool):
+        """
+        Подхватывает изменения индекса, сделанные другим процессом: размерность,
+        число писем и эскиз
+        """
+        if self.dim is None:
+            stored_dim = self._conn.execute("SELECT value FROM info WHERE key = 'dim'").fetchone()
+            if stored_dim is None:
+                return
+            self.dim = int(stored_dim['value'])
+        self._recover(repair)
+
+        basis_mtime = os.stat(self.sketch_basis_path).st_mtime_ns if os.path.exists(self.sketch_basis_path) else None
+        if basis_mtime != self._sketch_basis_mtime:
+            self._sketch_mean, self._sketch_basis, self._sketch, self._sketch_rows = None, None, None, 0
+            if basis_mtime is not None:
+                with np.load(self.sketch_basis_path) as arrays:
+                    self._sketch_mean = arrays['mean']
+                    self._sketch_basis = arrays['basis']
+            self._sketch_basis_mtime = basis_mtime
+        if self._sketch_basis is None:
+            return
+        if repair:
+            self._sync_sketch()
+        else:
+            row_bytes = SKETCH_DIM * np.dtype(np.float32).itemsize
+            sketch_rows = os.path.getsize(self.sketch_path) // row_bytes if os.path.exists(self.sketch_path) else 0
+            self._sketch_rows = min(sketch_rows, self._count)
+
+    def _recover(self, repair: bool = True):
+        """
+        Согласует файл векторов и метаданные после прерванной записи
+        """
+        row_bytes = self.dim * np.dtype(VECTOR_DTYPE).itemsize
+        file_rows = os.path.getsize(self.vectors_path) // row_bytes if os.path.exists(self.vectors_path) else 0
+        # Строки нумеруются подряд с нуля, поэтому их число - это MAX(row) + 1 по первичному ключу,
+        # без просмотра всей таблицы на каждой операции
+        metadata_rows = self._conn.execute("SELECT COALESCE(MAX(row) + 1, 0) FROM emails").fetchone()[0]
+        count = min(file_rows, metadata_rows)
+        if count != self._count:
+            self._vectors = None
+        self._count = count
+        if not repair:
+            return
+        if os.path.exists(self.vectors_path) and os.path.getsize(self.vectors_path) != count * row_bytes:
+            with open(self.vectors_path, 'r+b') as f:
+                f.truncate(count * row_bytes)
+            logger.warning(f"Индекс {self.path} восстановлен после прерванной записи: {count} писем")
+        if metadata_rows != count:
+            with self._conn:
+                self._conn.execute("DELETE FROM emails WHERE row >= ?", (count,))
+            logger.warning(f"Индекс {self.path} восстановлен после прерванной записи: {count} писем")
+
+    def __len__(self) -> int:
+        with self._locked(exclusive=False):
+            return self._count
+
+    def add(self, embedding: np.ndarray, metadata: Dict[str, Any]) -> int:
+        """
+        Добавляет эмбеддинг письма и его метаданные, возвращает номер строки
+        """
+        return self.add_batch(np.asarray(embedding)[None, :], [metadata])[0]
+
+    def add_batch(self, embeddings: np.ndarray, metadata: List[Dict[str, Any]]) -> List[int]:
+        """
+        Добавляет пачку эмбеддингов писем и их метаданные
+
+        Returns:
+            Номера строк добавленных писем
+        """
+        embeddings = np.atleast_2d(np.asarray(embeddings, dtype=VECTOR_DTYPE))
+        if len(embeddings) != len(metadata):
+            raise ValueError("Число эмбеддингов не совпадает с числом записей метаданных")
+        if not len(embeddings):
+            return []
+
+        with self._locked(exclusive=True):
+            if self.dim is None:
+                self.dim = embeddings.shape[1]
+                # Новый индекс начинается с пустого файла векторов
+                open(self.vectors_path, 'wb').close()
+                with self._conn:
+                    self._conn.execute("INSERT INTO info (key, value) VALUES ('dim', ?)", (str(self.dim),))
+            elif embeddings.shape[1] != self.dim:
+                raise ValueError(f"Размерность эмбеддингов {embeddings.shape[1]} не совпадает с индексом ({self.dim})")
+
+            rows = list(range(self._count, self._count + len(embeddings)))
+            # Сначала векторы, затем метаданные: при сбое лишние векторы отрезаются в _recover
+            with open(self.vectors_path, 'ab') as f:
+                f.write(np.ascontiguousarray(embeddings).tobytes())
+            placeholders = ', '.join('?' for _ in range(len(INDEX_FIELDS) + 1))
+            with self._conn:
+                self._conn.executemany(
+                    f"INSERT INTO emails (row, {', '.join(INDEX_FIELDS)}) VALUES ({placeholders})",
+                    [[row] + [record.get(field) for field in INDEX_FIELDS] for row, record in zip(rows, metadata)],
+                )
+            self._count += len(embeddings)
+
+            if self._sketch_basis is None and self._count >= SKETCH_MIN_ROWS:
+                self._fit_sketch()
+            elif self._sketch_basis is not None:
+                self._sync_sketch()
+        return rows
+
+    def _open_vectors(self) -> np.memmap:
+        """
+        Отображение файла векторов в память (пересоздаётся после добавления писем)
+        """
+        if self._vectors is None or len(self._vectors) != self._count:
+            self._vectors = np.memmap(self.vectors_path, dtype=VECTOR_DTYPE, mode='r', shape=(self._count, self.dim))
+        return self._vectors
+
+    def _matrix(self) -> Optional[np.ndarray]:
+        with self._locked(exclusive=False):
+            if not self._count:
+                return None
+            return self._open_vectors()
+
+    def _fit_sketch(self):
+        """
+        Строит базис эскиза по равномерной выборке векторов индекса
+        """
+        vectors = self._open_vectors()
+        step = max(1, len(vectors) // SKETCH_SAMPLE_ROWS)
+        sample = np.asarray(vectors[::step], dtype=np.float32)
+        mean = sample.mean(axis=0)
+        centered = sample - mean
+        # Главные компоненты - собственные векторы ковариации с наибольшими значениями
+        _, eigenvectors = np.linalg.eigh(centered.T @ centered)
+        basis = np.ascontiguousarray(eigenvectors[:, ::-1][:, :SKETCH_DIM]).astype(np.float32)
+
+        tmp_path = self.sketch_basis_path + '.tmp.npz'
+        np.savez(tmp_path, mean=mean, basis=basis)
+        os.replace(tmp_path, self.sketch_basis_path)
+        open(self.sketch_path, 'wb').close()
+        self._sketch_mean, self._sketch_basis = mean, basis
+        self._sketch_basis_mtime = os.stat(self.sketch_basis_path).st_mtime_ns
+        self._sketch, self._sketch_rows = None, 0
+        self._sync_sketch()
+        logger.info(f"Построен эскиз индекса {self.path}: {self._count} писем, {SKETCH_DIM} компонент")
+
+    def _sync_sketch(self, chunk_rows: int = 65_536):
+        """
+        Дописывает в эскиз проекции векторов, которых в нём ещё нет
+        """
+        row_bytes = SKETCH_DIM * np.dtype(np.float32).itemsize
+        sketch_rows = os.path.getsize(self.sketch_path) // row_bytes if os.path.exists(self.sketch_path) else 0
+        if sketch_rows > self._count or not os.path.exists(self.sketch_path) \
+                or os.path.getsize(self.sketch_path) != sketch_rows * row_bytes:
+            # Эскиз длиннее индекса или запись прервана - обрезаем до целых строк
+            sketch_rows = min(sketch_rows, self._count)
+            with open(self.sketch_path, 'ab') as f:
+                f.truncate(sketch_rows * row_bytes)
+        if sketch_rows < self._count:
+            vectors = self._open_vectors()
+            with open(self.sketch_path, 'ab') as f:
+                for start in range(sketch_rows, self._count, chunk_rows):
+                    block = np.asarray(vectors[start:start + chunk_rows], dtype=np.float32)
+                    f.write(((block - self._sketch_mean) @ self._sketch_basis).astype(np.float32).tobytes())
+        self._sketch_rows = self._count
+        self._sketch = None
+
+    def _open_sketch(self) -> Optional[np.ndarray]:
+        with self._lock:
+            if self._sketch_basis is None or not self._sketch_rows:
+                return None
+            if self._sketch is None or len(self._sketch) != self._sketch_rows:
+                self._sketch = np.memmap(self.sketch_path, dtype=np.float32, mode='r',
+                                         shape=(self._sketch_rows, SKETCH_DIM))
+            return self._sketch
+
+    def vector(self, row: int) -> np.ndarray:
+        """
+        Эмбеддинг письма по номеру строки
+        """
+        matrix = self._matrix()
+        if matrix is None or not 0 <= row < len(matrix):
+            raise ValueError(f"В индексе нет письма с номером {row}")
+        return np.asarray(matrix[row], dtype=np.float32)
+
+    def get(self, rows: List[int]) -> List[Dict[str, Any]]:
+        """
+        Метаданные писем по номерам строк в порядке запроса
+        """
+        if not rows:
+            return []
+        with self._lock:
+            records = self._conn.execute(
+                f"SELECT * FROM emails WHERE row IN ({', '.join('?' for _ in rows)})",
+                [int(row) for row in rows],
+            ).fetchall()
+        by_row = {record['row']: dict(record) for record in records}
+        return [by_row[int(row)] for row in rows if int(row) in by_row]
+
+    def _mask(self, count: int, category: Optional[str] = None, tenant: Optional[str] = None) -> np.ndarray:
+        """
+        Маска строк, подходящих под фильтры по категории и набору категорий
+        """
+        conditions, params = ["row < ?"], [count]
+        if category is not None:
+            conditions.append("predicted_category = ?")
+            params.append(category)
+        if tenant is not None:
+            conditions.append("tenant = ?")
+            params.append(tenant)
+        with self._lock:
+            rows = [record[0] for record in self._conn.execute(
+                f"SELECT row FROM emails WHERE {' AND '.join(conditions)}", params
+            )]
+        mask = np.zeros(count, dtype=bool)
+        mask[rows] = True
+        return mask
+
+    def _rows_with_sha256(self, sha256: str, count: int) -> List[int]:
+        with self._lock:
+            return [record[0] for record in self._conn.execute(
+                "SELECT row FROM emails WHERE sha256 = ? AND row < ?", (sha256, count)
+            )]
+
+    @staticmethod
+    def _scan(matrix: np.ndarray, query: np.ndarray, k: int, mask: Optional[np.ndarray],
+              exclude: Optional[List[int]], chunk_rows: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Блочно умножает матрицу на запрос и отбирает k лучших строк
+        """
+        best_rows, best_scores = [], []
+        for start in range(0, len(matrix), chunk_rows):
+            # Блок переводится в float32 только на время умножения
+            scores = np.asarray(matrix[start:start + chunk_rows], dtype=np.float32) @ query
+            if mask is not None:
+                scores[~mask[start:start + len(scores)]] = -np.inf
+            for row in exclude or ():
+                if start <= row < start + len(scores):
+                    scores[row - start] = -np.inf
+            top = _top_rows(scores, k)
+            best_rows.append(top + start)
+            best_scores.append(scores[top])
+        return np.concatenate(best_rows), np.concatenate(best_scores)
+
+    def search(self, query: np.ndarray, k: int = 10, category: Optional[str] = None, tenant: Optional[str] = None,
+               exclude: Optional[List[int]] = None, exclude_sha256: Optional[str] = None, exact: bool = False,
+               candidates: int = SKETCH_CANDIDATES, chunk_rows: int = 262_144) -> List[Dict[str, Any]]:
+        """
+        Находит k писем, наиболее похожих на эмбеддинг запроса
+
+        Args:
+            query: нормализованный эмбеддинг письма или текстового запроса
+            category: искать только среди писем этой категории
+            tenant: искать только среди писем этого набора категорий. В индексе лежат
+                письма всех наборов, поэтому приложение всегда передаёт текущий набор
+            exclude: номера строк, которые не попадают в выдачу (например, само письмо)
+            exclude_sha256: SHA-256 письма, все копии которого не попадают в выдачу
+            exact: полный просмотр всех векторов без отбора кандидатов по эскизу
+            candidates: число кандидатов эскиза для переоценки по полным векторам
+            chunk_rows: число строк матрицы, обрабатываемых за одно умножение
+
+        Returns:
+            Метаданные найденных писем с ключами 'row' и 'similarity', по убыванию близости
+        """
+        matrix = self._matrix()
+        if matrix is None or k <= 0:
+            return []
+        query = np.asarray(query, dtype=np.float32).ravel()
+        if query.shape[0] != self.dim:
+            raise ValueError(f"Размерность запроса {query.shape[0]} не совпадает с индексом ({self.dim})")
+        mask = None
+        if category is not None or tenant is not None:
+            mask = self._mask(len(matrix), category, tenant)
+        if exclude_sha256 is not None:
+            exclude = list(exclude or []) + self._rows_with_sha256(exclude_sha256, len(matrix))
+
+        sketch = None if exact else self._open_sketch()
+        if sketch is not None and len(sketch) == len(matrix) and len(matrix) > max(candidates, k):
+            # Грубый отбор по эскизу: сдвиг на среднее одинаков для всех писем и не меняет порядок
+            coarse_rows, _ = self._scan(sketch, query @ self._sketch_basis, max(candidates, k),
+                                        mask, exclude, chunk_rows)
+            coarse_rows = np.sort(coarse_rows)
+            scores = np.asarray(matrix[coarse_rows], dtype=np.float32) @ query
+            if mask is not None:
+                scores[~mask[coarse_rows]] = -np.inf
+            if exclude:
+                scores[np.isin(coarse_rows, exclude)] = -np.inf
+            top = _top_rows(scores, k)
+            rows, scores = coarse_rows[top], scores[top]
+        else:
+            rows, scores = self._scan(matrix, query, k, mask, exclude, chunk_rows)
+
+        order = np.argsort(-scores, kind='stable')[:k]
+        order = order[np.isfinite(scores[order])]
+        records = self.get(rows[order].tolist())
+        for record, score in zip(records, scores[order]):
+            record['similarity'] = float(score)
+        return records
+
+    def search_text(self, classifier, text: str, k: int = 10, category: Optional[str] = None,
+                    tenant: Optional[str] = None) -> List[Dict[str, Any]]:
+        """
+        Находит письма, похожие на произвольный текстовый запрос.
+        Запрос кодируется так же, как письма, чтобы попасть в то же пространство эмбеддингов
+        """
+        return self.search(classifier.encode_emails([text])[0], k=k, category=category, tenant=tenant)
+
+    def categories(self, tenant: Optional[str] = None) -> List[str]:
+        """
+        Категории писем, встречающиеся в индексе (в письмах набора tenant, если он задан)
+        """
+        query = "SELECT DISTINCT predicted_category FROM emails WHERE predicted_category IS NOT NULL"
+        params = []
+        if tenant is not None:
+            query += " AND tenant = ?"
+            params.append(tenant)
+        with self._lock:
+            return [record[0] for record in self._conn.execute(query + " ORDER BY 1", params)]
+
+    def clear(self):
+        """
+        Удаляет все письма из индекса. Другие процессы не должны в это время искать по индексу:
+        файл векторов обрезается, а их отображения в память становятся недействительными
+        """
+        with self._locked(exclusive=True):
+            self._vectors = None
+            self._sketch = None
+            open(self.vectors_path, 'wb').close()
+            for path in (self.sketch_path, self.sketch_basis_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            self._sketch_mean, self._sketch_basis, self._sketch_rows = None, None, 0
+            self._sketch_basis_mtime = None
+            with self._conn:
+                self._conn.execute("DELETE FROM emails")
+            self._count = 0
+
+    def close(self):
+        self._vectors = None
+        self._sketch = None
+        self._conn.close()
+        if self._lock_file is not None:
+            self._lock_file.close()
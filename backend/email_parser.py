@@ -1,18 +1,32 @@
 import re
 import logging
 import io
-from typing import Dict, List, Optional, Tuple, BinaryIO
+import csv
+import codecs
+import binascii
+import zipfile
+from typing import Dict, Iterator, List, Optional, Tuple, BinaryIO
 from email import policy
 from email.parser import BytesParser
 from email.header import decode_header
-import html2text
 import tempfile
 import os
 from typing import Dict, Any
 from collections import Counter
 
+from backend.attachment_cache import AttachmentTextCache, default_attachment_cache
+from backend.html_text import html_to_text
+from backend.threads import strip_quoted_text, thread_parents
+
 
 # Служебные проверки установленных библиотек для корректной работы парсера
+try:
+    import html2text
+    HTML2TEXT_SUPPORT = True
+except ImportError:
+    HTML2TEXT_SUPPORT = False
+    logging.warning("html2text not installed. HTML bodies will be converted with the built-in fast extractor only.")
+
 try:
     import extract_msg
     MSG_SUPPORT = True
@@ -44,22 +58,260 @@ except ImportError:
 
 logger = logging.getLogger(__name__)
 
+# Лимит символов, извлекаемых из одного текстового вложения
+MAX_ATTACHMENT_CHARS = 100_000
+# Лимит страниц PDF, просматриваемых при извлечении текста
+MAX_PDF_PAGES = 50
+
+# Ограничения обхода MIME-структуры письма
+MAX_MIME_DEPTH = 10
+MAX_MIME_PARTS = 500
+MAX_DECODED_BYTES = 50 * 1024 * 1024
+# Глубина вложенных писем (.eml/.msg во вложениях)
+MAX_NESTED_EMAILS = 3
+# Типы вложений, данные которых не декодируются: текст из них не извлекается
+SKIPPED_MAIN_TYPES = ('image', 'audio', 'video')
+# Режимы преобразования HTML тела письма в текст
+HTML_MODES = ('fast', 'html2text')
+
+# Размер префикса файла для определения кодировки и диалекта CSV
+CHARSET_SAMPLE_SIZE = 64 * 1024
+CSV_SNIFF_SIZE = 4096
+
+# Число первых байт вложения, по которым определяется его формат
+FORMAT_SNIFF_SIZE = 4096
+# Сигнатуры форматов по первым байтам файла
+MAGIC_SIGNATURES = [
+    (b'%PDF-', 'pdf'),
+    (b'PK\x03\x04', 'zip'),
+    (b'PK\x05\x06', 'zip'),
+    (b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1', 'ole'),
+    (b'Rar!\x1a\x07', 'rar'),
+    (b'7z\xbc\xaf\x27\x1c', '7z'),
+    (b'\x1f\x8b', 'gzip'),
+    (b'\x89PNG\r\n\x1a\n', 'image'),
+    (b'\xff\xd8\xff', 'image'),
+    (b'GIF87a', 'image'),
+    (b'GIF89a', 'image'),
+    (b'II*\x00', 'image'),
+    (b'MM\x00*', 'image'),
+    (b'RIFF', 'media'),
+    (b'ID3', 'media'),
+    (b'OggS', 'media'),
+    (b'fLaC', 'media'),
+    (b'\x1a\x45\xdf\xa3', 'media'),
+    (b'MZ', 'executable'),
+    (b'\x7fELF', 'executable'),
+    (b'\xca\xfe\xba\xbe', 'executable'),
+    (b'wOFF', 'font'),
+    (b'wOF2', 'font'),
+]
+# Форматы, из которых текст не извлекается: их данные не декодируются и не разбираются
+SKIPPED_FORMATS = ('image', 'media', 'executable', 'font', 'rar', '7z', 'gzip')
+EMAIL_HEADER_REGEX = re.compile(
+    rb'^(Received|Return-Path|From|To|Subject|Date|Message-ID|MIME-Version|Delivered-To):', re.IGNORECASE | re.MULTILINE
+)
+TEXT_EXTENSIONS = ('.txt', '.text', '.log')
+# Расширения текстовых форматов. Короткие сигнатуры ('MZ', 'ID3', ...) встречаются в начале
+# обычного текста, поэтому для таких файлов решают только сигнатуры контейнеров
+# или управляющие байты, которых не бывает в тексте
+TEXTUAL_EXTENSIONS = TEXT_EXTENSIONS + ('.csv', '.html', '.htm', '.eml')
+STRUCTURAL_FORMATS = ('pdf', 'zip', 'ole')
+BINARY_BYTES_REGEX = re.compile(rb'[\x00-\x08\x0e-\x1a\x1c-\x1f]')
+HTML_START_REGEX = re.compile(rb'^\s*(<!doctype html|<html|<head|<body)', re.IGNORECASE)
+
+# Во сколько раз HTML вложения читается больше лимита символов: разметка не попадает в текст
+HTML_MARKUP_FACTOR = 8
+
+# Ограничения распаковки zip вложений
+MAX_ARCHIVE_MEMBERS = 100
+MAX_ARCHIVE_MEMBER_BYTES = 10 * 1024 * 1024
+MAX_NESTED_ARCHIVES = 2
+
+BOM_ENCODINGS = [
+    (codecs.BOM_UTF8, 'utf-8-sig'),
+    (codecs.BOM_UTF16_LE, 'utf-16'),
+    (codecs.BOM_UTF16_BE, 'utf-16'),
+]
+SINGLE_BYTE_CYRILLIC_ENCODINGS = ['cp1251', 'koi8-r', 'iso-8859-5']
+FREQUENT_CYRILLIC_CHARS = 'оеаинтср'
+
+
+def _payload_bytes(file) -> bytes:
+    """
+    Байты данных вложения без копирования, если memoryview охватывает весь объект bytes
+    """
+    if isinstance(file, memoryview):
+        if isinstance(file.obj, bytes) and file.nbytes == len(file.obj):
+            return file.obj
+        return file.tobytes()
+    return file
+
+
+def _decode_payload(part) -> Optional[bytes]:
+    """
+    Декодирует данные части письма. Base64 декодируется напрямую из строки
+    через binascii: get_payload(decode=True) делает несколько промежуточных
+    копий, что для больших вложений в разы увеличивает пиковую память
+    """
+    raw_payload = part.get_payload()
+    if isinstance(raw_payload, str) and part.get('Content-Transfer-Encoding', '').lower() == 'base64':
+        try:
+            return binascii.a2b_base64(raw_payload)
+        except (ValueError, binascii.Error):
+            pass
+    return part.get_payload(decode=True)
+
+
+def _release_payload(data):
+    """
+    Освобождает memoryview данных вложения после извлечения текста
+    """
+    if isinstance(data, memoryview):
+        try:
+            data.release()
+        except BufferError:
+            # Буфер ещё экспортирован - память освободится вместе с последней ссылкой
+            pass
+
+
+def sniff_format(head: bytes, ext: str = '') -> str:
+    """
+    Определяет формат вложения по первым байтам, а расширение учитывает
+    только для текстовых данных без сигнатуры. У файлов с текстовым расширением
+    короткая сигнатура учитывается, только если данные действительно двоичные.
+
+    Returns:
+        pdf, zip, ole, rar, 7z, gzip, image, media, executable, font,
+        eml, html, csv, text или binary
+    """
+    head = bytes(head[:FORMAT_SNIFF_SIZE])
+    textual = ext in TEXTUAL_EXTENSIONS and not BINARY_BYTES_REGEX.search(head)
+    for signature, kind in MAGIC_SIGNATURES:
+        if head.startswith(signature) and (kind in STRUCTURAL_FORMATS or not textual):
+            return kind
+    if head[4:8] == b'ftyp' and not textual:
+        # Контейнеры ISO BMFF: mp4, mov, heic
+        return 'media'
+
+    if any(head.startswith(bom) for bom, _ in BOM_ENCODINGS):
+        return 'csv' if ext == '.csv' else 'text'
+    if b'\x00' in head:
+        return 'binary'
+    if ext in ('.eml', '.msg'):
+        return 'eml'
+    if ext in ('.html', '.htm'):
+        return 'html'
+    if ext == '.csv':
+        return 'csv'
+    if ext in TEXT_EXTENSIONS:
+        return 'text'
+    # Расширение неизвестно или не соответствует содержимому
+    if EMAIL_HEADER_REGEX.match(head):
+        return 'eml'
+    if HTML_START_REGEX.match(head):
+        return 'html'
+    return 'text'
+
+
+def _peek_payload(part, size: int = 64) -> bytes:
+    """
+    Первые байты данных части письма без декодирования всего вложения
+    """
+    raw_payload = part.get_payload()
+    if not isinstance(raw_payload, str):
+        return b''
+    if part.get('Content-Transfer-Encoding', '').lower() == 'base64':
+        chunk = re.sub(r'\s+', '', raw_payload[:size * 2])
+        chunk = chunk[:len(chunk) // 4 * 4]
+        try:
+            return binascii.a2b_base64(chunk)
+        except (ValueError, binascii.Error):
+            return b''
+    return raw_payload[:size].encode('utf-8', errors='replace')
+
+
+def _zip_document_kind(archive: zipfile.ZipFile) -> str:
+    """
+    Отличает документы Office Open XML от обычного zip архива по составу файлов
+    """
+    names = set(archive.namelist())
+    if 'word/document.xml' in names:
+        return 'docx'
+    if 'xl/workbook.xml' in names:
+        return 'xlsx'
+    return 'zip'
+
+
+def _pdf_page_has_text(page) -> bool:
+    """
+    Быстрая проверка по ресурсам страницы, может ли на ней быть текст:
+    без шрифтов и с одними картинками страница - это скан
+    """
+    resources = page.get('/Resources')
+    if resources is None:
+        return True
+    resources = resources.get_object()
+    if '/Font' in resources:
+        return True
+    xobjects = resources.get('/XObject')
+    if xobjects is None:
+        return False
+    xobjects = xobjects.get_object()
+    # Формы (/Form) могут содержать собственные шрифты
+    return any(xobjects[name].get_object().get('/Subtype') != '/Image' for name in xobjects)
+
 
 class EmailParser:
     """
     Класс парсер писем для извлечения текстового содержимого .eml и .msg файлов
     """
 
-    def __init__(self):
-        self.html_converter = html2text.HTML2Text()
-        # Настройки для html2text парсера
-        self.html_converter.ignore_links = False # Игнорирование ссылок
-        self.html_converter.ignore_images = True # Игнорирование изображений
-        self.html_converter.ignore_tables = True  # Игнорирование таблиц
-        self.html_converter.ignore_emphasis = True  # Игнорирование *курсивf* и **жирного**
-        self.html_converter.body_width = True # Количество пустых строк между абзацами (1)
-        self.html_converter.single_line_break = True  # Запрет на перенос строк
-        self.html_converter.mark_code = False  #  Запрет на обрамление кода в ```
+    def __init__(self, attachment_cache: Optional[AttachmentTextCache] = None,
+                 max_attachment_chars: int = MAX_ATTACHMENT_CHARS, strip_quoted: bool = False,
+                 max_pdf_pages: int = MAX_PDF_PAGES, max_mime_depth: int = MAX_MIME_DEPTH,
+                 max_mime_parts: int = MAX_MIME_PARTS, max_decoded_bytes: int = MAX_DECODED_BYTES,
+                 html_mode: str = 'fast'):
+        # Максимальное число символов, извлекаемых из одного вложения
+        self.max_attachment_chars = max_attachment_chars
+        # Максимальное число страниц PDF, с которых извлекается текст
+        self.max_pdf_pages = max_pdf_pages
+        # Ограничения обхода MIME-структуры
+        self.max_mime_depth = max_mime_depth
+        self.max_mime_parts = max_mime_parts
+        self.max_decoded_bytes = max_decoded_bytes
+        # Всегда отрезать процитированную переписку от тела ответа. По умолчанию выключено:
+        # новая часть ответа отдаётся отдельно (reply_body), а решение об её использовании
+        # принимает ThreadIndex, когда родительское письмо ему известно
+        self.strip_quoted = strip_quoted
+        # Кэш извлечённого текста вложений (по умолчанию общий для процесса)
+        self.attachment_cache = attachment_cache if attachment_cache is not None else default_attachment_cache
+        # Режим преобразования HTML: 'fast' - встроенный потоковый извлекатель текста,
+        # 'html2text' - прежний конвертер в markdown
+        if html_mode not in HTML_MODES:
+            raise ValueError(f"Неподдерживаемый режим HTML: {html_mode}. Допустимы {', '.join(HTML_MODES)}")
+        if html_mode == 'html2text' and not HTML2TEXT_SUPPORT:
+            raise ImportError("html2text library is not installed. Install with: pip install html2text")
+        self.html_mode = html_mode
+        self.html_converter = None
+        if html_mode == 'html2text':
+            self.html_converter = html2text.HTML2Text()
+            # Настройки для html2text парсера
+            self.html_converter.ignore_links = False # Игнорирование ссылок
+            self.html_converter.ignore_images = True # Игнорирование изображений
+            self.html_converter.ignore_tables = True  # Игнорирование таблиц
+            self.html_converter.ignore_emphasis = True  # Игнорирование *курсивf* и **жирного**
+            self.html_converter.body_width = True # Количество пустых строк между абзацами (1)
+            self.html_converter.single_line_break = True  # Запрет на перенос строк
+            self.html_converter.mark_code = False  #  Запрет на обрамление кода в ```
+
+    def html_to_text(self, body_html: str) -> str:
+        """
+        Функция преобразования HTML тела письма в текст выбранным режимом
+        """
+        if self.html_mode == 'html2text':
+            return self.html_converter.handle(body_html)
+        return html_to_text(body_html)
 
     def decode_email_header(self, header: Optional[str]) -> str:
         """
@@ -93,7 +345,7 @@ class EmailParser:
         """Парсит .eml файл и возвращает структурированную информацию"""
         try:
             # Создаем байтовый поток
-            byte_stream = io.BytesIO(file)
+            byte_stream = io.BytesIO(_payload_bytes(file))
             msg = BytesParser(policy=policy.default).parse(byte_stream)
 
             # Извлекаем базовые метаданные
@@ -111,16 +363,17 @@ class EmailParser:
             }
 
             # Извлекаем дополнительные заголовки
-            for header in ['Message-ID', 'References', 'In-Reply-To', 'X-Mailer']:
+            for header in ['Message-ID', 'References', 'In-Reply-To', 'X-Mailer',
+                           'List-Id', 'List-Unsubscribe', 'Precedence', 'Auto-Submitted']:
                 if header in msg:
                     result['headers'][header] = self.decode_email_header(msg[header])
 
-            # Рекурсивно обходим части письма
+            # Обходим части письма
             self._process_email_parts(msg, result)
 
             # Если нет текстового тела, пытаемся извлечь из html
             if not result['body_plain'] and result['body_html']:
-                result['body_plain'] = self.html_converter.handle(result['body_html'])
+                result['body_plain'] = self.html_to_text(result['body_html'])
 
             logger.info(f"Успешно распарсен .eml файл: {result['subject'][:50]}...")
             return result
@@ -286,7 +539,7 @@ class EmailParser:
                 if msg.htmlBody:
                     result['body_html'] = msg.htmlBody
                     if not result['body_plain']:
-                        result['body_plain'] = self.html_converter.handle(msg.htmlBody)
+                        result['body_plain'] = self.html_to_text(msg.htmlBody)
 
                 # Извлекаем вложения
                 for attachment in msg.attachments:
@@ -313,7 +566,7 @@ class EmailParser:
                     # Сохраняем информацию о вложении
                     attachment_info = {
                         'filename': attachment_filename,
-                        'data': attachment_data
+                        'data': memoryview(attachment_data) if isinstance(attachment_data, (bytes, bytearray)) else attachment_data
                     }
                     result['attachments'].append(attachment_info)
 
@@ -335,67 +588,130 @@ class EmailParser:
             logger.error(f"Ошибка во время парсинга .msg файла: {e}")
             raise ValueError(f"Ошибка во время парсинга .msg файла: {e}")
 
-    def _process_email_parts(self, part, result: Dict):
+    def _process_email_parts(self, msg, result: Dict):
         """
-        Рекурсивно обрабатывает части письма (для .eml)
+        Итеративно обходит части письма (для .eml) с ограничениями на глубину
+        вложенности, число частей и суммарный объём декодированных данных.
+        Картинки, аудио и видео не декодируются - от них нужны только метаданные
         """
-        if part.is_multipart():
-            for subpart in part.iter_parts():
-                self._process_email_parts(subpart, result)
-        else:
+        body_plain_parts = []
+        body_html_parts = []
+        decoded_bytes = 0
+        parts_seen = 0
+        stack = [(msg, 0)]
+
+        while stack:
+            part, depth = stack.pop()
+            parts_seen += 1
+            if parts_seen > self.max_mime_parts:
+                logger.warning(f"Письмо {result['filename']}: превышен лимит в {self.max_mime_parts} частей")
+                break
+
+            if part.is_multipart():
+                if depth >= self.max_mime_depth:
+                    logger.warning(f"Письмо {result['filename']}: превышена глубина вложенности {self.max_mime_depth}")
+                    continue
+                # Кладём в стек в обратном порядке, чтобы сохранить порядок частей
+                stack.extend((subpart, depth + 1) for subpart in reversed(list(part.iter_parts())))
+                continue
+
             content_type = part.get_content_type()
             content_disposition = str(part.get("Content-Disposition", ""))
+            is_attachment = "attachment" in content_disposition or part.get_filename()
+            if not is_attachment and content_type not in ('text/plain', 'text/html'):
+                # Встроенные картинки и прочие части тела не используются
+                continue
+
+            # Размер оценивается по закодированным данным, без декодирования
+            raw_payload = part.get_payload()
+            if not isinstance(raw_payload, str):
+                raw_payload = ''
+            estimated_size = len(raw_payload)
+            if part.get('Content-Transfer-Encoding', '').lower() == 'base64':
+                encoded = estimated_size - raw_payload.count('\n') - raw_payload.count('\r')
+                estimated_size = encoded * 3 // 4 - raw_payload.rstrip().count('=')
 
-            # Проверяем, является ли часть вложением
-            if "attachment" in content_disposition or part.get_filename():
+            if is_attachment:
                 filename = part.get_filename()
                 if filename:
                     filename = self.decode_email_header(filename)
-                
                 attachment_info = {
                     'filename': filename or f"attachment_{len(result['attachments'])}",
                     'content_type': content_type,
-                    'data': part.get_payload(decode=True)
+                    'data': None,
+                    'size': estimated_size,
                 }
+                skip = content_type.split('/')[0] in SKIPPED_MAIN_TYPES
+                attachment_ext = os.path.splitext(attachment_info['filename'])[1].lower()
+                if not skip and sniff_format(_peek_payload(part), attachment_ext) in SKIPPED_FORMATS:
+                    # Формат по сигнатуре бесполезен для текста (например, картинка с типом octet-stream)
+                    skip = True
+                if not skip and decoded_bytes + estimated_size > self.max_decoded_bytes:
+                    logger.warning(f"Вложение {attachment_info['filename']} пропущено: превышен лимит декодированных данных")
+                    skip = True
+                if not skip:
+                    # Данные вложения передаются через memoryview и освобождаются после извлечения текста
+                    attachment_info['data'] = memoryview(_decode_payload(part) or b'')
+                    attachment_info['size'] = attachment_info['data'].nbytes
+                    # Закодированная копия больше не нужна - держим только декодированные байты
+                    part.set_payload('')
+                    decoded_bytes += attachment_info['size']
                 result['attachments'].append(attachment_info)
+                continue
+
+            if decoded_bytes + estimated_size > self.max_decoded_bytes:
+                logger.warning(f"Часть {content_type} письма {result['filename']} пропущена: превышен лимит декодированных данных")
+                continue
+
+            # Часть тела письма
+            payload = part.get_payload(decode=True)
+            if not payload:
+                continue
+            decoded_bytes += len(payload)
+            charset = part.get_content_charset() or 'utf-8'
+            try:
+                text = payload.decode(charset, errors='replace')
+            except LookupError as e:
+                logger.warning(f"Ошибка декодирования части кода, связанной с кодировкой символов {charset}: {e}")
+                text = payload.decode('utf-8', errors='replace')
+            if content_type == 'text/plain':
+                body_plain_parts.append(text)
             else:
-                # Часть тела письма
-                payload = part.get_payload(decode=True)
-                charset = part.get_content_charset() or 'utf-8'
+                body_html_parts.append(text)
 
-                try:
-                    if payload:
-                        text = payload.decode(charset, errors='replace')
-                        if content_type == 'text/plain':
-                            result['body_plain'] += text + "\n"
-                        elif content_type == 'text/html':
-                            result['body_html'] += text + "\n"
-                except (UnicodeDecodeError, LookupError) as e:
-                    logger.warning(f"Ошибка декодирования части кода, связанной с кодировкой символов {charset}: {e}")
-                    try:
-                        text = payload.decode('utf-8', errors='replace')
-                        if content_type == 'text/plain':
-                            result['body_plain'] += text + "\n"
-                        elif content_type == 'text/html':
-                            result['body_html'] += text + "\n"
-                    except:
-                        pass
+        result['body_plain'] += "".join(text + "\n" for text in body_plain_parts)
+        result['body_html'] += "".join(text + "\n" for text in body_html_parts)
+
+    def iter_pdf_pages(self, file: bytes, filename: str = "unknown.pdf") -> Iterator[str]:
+        """
+        Лениво отдаёт текст страниц PDF, пропуская страницы без шрифтов
+        (сканы и картинки) и останавливаясь после max_pdf_pages страниц
+        """
+        pdf_reader = PyPDF2.PdfReader(io.BytesIO(_payload_bytes(file)))
+        for index, page in enumerate(pdf_reader.pages):
+            if index >= self.max_pdf_pages:
+                logger.info(f"PDF {filename}: достигнут лимит в {self.max_pdf_pages} страниц")
+                return
+            if not _pdf_page_has_text(page):
+                continue
+            page_text = page.extract_text()
+            if page_text:
+                yield page_text
 
     def extract_text_from_pdf(self, file: bytes, filename: str = "unknown.pdf") -> str:
-        """Извлекает текст из PDF файла"""
+        """Извлекает текст из PDF файла в пределах лимита символов и страниц"""
         if not PDF_SUPPORT:
             return f"PDF содержимое недоступно - установите PyPDF2: {filename}"
         try:
-            text = ""
-            pdf_stream = io.BytesIO(file)
-
-            pdf_reader = PyPDF2.PdfReader(pdf_stream)
-
-            for page in pdf_reader.pages:
-                page_text = page.extract_text()
-                if page_text:
-                    text += page_text + "\n"
-            return text.strip()
+            text_parts = []
+            total_chars = 0
+            for page_text in self.iter_pdf_pages(file, filename):
+                page_text = page_text[:self.max_attachment_chars - total_chars]
+                text_parts.append(page_text)
+                total_chars += len(page_text) + 1
+                if total_chars >= self.max_attachment_chars:
+                    break
+            return "\n".join(text_parts).strip()
         except Exception as e:
             logger.error(f"Ошибка при извлечении текста из PDF {filename}: {e}")
             raise ValueError(f"Ошибка при извлечении текста из PDF {filename}: {e}")
@@ -406,7 +722,7 @@ class EmailParser:
             return f"[DOCX содержимое недоступно - установите python-docx: {filename}]"
 
         try:
-            doc_stream = io.BytesIO(file)
+            doc_stream = io.BytesIO(_payload_bytes(file))
             doc = docx.Document(doc_stream)
             text = "\n".join([paragraph.text for paragraph in doc.paragraphs])
             return text.strip()
@@ -420,7 +736,7 @@ class EmailParser:
             return f"[Excel содержимое недоступно - установите openpyxl: {filename}]"
 
         try:
-            excel_stream = io.BytesIO(file)
+            excel_stream = io.BytesIO(_payload_bytes(file))
             wb = load_workbook(excel_stream, read_only=True, data_only=True)
             text_parts = []
 
@@ -445,77 +761,214 @@ class EmailParser:
             logger.error(f"Ошибка при извлечении текста из Excel {filename}: {e}")
             raise ValueError(f"Ошибка при извлечении текста из Excel {filename}: {e}")
 
+    def detect_charset(self, file: bytes) -> str:
+        """
+        Определяет кодировку текстового вложения по ограниченному префиксу файла
+        """
+        sample = bytes(file[:CHARSET_SAMPLE_SIZE])
+
+        for bom, encoding in BOM_ENCODINGS:
+            if sample.startswith(bom):
+                return encoding
+
+        # Префикс может обрываться посреди многобайтового символа,
+        # поэтому декодируем его без финализации
+        try:
+            codecs.getincrementaldecoder('utf-8')().decode(sample, final=False)
+            return 'utf-8'
+        except UnicodeDecodeError:
+            pass
+
+        # Для однобайтовых кириллических кодировок выбираем ту,
+        # в которой префикс содержит больше частых строчных букв
+        best_encoding, best_score = 'cp1251', -1
+        for encoding in SINGLE_BYTE_CYRILLIC_ENCODINGS:
+            decoded = sample.decode(encoding, errors='replace')
+            score = sum(decoded.count(char) for char in FREQUENT_CYRILLIC_CHARS)
+            if score > best_score:
+                best_encoding, best_score = encoding, score
+        return best_encoding
+
+    def _open_text_stream(self, file: bytes) -> io.TextIOWrapper:
+        """
+        Открывает вложение как поток текста в определённой кодировке
+        """
+        encoding = self.detect_charset(file)
+        return io.TextIOWrapper(io.BytesIO(_payload_bytes(file)), encoding=encoding, errors='replace', newline='')
+
+    def extract_text_from_txt(self, file: bytes, filename: str = "unknown.txt") -> str:
+        """Извлекает текст из текстового файла в пределах лимита символов"""
+        try:
+            with self._open_text_stream(file) as text_stream:
+                return text_stream.read(self.max_attachment_chars).strip()
+        except Exception as e:
+            logger.error(f"Ошибка при извлечении текста из файла {filename}: {e}")
+            raise ValueError(f"Ошибка при извлечении текста из файла {filename}: {e}")
+
+    def extract_text_from_html(self, file: bytes, filename: str = "unknown.html") -> str:
+        """Извлекает текст из HTML файла, читая не больше лимита с запасом на разметку"""
+        try:
+            with self._open_text_stream(file) as text_stream:
+                document = text_stream.read(self.max_attachment_chars * HTML_MARKUP_FACTOR)
+            return html_to_text(document)[:self.max_attachment_chars]
+        except Exception as e:
+            logger.error(f"Ошибка при извлечении текста из HTML файла {filename}: {e}")
+            raise ValueError(f"Ошибка при извлечении текста из HTML файла {filename}: {e}")
+
     def extract_text_from_csv(self, file: bytes, filename: str = "unknown.csv") -> str:
-        """Извлекает текст из CSV файла"""
+        """Извлекает текст из CSV файла в пределах лимита символов"""
         try:
-            import csv
             text_parts = []
-            csv_stream = io.BytesIO(file)
-            
-            # Пытаемся определить кодировку
-            sample = csv_stream.read(1024)
-            csv_stream.seek(0)
-            
-            # Пробуем разные кодировки
-            for encoding in ['utf-8', 'cp1251', 'koi8-r', 'iso-8859-5']:
+            total_chars = 0
+            with self._open_text_stream(file) as text_stream:
+                # Пытаемся определить разделитель по началу файла
+                sample = text_stream.read(CSV_SNIFF_SIZE)
+                text_stream.seek(0)
                 try:
-                    csv_stream.seek(0)
-                    decoded = csv_stream.read().decode(encoding)
-                    csv_text = io.StringIO(decoded)
-                    
-                    # Пытаемся определить разделитель
-                    sniffer = csv.Sniffer()
-                    try:
-                        dialect = sniffer.sniff(decoded[:1024])
-                    except:
-                        dialect = csv.excel
-                    
-                    csv_reader = csv.reader(csv_text, dialect)
-                    for row in csv_reader:
-                        text_parts.append(" | ".join(row))
-                    
-                    break  # Успешно декодировали
-                except:
-                    continue
-            
-            return "\n".join(text_parts).strip()
+                    dialect = csv.Sniffer().sniff(sample)
+                except csv.Error:
+                    dialect = csv.excel
+
+                # Строки читаются потоково, пока не исчерпан лимит символов
+                for row in csv.reader(text_stream, dialect):
+                    line = " | ".join(row)
+                    text_parts.append(line)
+                    total_chars += len(line) + 1
+                    if total_chars >= self.max_attachment_chars:
+                        break
+
+            return "\n".join(text_parts)[:self.max_attachment_chars].strip()
         except Exception as e:
             logger.error(f"Ошибка при извлечении текста из CSV {filename}: {e}")
+            raise ValueError(f"Ошибка при извлечении текста из CSV {filename}: {e}")
 
-    def extract_text_from_attachment(self, file: bytes, filename: str) -> str:
-        """Извлекает текст из вложения по типу файла"""
+    def _cache_settings(self, depth: int = 0, archive_depth: int = 0) -> str:
+        """
+        Настройки парсера, от которых зависит текст вложения: кэш общий для всех парсеров процесса
+        """
+        return (
+            f"{self.max_attachment_chars}:{self.max_pdf_pages}:{self.html_mode}:{self.strip_quoted}:"
+            f"{self.max_mime_depth}:{self.max_mime_parts}:{self.max_decoded_bytes}:"
+            f"{depth}:{archive_depth}"
+        )
+
+    def extract_text_from_attachment(self, file: bytes, filename: str, depth: int = 0, archive_depth: int = 0) -> str:
+        """
+        Извлекает текст из вложения по типу файла, используя кэш по хэшу содержимого.
+        depth и archive_depth - глубина вложенности письма и архива, в которых лежит вложение
+        """
         if not file:
             return f"Пустой файл: {filename}"
 
-        ext = os.path.splitext(filename)[1].lower()
-
         try:
-            if ext == '.pdf':
-                return self.extract_text_from_pdf(file, filename)
-            elif ext == '.docx':
-                return self.extract_text_from_docx(file, filename)
-            elif ext in ['.xlsx', '.xls']:
-                return self.extract_text_from_excel(file, filename)
-            elif ext == '.csv':
-                return self.extract_text_from_csv(file, filename)
-            elif ext in ['.txt', '.text', '.log']:
-                try:
-                    return file.decode('utf-8').strip()
-                except:
-                    return file.decode('cp1251', errors='ignore').strip()
-            elif ext in ['.eml', '.msg']:
-                # Рекурсивно парсим вложенные письма
-                nested_content = self.get_email_content(file, filename)
-                return f"Вложенное письмо: {filename}]\n{nested_content}"
-            else:
-                # Для неподдерживаемых форматов возвращаем информацию о файле
-                file_size = len(file)
-                return f"Бинарный файл: {filename}, размер: {file_size} байт, тип: {ext}"
+            key = self.attachment_cache.make_key(file, filename, self._cache_settings(depth, archive_depth))
+            cached = self.attachment_cache.get(key)
+            if cached is not None:
+                return cached
+            text = self._extract_attachment_text(file, filename, depth, archive_depth)
         except Exception as e:
             logger.error(f"Ошибка при обработке вложения файла {filename}: {e}")
             return "Не удалось извлечь данные из вложения"
 
-    def get_email_content(self, file: bytes, filename: str, include_attachments: bool = True) -> Tuple[str, List[Dict]]:
+        self.attachment_cache.put(key, text)
+        return text
+
+    def _extract_attachment_text(self, file: bytes, filename: str, depth: int = 0, archive_depth: int = 0) -> str:
+        """
+        Выбирает способ извлечения текста по сигнатуре содержимого.
+        Расширение учитывается только там, где сигнатура не различает форматы
+        """
+        ext = os.path.splitext(filename)[1].lower()
+        kind = sniff_format(file[:FORMAT_SNIFF_SIZE], ext)
+
+        if kind == 'zip':
+            with zipfile.ZipFile(io.BytesIO(_payload_bytes(file))) as archive:
+                kind = _zip_document_kind(archive)
+                if kind == 'zip':
+                    return self.extract_text_from_zip(archive, filename, depth, archive_depth)
+
+        if kind == 'pdf':
+            return self.extract_text_from_pdf(file, filename)
+        elif kind == 'docx':
+            return self.extract_text_from_docx(file, filename)
+        elif kind == 'xlsx':
+            return self.extract_text_from_excel(file, filename)
+        elif kind == 'csv':
+            return self.extract_text_from_csv(file, filename)
+        elif kind == 'text':
+            return self.extract_text_from_txt(file, filename)
+        elif kind == 'html':
+            return self.extract_text_from_html(file, filename)
+        elif kind == 'eml' or (kind == 'ole' and ext == '.msg'):
+            if depth >= MAX_NESTED_EMAILS:
+                return f"Вложенное письмо: {filename} (превышена глубина вложенности)"
+            # Рекурсивно парсим вложенные письма с ограничением глубины.
+            # Парсер выбирается по расширению, поэтому имя приводим к фактическому формату
+            nested_name = filename if kind == 'ole' else f"{os.path.splitext(filename)[0]}.eml"
+            nested_content = self.get_email_content(file, nested_name, depth=depth + 1)
+            return f"Вложенное письмо: {filename}]\n{nested_content}"
+        else:
+            # Картинки, архивы без поддержки, старые форматы Office (.doc, .xls) и прочие
+            # бинарные файлы - возвращаем информацию о файле без разбора содержимого
+            file_size = len(file)
+            return f"Бинарный файл: {filename}, размер: {file_size} байт, тип: {ext}"
+
+    def _extract_archive_member(self, archive: zipfile.ZipFile, member: zipfile.ZipInfo, filename: str,
+                                depth: int, archive_depth: int) -> Optional[str]:
+        """
+        Распаковывает файл архива и извлекает из него текст. Файлы, бесполезные по сигнатуре,
+        дальше первых байт не распаковываются. None - если текст извлечь не удалось
+        """
+        member_ext = os.path.splitext(member.filename)[1].lower()
+        with archive.open(member) as member_stream:
+            head = member_stream.read(FORMAT_SNIFF_SIZE)
+            if sniff_format(head, member_ext) in SKIPPED_FORMATS:
+                return f"Бинарный файл: {member.filename}, размер: {member.file_size} байт, тип: {member_ext}"
+            # Заявленный размер не доверяем: читаем не больше лимита
+            data = head + member_stream.read(MAX_ARCHIVE_MEMBER_BYTES + 1 - len(head))
+        if len(data) > MAX_ARCHIVE_MEMBER_BYTES:
+            return f"Файл архива пропущен: {member.filename}, размер больше {MAX_ARCHIVE_MEMBER_BYTES} байт"
+
+        try:
+            member_text = self._extract_attachment_text(data, member.filename, depth, archive_depth + 1)
+        except Exception as e:
+            logger.error(f"Ошибка при обработке файла {member.filename} из архива {filename}: {e}")
+            return None
+        return f"--- Файл архива: {member.filename} ---\n{member_text}"
+
+    def extract_text_from_zip(self, archive: zipfile.ZipFile, filename: str = "unknown.zip",
+                              depth: int = 0, archive_depth: int = 0) -> str:
+        """
+        Потоково распаковывает zip архив и извлекает текст из его файлов
+        в пределах лимита символов вложения. Файлы, бесполезные по сигнатуре,
+        распознаются по первым распакованным байтам и дальше не распаковываются
+        """
+        if archive_depth >= MAX_NESTED_ARCHIVES:
+            return f"Архив: {filename} (превышена глубина вложенности архивов)"
+
+        text_parts = []
+        total_chars = 0
+        for member in archive.infolist()[:MAX_ARCHIVE_MEMBERS]:
+            if member.is_dir():
+                continue
+            if member.flag_bits & 0x1:
+                member_text = f"Зашифрованный файл архива: {member.filename}"
+            elif member.file_size > MAX_ARCHIVE_MEMBER_BYTES:
+                member_text = f"Файл архива пропущен: {member.filename}, размер: {member.file_size} байт"
+            else:
+                member_text = self._extract_archive_member(archive, member, filename, depth, archive_depth)
+                if member_text is None:
+                    continue
+            # Заметки о пропущенных файлах тоже расходуют лимит символов вложения
+            member_text = member_text[:self.max_attachment_chars - total_chars]
+            text_parts.append(member_text)
+            total_chars += len(member_text) + 1
+            if total_chars >= self.max_attachment_chars:
+                break
+        return "\n".join(text_parts).strip()
+
+    def get_email_content(self, file: bytes, filename: str, include_attachments: bool = True,
+                          depth: int = 0) -> Tuple[str, List[Dict]]:
         """
         Главная функция: извлекает полное текстовое содержимое письма
 
@@ -523,6 +976,7 @@ class EmailParser:
             file: Байты  файла
             filename: Имя файла (для определения типа)
             include_attachments: Включать ли текст из вложений
+            depth: Глубина вложенности письма (0 - письмо верхнего уровня)
 
         Returns:
             Tuple[текст письма, список информации о вложениях]
@@ -541,29 +995,51 @@ class EmailParser:
                 raise ValueError(f"Неподдерживаемый формат файла: {ext}. Допустимы типы файлов .eml или .msg")
 
             text_parts = []
+            reply_body = None
             # Добавляем тело письма
             if email_data['body_plain']:
-                text_parts.append(email_data['body_plain'])
+                body = email_data['body_plain']
+                if thread_parents(email_data['headers']):
+                    # Новая часть ответа без процитированной истории
+                    reply = strip_quoted_text(body, email_data['subject'])
+                    if reply != body:
+                        reply_body, _ = self.extract_and_remove_urls(self.clean_text(reply))
+                        if self.strip_quoted:
+                            body = reply
+                text_parts.append(body)
 
             # Обрабатываем вложения
             if include_attachments and email_data['attachments']:
 
-                for i, attachment in enumerate(email_data['attachments']):
-                    if attachment.get('data'):
+                attachments = email_data['attachments']
+                for i in range(len(attachments)):
+                    # Убираем вложение из результата парсинга, чтобы его данные
+                    # жили только до конца извлечения текста
+                    attachment, attachments[i] = attachments[i], None
+                    data = attachment.pop('data', None)
+                    filename = attachment['filename'] or f"attachment_{i}"
+                    if data is None and attachment.get('size'):
+                        # Вложение не декодировалось (картинка или превышен лимит) - только метаданные
+                        attachment_info_list.append({
+                            'filename': filename,
+                            'data': f"Бинарный файл: {filename}, размер: {attachment['size']} байт, тип: {os.path.splitext(filename)[1].lower()}",
+                            'content_type': attachment.get('content_type', ''),
+                            'size': attachment['size'],
+                        })
+                    elif data:
                         # Извлекаем текст из вложения
-                        filename = attachment['filename'] or f"attachment_{i}"
-                        attachment_text = self.extract_text_from_attachment(
-                            attachment['data'], 
-                            filename
-                        )
+                        attachment_text = self.extract_text_from_attachment(data, filename, depth)
                         # Сохраняем информацию о вложении
                         attachment_info = {
                             'filename': filename,
                             'data': attachment_text, 
                             'content_type': attachment.get('content_type', ''),
-                            'size': len(attachment['data'])
+                            'size': len(data)
                         }
                         attachment_info_list.append(attachment_info)
+                    _release_payload(data)
+                    del data, attachment
+                email_data['attachments'] = []
 
             # Объединяем все части в один текст
             full_text = "\n".join(text_parts)
@@ -571,6 +1047,8 @@ class EmailParser:
             # Очищаем от лишних пробелов и пустых строк
             clean_text = self.clean_text(full_text)
             clean_text, urls = self.extract_and_remove_urls(clean_text)
+            if reply_body == clean_text:
+                reply_body = None
             logger.info(f"Из электронного письма извлечено {len(clean_text)} символов")
             return {
                 'subject': f"Тема письма {email_data['subject']}" if email_data['subject'] else 'Без темы',
@@ -578,8 +1056,14 @@ class EmailParser:
                 'to': f"Кому: {email_data['to']}" if email_data['to'] else 'Неизвестный получатель',
                 'date': f"Дата: {email_data['date']}" if email_data['date'] else 'Нет даты',
                 "body": clean_text,
+                # Тело ответа без процитированной истории или None, если письмо не ответ или истории нет
+                "reply_body": reply_body,
                 "attachments": attachment_info_list,  # список словарей или пустой список
-                "urls": urls
+                "urls": urls,
+                # Исходные отправитель, тема и служебные заголовки для правил быстрой классификации
+                "sender": email_data['from'],
+                "raw_subject": email_data['subject'],
+                "headers": email_data['headers'],
             }
         except Exception as e:
             logger.error(f"Ошибка при получении содержимого электронного письма из байтов: {e}")
@@ -0,0 +1,318 @@
+import logging
+from typing import Dict, Iterator, List, Optional
+
+import numpy as np
+
+from backend.linear_head import LinearHead
+
+
+logger = logging.getLogger(__name__)
+
+# Поддерживаемые форматы хранения эмбеддингов
+STORAGE_DTYPES = ('float32', 'float16', 'int8')
+
+# Размер блока строк, который за раз переводится в float32 при скоринге
+SCORE_BLOCK_ROWS = 8192
+
+
+class CompactEmbeddingStore:
+    """
+    Компактное хранилище эмбеддингов категорий.
+
+    Все эмбеддинги всех категорий лежат в одной непрерывной матрице
+    (float16 или int8 с масштабом на строку), а массив смещений
+    отображает диапазоны строк на категории. По интерфейсу хранилище
+    ведёт себя как словарь ``{категория: {'embeddings': ...}}``.
+    """
+
+    def __init__(self, dtype: str = 'float16', max_error: float = 1e-2):
+        if dtype not in STORAGE_DTYPES:
+            raise ValueError(f"Неподдерживаемый тип хранения эмбеддингов: {dtype}. Допустимы {', '.join(STORAGE_DTYPES)}")
+        self.dtype = dtype
+        self.max_error = max_error
+        self._names: List[str] = []
+        self._matrix: Optional[np.ndarray] = None
+        self._scales: Optional[np.ndarray] = None
+        self._offsets = np.zeros(1, dtype=np.int64)
+        # Номер версии набора категорий, растёт при каждом изменении
+        self.version = 0
+        # Откалиброванные пороги и минимальные отрывы от второй категории
+        self.thresholds: Dict[str, float] = {}
+        self.margins: Dict[str, float] = {}
+        # Обученная голова поверх эмбеддингов (необязательный способ оценки)
+        self.head: Optional[LinearHead] = None
+
+    # --- Интерфейс словаря ---
+
+    def __len__(self) -> int:
+        return len(self._names)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(list(self._names))
+
+    def __contains__(self, category) -> bool:
+        return category in self._names
+
+    def __getitem__(self, category: str) -> Dict:
+        return {'embeddings': self.get_embeddings(category)}
+
+    def __delitem__(self, category: str):
+        self.remove(category)
+
+    def keys(self) -> List[str]:
+        return list(self._names)
+
+    def items(self):
+        for category in self._names:
+            yield category, self[category]
+
+    # --- Квантизация ---
+
+    def _quantize(self, embeddings: np.ndarray):
+        """
+        Переводит float32 эмбеддинги в формат хранения, возвращает (матрица, масштабы)
+        """
+        if self.dtype == 'int8':
+            scales = np.abs(embeddings).max(axis=1) / 127.0
+            scales[scales == 0] = 1.0
+            quantized = np.rint(embeddings / scales[:, None]).astype(np.int8)
+            return quantized, scales.astype(np.float32)
+        return embeddings.astype(self.dtype), None
+
+    def _dequantize(self, start: int, stop: int) -> np.ndarray:
+        """
+        Восстанавливает float32 эмбеддинги для диапазона строк
+        """
+        block = self._matrix[start:stop].astype(np.float32)
+        if self._scales is not None:
+            block *= self._scales[start:stop, None]
+        return block
+
+    # --- Изменение набора категорий ---
+
+    def add(self, category: str, embeddings: np.ndarray):
+        """
+        Добавляет (или заменяет) эмбеддинги категории
+        """
+        embeddings = np.atleast_2d(np.asarray(embeddings, dtype=np.float32))
+        if self._matrix is not None and embeddings.shape[1] != self._matrix.shape[1]:
+            raise ValueError(
+                f"Размерность эмбеддингов категории {category} ({embeddings.shape[1]}) "
+                f"не совпадает с хранилищем ({self._matrix.shape[1]})"
+            )
+        if category in self._names:
+            self.remove(category)
+        # Калибровка и голова по старому набору примеров больше не действительны
+        self.thresholds.pop(category, None)
+        self.margins.pop(category, None)
+        self.head = None
+
+        quantized, scales = self._quantize(embeddings)
+
+        # Проверяем, что компактное представление не искажает близости
+        restored = quantized.astype(np.float32)
+        if scales is not None:
+            restored *= scales[:, None]
+        error = float(np.abs(restored - embeddings).max()) if embeddings.size else 0.0
+        if error > self.max_error:
+            logger.warning(
+                f"Ошибка квантизации эмбеддингов категории {category} ({error:.4f}) "
+                f"превышает допустимую ({self.max_error})"
+            )
+
+        if self._matrix is None:
+            self._matrix = quantized
+            self._scales = scales
+        else:
+            self._matrix = np.concatenate([self._matrix, quantized])
+            if scales is not None:
+                self._scales = np.concatenate([self._scales, scales])
+        self._names.append(category)
+        self._offsets = np.append(self._offsets, self._offsets[-1] + len(embeddings))
+        self.version += 1
+
+    def remove(self, category: str):
+        """
+        Удаляет категорию и её строки из матрицы
+        """
+        index = self._names.index(category)
+        start, stop = self._offsets[index], self._offsets[index + 1]
+        self._matrix = np.delete(self._matrix, np.s_[start:stop], axis=0)
+        if self._scales is not None:
+            self._scales = np.delete(self._scales, np.s_[start:stop])
+        del self._names[index]
+        self.thresholds.pop(category, None)
+        self.margins.pop(category, None)
+        self.head = None
+        sizes = np.delete(np.diff(self._offsets), index)
+        self._offsets = np.concatenate([[0], np.cumsum(sizes)]).astype(np.int64)
+        self.version += 1
+        if not self._names:
+            self.clear()
+
+    def clear(self):
+        """
+        Удаляет все категории
+        """
+        self._names = []
+        self._matrix = None
+        self._scales = None
+        self._offsets = np.zeros(1, dtype=np.int64)
+        self.thresholds = {}
+        self.margins = {}
+        self.head = None
+        self.version += 1
+
+    def set_calibration(self, thresholds: Dict[str, float], margins: Dict[str, float]):
+        """
+        Сохраняет откалиброванные пороги и отрывы категорий
+        """
+        self.thresholds = {name: float(value) for name, value in thresholds.items() if name in self._names}
+        self.margins = {name: float(value) for name, value in margins.items() if name in self._names}
+        self.version += 1
+
+    def set_head(self, head: LinearHead):
+        """
+        Сохраняет обученную голову вместе с набором категорий
+        """
+        self.head = head
+        self.version += 1
+
+    @property
+    def head_ready(self) -> bool:
+        """
+        Есть ли обученная голова, которая знает все категории набора
+        """
+        return self.head is not None and set(self._names) <= set(self.head.classes)
+
+    @property
+    def offsets(self) -> np.ndarray:
+        """
+        Смещения строк категорий в матрице (длина - число категорий + 1)
+        """
+        return self._offsets.copy()
+
+    def dequantized(self) -> np.ndarray:
+        """
+        Восстанавливает float32 матрицу всех эмбеддингов
+        """
+        if self._matrix is None:
+            return np.zeros((0, 0), dtype=np.float32)
+        return self._dequantize(0, self._offsets[-1])
+
+    def get_embeddings(self, category: str) -> np.ndarray:
+        """
+        Возвращает восстановленные float32 эмбеддинги категории
+        """
+        index = self._names.index(category)
+        return self._dequantize(self._offsets[index], self._offsets[index + 1])
+
+    # --- Сохранение ---
+
+    def to_arrays(self) -> Dict[str, np.ndarray]:
+        """
+        Представление хранилища в виде массивов для np.savez
+        """
+        arrays = {
+            'store_dtype': np.array(self.dtype),
+            'store_names': np.array(self._names, dtype=str),
+            'store_offsets': self._offsets,
+        }
+        if self._matrix is not None:
+            arrays['store_matrix'] = self._matrix
+        if self._scales is not None:
+            arrays['store_scales'] = self._scales
+        if self.thresholds or self.margins:
+            calibrated = [name for name in self._names if name in self.thresholds or name in self.margins]
+            arrays['calibration_names'] = np.array(calibrated, dtype=str)
+            arrays['calibration_thresholds'] = np.array(
+                [self.thresholds.get(name, np.nan) for name in calibrated], dtype=np.float32
+            )
+            arrays['calibration_margins'] = np.array(
+                [self.margins.get(name, 0.0) for name in calibrated], dtype=np.float32
+            )
+        if self.head is not None:
+            arrays.update(self.head.to_arrays())
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays) -> 'CompactEmbeddingStore':
+        """
+        Восстанавливает хранилище из массивов, сохранённых to_arrays
+        """
+        store = cls(dtype=str(arrays['store_dtype']))
+        store._names = [str(name) for name in arrays['store_names']]
+        store._offsets = np.asarray(arrays['store_offsets'], dtype=np.int64)
+        if 'store_matrix' in arrays:
+            store._matrix = np.asarray(arrays['store_matrix'])
+        if 'store_scales' in arrays:
+            store._scales = np.asarray(arrays['store_scales'])
+        if 'calibration_names' in arrays:
+            for name, threshold, margin in zip(
+                arrays['calibration_names'], arrays['calibration_thresholds'], arrays['calibration_margins']
+            ):
+                if not np.isnan(threshold):
+                    store.thresholds[str(name)] = float(threshold)
+                store.margins[str(name)] = float(margin)
+        if 'head_weights' in arrays:
+            store.head = LinearHead.from_arrays(arrays)
+        return store
+
+    # --- Скоринг ---
+
+    @property
+    def nbytes(self) -> int:
+        """
+        Объём памяти, занимаемый матрицей эмбеддингов
+        """
+        if self._matrix is None:
+            return 0
+        total = self._matrix.nbytes + self._offsets.nbytes
+        if self._scales is not None:
+            total += self._scales.nbytes
+        return total
+
+    def similarities(self, queries: np.ndarray) -> np.ndarray:
+        """
+        Косинусная близость запросов со всеми строками хранилища.
+
+        Матрица переводится в float32 блоками: в numpy нет быстрого
+        матричного умножения для float16/int8, а блочный перевод
+        держит пиковую память в пределах SCORE_BLOCK_ROWS строк.
+
+        Returns:
+            Матрица (число запросов, число строк)
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        n_rows = self._offsets[-1]
+        result = np.empty((queries.shape[0], n_rows), dtype=np.float32)
+        for start in range(0, n_rows, SCORE_BLOCK_ROWS):
+            stop = min(start + SCORE_BLOCK_ROWS, n_rows)
+            block = self._matrix[start:stop].astype(np.float32)
+            sims = queries @ block.T
+            if self._scales is not None:
+                sims *= self._scales[start:stop]
+            result[:, start:stop] = sims
+        return result
+
+    def category_scores(self, queries: np.ndarray) -> np.ndarray:
+        """
+        Средняя близость запросов с эмбеддингами каждой категории
+
+        Returns:
+            Матрица (число запросов, число категорий)
+        """
+        sims = self.similarities(queries)
+        sums = np.add.reduceat(sims, self._offsets[:-1], axis=1)
+        return sums / np.diff(self._offsets)[None, :]
+
+    def parity_error(self, category: str, embeddings: np.ndarray, queries: np.ndarray) -> float:
+        """
+        Максимальное расхождение средней близости категории в компактной
+        форме с близостью по исходным float32 эмбеддингам
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        reference = (queries @ np.asarray(embeddings, dtype=np.float32).T).mean(axis=1)
+        index = self._names.index(category)
+        compact = self.category_scores(queries)[:, index]
+        return float(np.abs(compact - reference).max())
@@ -0,0 +1,76 @@
+import argparse
+import logging
+import time
+from email import policy
+from email.parser import BytesParser
+from typing import Dict, List, Tuple
+
+from backend.bootstrap import DEFAULT_EXAMPLES_PATH
+from backend.email_parser import HTML_MODES, EmailParser
+from backend.loadtest import load_corpus
+
+
+logger = logging.getLogger(__name__)
+
+
+def load_html_bodies(base_path: str = DEFAULT_EXAMPLES_PATH) -> List[Tuple[str, str]]:
+    """
+    Собирает HTML части писем .eml корпуса: (имя файла, HTML)
+    """
+    bodies = []
+    for filename, data in load_corpus(base_path):
+        if not filename.endswith('.eml'):
+            continue
+        msg = BytesParser(policy=policy.default).parsebytes(data)
+        for part in msg.walk():
+            if part.get_content_type() != 'text/html':
+                continue
+            try:
+                bodies.append((filename, part.get_content()))
+            except (LookupError, UnicodeError) as e:
+                logger.warning(f"HTML часть письма {filename} не декодирована: {e}")
+    return bodies
+
+
+def benchmark(bodies: List[Tuple[str, str]], mode: str, repeat: int = 3) -> Dict:
+    """
+    Время преобразования HTML в текст режимом mode: лучший из repeat проходов
+    по всем документам и самые медленные документы этого прохода
+    """
+    parser = EmailParser(html_mode=mode)
+    best_total, best_times = None, None
+    for _ in range(repeat):
+        times = []
+        for filename, body_html in bodies:
+            started = time.perf_counter()
+            parser.html_to_text(body_html)
+            times.append((time.perf_counter() - started, filename))
+        total = sum(elapsed for elapsed, _ in times)
+        if best_total is None or total < best_total:
+            best_total, best_times = total, times
+    return {
+        'mode': mode,
+        'documents': len(bodies),
+        'total_s': best_total,
+        'slowest': sorted(best_times, reverse=True)[:5],
+    }
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Сравнение скорости режимов преобразования HTML писем в текст")
+    arg_parser.add_argument("--corpus", default=DEFAULT_EXAMPLES_PATH, help="Каталог с письмами")
+    arg_parser.add_argument("--repeat", type=int, default=3, help="Число проходов по корпусу, берётся лучший")
+    arg_parser.add_argument("--modes", nargs="+", default=list(HTML_MODES), choices=HTML_MODES)
+    args = arg_parser.parse_args()
+
+    bodies = load_html_bodies(args.corpus)
+    print(f"HTML документов: {len(bodies)}, символов: {sum(len(body) for _, body in bodies)}")
+    for mode in args.modes:
+        report = benchmark(bodies, mode, args.repeat)
+        print(f"{mode}: {report['total_s'] * 1000:.1f} мс на корпус")
+        for elapsed, filename in report['slowest']:
+            print(f"    {elapsed * 1000:.2f} мс  {filename}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+import html
+import re
+
+
+# Токены HTML: комментарии и служебные конструкции, теги, текст.
+# Кавычки открывают значение атрибута только после '=', как в разборе HTML браузером:
+# кавычка внутри имени (width="1 border="0") не должна поглощать остаток документа.
+# Незакрытые тег, комментарий или значение атрибута, как и в браузере, продолжаются
+# до конца документа: ни одна ветка не может не совпасть после просмотра остатка,
+# поэтому разбор линеен и на обрезанных письмах
+HTML_TOKEN_REGEX = re.compile(
+    r'<!--.*?(?:-->|\Z)|<!\[CDATA\[.*?(?:\]\]>|\Z)|<![^>]*(?:>|\Z)|<\?[^>]*(?:>|\Z)'
+    r'|<(/?)([a-zA-Z][a-zA-Z0-9:-]*)((?:[^>"\'=]|=\s*"[^"]*"?|=\s*\'[^\']*\'?|=|["\'])*)(?:>|\Z)'
+    r'|([^<]+|<)',
+    re.DOTALL,
+)
+HREF_REGEX = re.compile(r'\bhref\s*=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\s>]+))', re.IGNORECASE)
+HIDDEN_STYLE_REGEX = re.compile(r'display\s*:\s*none|visibility\s*:\s*hidden|mso-hide\s*:\s*all', re.IGNORECASE)
+HIDDEN_ATTRIBUTE_REGEX = re.compile(r'(?:^|\s)hidden(?:\s|=|/|$)', re.IGNORECASE)
+QUOTED_VALUE_REGEX = re.compile(r'"[^"]*"|\'[^\']*\'')
+WHITESPACE_REGEX = re.compile(r'\s+')
+# Разрыв блока отмечается служебным символом и превращается в перенос строки в конце
+BLOCK_BREAK = '\x01'
+BLOCK_BREAK_REGEX = re.compile(r' ?\x01[\x01 ]*')
+
+# Элементы, содержимое которых не является текстом письма и не разбирается как разметка.
+# Сам <head> не пропускается: в нём нет текста кроме <title>, а закрывающий тег часто отсутствует
+SKIPPED_TAGS = frozenset(['style', 'script', 'title', 'template', 'noscript', 'svg', 'object', 'xml'])
+# Элементы без содержимого и закрывающего тега
+VOID_TAGS = frozenset(['area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'source',
+                       'track', 'wbr'])
+# Элементы, начало и конец которых разрывают строку
+BLOCK_TAGS = frozenset(['address', 'article', 'aside', 'blockquote', 'br', 'center', 'dd', 'div', 'dl', 'dt',
+                        'footer', 'form', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'header', 'hr', 'li', 'main',
+                        'nav', 'ol', 'p', 'pre', 'section', 'table', 'tbody', 'thead', 'tfoot', 'tr', 'ul'])
+CELL_TAGS = frozenset(['td', 'th'])
+SKIPPED_END_REGEX = {tag: re.compile(rf'</{tag}\s*>', re.IGNORECASE) for tag in SKIPPED_TAGS}
+
+
+def _is_hidden(attributes: str) -> bool:
+    """
+    Проверяет, скрыт ли элемент стилем или атрибутом hidden
+    """
+    lowered = attributes.lower()
+    if 'none' in lowered or 'hidden' in lowered or 'mso-hide' in lowered:
+        if HIDDEN_STYLE_REGEX.search(attributes):
+            return True
+        return bool(HIDDEN_ATTRIBUTE_REGEX.search(QUOTED_VALUE_REGEX.sub('', attributes)))
+    return False
+
+
+def _href(attributes: str) -> str:
+    match = HREF_REGEX.search(attributes)
+    if not match:
+        return ''
+    return next(value for value in match.groups() if value is not None).strip()
+
+
+def html_to_text(document: str) -> str:
+    """
+    Быстрое извлечение текста из HTML письма без промежуточной разметки.
+
+    Документ разбирается одним проходом регулярного выражения по токенам:
+    содержимое <style>, <script>, <title> и скрытых элементов отбрасывается,
+    блочные теги дают переносы строк, ячейки таблиц - пробелы, картинки
+    пропускаются, а адреса ссылок добавляются после текста ссылки в скобках,
+    как в выводе html2text, чтобы их находил extract_and_remove_urls.
+    """
+    if not document:
+        return ""
+
+    parts = []
+    skip_tag = None
+    skip_depth = 0
+    link_href = None
+    link_start = 0
+    pos = 0
+    length = len(document)
+    match_token = HTML_TOKEN_REGEX.match
+    while pos < length:
+        token = match_token(document, pos)
+        pos = token.end()
+        closing, tag, attributes, text = token.groups()
+
+        if skip_tag is not None:
+            # Внутри пропускаемого элемента считаем только вложенные одноимённые теги
+            if tag is not None and tag.lower() == skip_tag:
+                if closing:
+                    skip_depth -= 1
+                    if skip_depth == 0:
+                        skip_tag = None
+                elif not attributes.endswith('/'):
+                    skip_depth += 1
+            continue
+
+        if text is not None:
+            parts.append(text)
+            continue
+        if tag is None:
+            # Комментарии, DOCTYPE и условные комментарии Outlook
+            continue
+
+        tag = tag.lower()
+        if closing:
+            if tag in BLOCK_TAGS:
+                parts.append(BLOCK_BREAK)
+            elif tag in CELL_TAGS:
+                parts.append(' ')
+            elif tag == 'a' and link_href is not None:
+                link_text = ''.join(parts[link_start:]).strip(' \t\r\n' + BLOCK_BREAK)
+                if link_text != link_href:
+                    parts.append(f" ({link_href})")
+                link_href = None
+            continue
+
+        if tag in SKIPPED_TAGS:
+            if not attributes.endswith('/'):
+                end = SKIPPED_END_REGEX[tag].search(document, pos)
+                pos = end.end() if end else length
+            continue
+        if tag not in VOID_TAGS and attributes and _is_hidden(attributes):
+            if not attributes.endswith('/'):
+                skip_tag, skip_depth = tag, 1
+            continue
+
+        if tag in BLOCK_TAGS:
+            parts.append(BLOCK_BREAK)
+        elif tag in CELL_TAGS:
+            parts.append(' ')
+        elif tag == 'a':
+            href = _href(attributes)
+            if href.lower().startswith(('http://', 'https://', 'www.')):
+                link_href = html.unescape(href)
+                link_start = len(parts)
+
+    text = html.unescape(''.join(parts))
+    text = WHITESPACE_REGEX.sub(' ', text)
+    text = BLOCK_BREAK_REGEX.sub('\n', text)
+    return text.strip()
@@ -0,0 +1,173 @@
+import logging
+from typing import Dict, List, Optional
+
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+# Класс «неизвестно» обучается явно, наравне с категориями
+UNKNOWN_CLASS = "Не определена"
+
+
+def _softmax(logits: np.ndarray) -> np.ndarray:
+    logits = logits - logits.max(axis=1, keepdims=True)
+    exp = np.exp(logits)
+    return exp / exp.sum(axis=1, keepdims=True)
+
+
+class LinearHead:
+    """
+    Логистическая (softmax) голова поверх замороженных эмбеддингов e5.
+
+    Применяется одним умножением матриц и softmax к уже посчитанным
+    эмбеддингам писем и возвращает откалиброванные вероятности классов,
+    включая явный класс «Не определена».
+    """
+
+    def __init__(self, classes: List[str], weights: np.ndarray, bias: np.ndarray,
+                 mean: np.ndarray, scale: np.ndarray):
+        self.classes = list(classes)
+        self.weights = weights.astype(np.float32)
+        self.bias = bias.astype(np.float32)
+        self.mean = mean.astype(np.float32)
+        self.scale = scale.astype(np.float32)
+
+    @classmethod
+    def train(cls, embeddings: np.ndarray, labels: np.ndarray, classes: List[str],
+              l2: float = 1e-2, epochs: int = 300, learning_rate: float = 0.5) -> 'LinearHead':
+        """
+        Обучает голову полнопакетным градиентным спуском с моментом
+
+        Args:
+            embeddings: эмбеддинги обучающих примеров (n, размерность)
+            labels: индексы классов примеров в classes
+            classes: имена классов
+        """
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        labels = np.asarray(labels)
+        n_samples, dim = embeddings.shape
+        n_classes = len(classes)
+
+        # Стандартизация признаков: эмбеддинги e5 лежат в узком конусе
+        mean = embeddings.mean(axis=0)
+        scale = embeddings.std(axis=0) + 1e-6
+        features = (embeddings - mean) / scale
+
+        targets = np.zeros((n_samples, n_classes), dtype=np.float32)
+        targets[np.arange(n_samples), labels] = 1.0
+        # Балансируем классы с разным числом примеров
+        class_counts = np.maximum(targets.sum(axis=0), 1.0)
+        sample_weights = (n_samples / (n_classes * class_counts))[labels][:, None]
+
+        weights = np.zeros((dim, n_classes), dtype=np.float32)
+        bias = np.zeros(n_classes, dtype=np.float32)
+        velocity_w = np.zeros_like(weights)
+        velocity_b = np.zeros_like(bias)
+        for _ in range(epochs):
+            probs = _softmax(features @ weights + bias)
+            error = (probs - targets) * sample_weights / n_samples
+            grad_w = features.T @ error + l2 * weights
+            grad_b = error.sum(axis=0)
+            velocity_w = 0.9 * velocity_w - learning_rate * grad_w
+            velocity_b = 0.9 * velocity_b - learning_rate * grad_b
+            weights += velocity_w
+            bias += velocity_b
+
+        accuracy = float((_softmax(features @ weights + bias).argmax(axis=1) == labels).mean())
+        logger.info(f"Голова обучена на {n_samples} примерах, точность на обучении {accuracy:.3f}")
+        return cls(classes, weights, bias, mean, scale)
+
+    def predict_proba(self, embeddings: np.ndarray) -> np.ndarray:
+        """
+        Вероятности классов для пачки эмбеддингов (n, число классов)
+        """
+        embeddings = np.atleast_2d(np.asarray(embeddings, dtype=np.float32))
+        return _softmax(((embeddings - self.mean) / self.scale) @ self.weights + self.bias)
+
+    def to_arrays(self) -> Dict[str, np.ndarray]:
+        """
+        Представление головы в виде массивов для np.savez
+        """
+        return {
+            'head_classes': np.array(self.classes, dtype=str),
+            'head_weights': self.weights,
+            'head_bias': self.bias,
+            'head_mean': self.mean,
+            'head_scale': self.scale,
+        }
+
+    @classmethod
+    def from_arrays(cls, arrays) -> 'LinearHead':
+        """
+        Восстанавливает голову из массивов, сохранённых to_arrays
+        """
+        return cls(
+            [str(name) for name in arrays['head_classes']],
+            np.asarray(arrays['head_weights']),
+            np.asarray(arrays['head_bias']),
+            np.asarray(arrays['head_mean']),
+            np.asarray(arrays['head_scale']),
+        )
+
+
+def train_head(classifier, examples: Dict[str, List[str]], unknown_texts: Optional[List[str]] = None,
+               n_synthetic_unknown: Optional[int] = None, seed: int = 0) -> LinearHead:
+    """
+    Обучает голову на эмбеддингах примеров категорий классификатора
+    и сохраняет её в наборе категорий.
+
+    Все классы обучаются на письмах, закодированных encode_emails, - так же,
+    как письма кодируются при предсказании, а не на промптах категорий.
+    Категории без переданных примеров (добавленные пользователем) обучаются
+    на своих сохранённых строках набора: у них нет исходных текстов, но без
+    них голова не могла бы предсказать такую категорию.
+    Примеры класса «Не определена» - переданные unknown_texts (например,
+    письма из папки Other) и синтетические смеси примеров двух разных
+    категорий, лежащие между ними.
+    """
+    store = classifier.categories
+    names = store.keys()
+    if len(names) < 2:
+        raise ValueError("Для обучения головы нужно минимум две категории")
+    encoded = [name for name in names if examples.get(name)]
+    stored = [name for name in names if name not in encoded]
+    if stored:
+        logger.info(f"Категории без примеров писем обучаются на сохранённых строках набора: {', '.join(stored)}")
+
+    texts = [text for name in encoded for text in examples[name]]
+    encoded_matrix = np.asarray(classifier.encode_emails(texts), dtype=np.float32) if texts else None
+    parts, labels, position = [], [], 0
+    for index, name in enumerate(names):
+        if name in encoded:
+            part = encoded_matrix[position:position + len(examples[name])]
+            position += len(examples[name])
+        else:
+            rows = store.get_embeddings(name)
+            # Первая строка - промпт с названием категории, остальные - примеры писем
+            part = rows[1:] if len(rows) > 1 else rows
+        parts.append(part)
+        labels.append(np.full(len(part), index))
+    matrix = np.concatenate(parts)
+    labels = np.concatenate(labels)
+
+    rng = np.random.default_rng(seed)
+    if n_synthetic_unknown is None:
+        n_synthetic_unknown = int(len(matrix) / len(names))
+    first = rng.integers(0, len(matrix), n_synthetic_unknown)
+    second = rng.integers(0, len(matrix), n_synthetic_unknown)
+    different = labels[first] != labels[second]
+    mixtures = matrix[first[different]] + matrix[second[different]]
+    mixtures /= np.linalg.norm(mixtures, axis=1, keepdims=True)
+
+    unknown = [mixtures]
+    if unknown_texts:
+        unknown.append(np.asarray(classifier.encode_emails(unknown_texts), dtype=np.float32))
+    unknown = np.concatenate(unknown)
+
+    classes = names + [UNKNOWN_CLASS]
+    embeddings = np.concatenate([matrix, unknown])
+    all_labels = np.concatenate([labels, np.full(len(unknown), len(names))])
+    head = LinearHead.train(embeddings, all_labels, classes)
+    store.set_head(head)
+    return head
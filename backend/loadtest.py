@@ -0,0 +1,424 @@
+import argparse
+import json
+import logging
+import os
+import queue
+import re
+import threading
+import time
+import urllib.request
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import quote, unquote, urljoin
+
+import numpy as np
+
+from backend.attachment_cache import AttachmentTextCache
+from backend.bootstrap import DEFAULT_EXAMPLES_PATH, load_default_categories
+from backend.email_parser import EmailParser, prepare_for_classification
+from backend.injection_guard import detect_injection
+
+
+logger = logging.getLogger(__name__)
+
+TOKEN_REGEX = re.compile(r'\w+')
+
+
+class StubEncoder:
+    """
+    Детерминированная замена SentenceTransformer для нагрузочных прогонов.
+
+    Эмбеддинг - хэшированный мешок слов, поэтому одинаковые тексты дают
+    одинаковые векторы, а похожие - близкие. Задержка delay_per_text
+    имитирует время работы модели (sleep отпускает GIL, как и вызов на GPU).
+    """
+
+    def __init__(self, dim: int = 1024, delay_per_text: float = 0.0):
+        self.dim = dim
+        self.delay_per_text = delay_per_text
+        self.device = 'cpu'
+
+    def encode(self, texts, batch_size: int = 32, normalize_embeddings: bool = True,
+               convert_to_numpy: bool = True, show_progress_bar: bool = False) -> np.ndarray:
+        if isinstance(texts, str):
+            texts = [texts]
+        embeddings = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for token in TOKEN_REGEX.findall(text.lower()):
+                bucket = zlib.crc32(token.encode('utf-8'))
+                embeddings[row, bucket % self.dim] += 1.0 if bucket & 0x80000000 else -1.0
+        # Общая компонента, как у настоящих эмбеддингов e5
+        embeddings[:, 0] += 1.0
+        if normalize_embeddings:
+            embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+        if self.delay_per_text:
+            time.sleep(self.delay_per_text * len(texts))
+        return embeddings
+
+
+def load_corpus(base_path: str = DEFAULT_EXAMPLES_PATH) -> List[Tuple[str, bytes]]:
+    """
+    Читает все письма корпуса в память: (имя файла, байты)
+    """
+    corpus = []
+    for root, _, files in os.walk(base_path):
+        for filename in sorted(files):
+            if filename.endswith(('.eml', '.msg')):
+                with open(os.path.join(root, filename), 'rb') as f:
+                    corpus.append((filename, f.read()))
+    if not corpus:
+        raise ValueError(f"В каталоге {base_path} нет писем .eml или .msg")
+    return corpus
+
+
+class ClassificationPipeline:
+    """
+    Полный путь письма: парсинг, подготовка текста, защита от инъекций, классификация
+    """
+
+    def __init__(self, classifier, cold_cache: bool = True):
+        self.classifier = classifier
+        # Повторные прогоны корпуса не должны обслуживаться из кэша вложений
+        self.attachment_cache = AttachmentTextCache(max_chars=0) if cold_cache else None
+
+    def __call__(self, filename: str, data: bytes) -> Dict:
+        # Конвейер вызывается из нескольких потоков, поэтому парсер создаётся на каждое письмо:
+        # общим остаётся только потокобезопасный кэш вложений
+        parser = EmailParser(attachment_cache=self.attachment_cache)
+        parsed = parser.get_email_content(data, filename)
+        text = detect_injection(prepare_for_classification(parsed))
+        return self.classifier.predict(text)
+
+
+class HttpTarget:
+    """
+    Отправляет письма на HTTP сервис классификации (например, запущенный serve)
+    """
+
+    def __init__(self, url: str, timeout: float = 60.0):
+        self.url = url
+        self.timeout = timeout
+
+    def __call__(self, filename: str, data: bytes) -> Dict:
+        request = urllib.request.Request(
+            self.url,
+            data=data,
+            method='POST',
+            headers={'Content-Type': 'application/octet-stream', 'X-Filename': quote(filename)},
+        )
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            return json.loads(response.read().decode('utf-8'))
+
+    def rss_mb(self) -> Optional[float]:
+        """
+        Память процесса сервиса, если он отдаёт /stats (как локальный serve)
+        """
+        try:
+            with urllib.request.urlopen(urljoin(self.url, '/stats'), timeout=self.timeout) as response:
+                return json.loads(response.read().decode('utf-8'))['rss_mb']
+        except Exception:
+            return None
+
+
+def current_rss_mb() -> float:
+    """
+    Текущий размер резидентной памяти процесса в МБ (пиковый, если /proc недоступен)
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except (OSError, ValueError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return 0.0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class LoadGenerator:
+    """
+    Генератор нагрузки, воспроизводящий корпус писем против цели.
+
+    Без rate работает замкнутый цикл: concurrency исполнителей берут
+    письма одно за другим. С rate письма поступают пуассоновским потоком
+    с заданной средней частотой в очередь, которую разбирают concurrency
+    исполнителей; задержка считается от поступления письма, поэтому
+    включает ожидание в очереди.
+    """
+
+    def __init__(self, target, corpus: List[Tuple[str, bytes]], concurrency: int = 4,
+                 rate: Optional[float] = None, duration: float = 30.0, max_requests: Optional[int] = None,
+                 sample_interval: float = 1.0, seed: int = 0):
+        if concurrency < 1:
+            raise ValueError("Число исполнителей должно быть не меньше 1")
+        if rate is not None and rate <= 0:
+            raise ValueError("Частота поступления писем должна быть положительной")
+        self.target = target
+        self.corpus = corpus
+        self.concurrency = concurrency
+        self.rate = rate
+        self.duration = duration
+        self.max_requests = max_requests
+        self.sample_interval = sample_interval
+        self._rng = np.random.default_rng(seed)
+        self._queue: queue.Queue = queue.Queue(maxsize=0 if rate is not None else concurrency)
+        self._lock = threading.Lock()
+        self._latencies: List[float] = []
+        self._errors = 0
+        self._submitted = 0
+        self._stop = threading.Event()
+        self.timeline: List[Dict] = []
+
+    def _next_email(self) -> Tuple[str, bytes]:
+        return self.corpus[self._submitted % len(self.corpus)]
+
+    def _producer(self, deadline: float):
+        """
+        Подаёт письма в очередь: по расписанию прибытий или по мере освобождения исполнителей
+        """
+        next_arrival = time.perf_counter()
+        while not self._stop.is_set() and time.perf_counter() < deadline:
+            if self.max_requests is not None and self._submitted >= self.max_requests:
+                break
+            if self.rate is not None:
+                next_arrival += self._rng.exponential(1.0 / self.rate)
+                delay = next_arrival - time.perf_counter()
+                if delay > 0:
+                    self._stop.wait(delay)
+                arrived = time.perf_counter()
+                self._queue.put((arrived, self._next_email()))
+            else:
+                # Замкнутый цикл: put блокируется, пока все исполнители заняты
+                try:
+                    self._queue.put((None, self._next_email()), timeout=0.1)
+                except queue.Full:
+                    continue
+            self._submitted += 1
+        for _ in range(self.concurrency):
+            self._queue.put(None)
+
+    def _worker(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            arrived, (filename, data) = item
+            started = time.perf_counter()
+            try:
+                result = self.target(filename, data)
+                failed = bool(result.get('error'))
+            except Exception as e:
+                logger.error(f"Ошибка при обработке письма {filename}: {e}")
+                failed = True
+            latency = time.perf_counter() - (arrived if arrived is not None else started)
+            with self._lock:
+                self._latencies.append(latency)
+                self._errors += failed
+
+    def _monitor(self, started: float):
+        """
+        Периодически записывает пропускную способность, глубину очереди и память
+        """
+        previous_completed, previous_time = 0, started
+        while not self._stop.wait(self.sample_interval):
+            now = time.perf_counter()
+            with self._lock:
+                completed = len(self._latencies)
+            sample = {
+                'elapsed': round(now - started, 3),
+                'completed': completed,
+                'throughput': (completed - previous_completed) / (now - previous_time),
+                'queue_depth': self._queue.qsize(),
+                'rss_mb': round(current_rss_mb(), 1),
+            }
+            # Для HTTP цели память конвейера - это память процесса сервиса
+            if hasattr(self.target, 'rss_mb'):
+                target_rss = self.target.rss_mb()
+                sample['target_rss_mb'] = round(target_rss, 1) if target_rss is not None else None
+            self.timeline.append(sample)
+            previous_completed, previous_time = completed, now
+
+    def run(self) -> Dict:
+        """
+        Запускает прогон и возвращает отчёт
+        """
+        started = time.perf_counter()
+        workers = [threading.Thread(target=self._worker, daemon=True) for _ in range(self.concurrency)]
+        for worker in workers:
+            worker.start()
+        monitor = threading.Thread(target=self._monitor, args=(started,), daemon=True)
+        monitor.start()
+
+        self._producer(started + self.duration)
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - started
+        self._stop.set()
+        monitor.join()
+        return self.report(elapsed)
+
+    def report(self, elapsed: float) -> Dict:
+        latencies = np.array(self._latencies) * 1000
+        percentiles = np.percentile(latencies, [50, 90, 95, 99]) if len(latencies) else [0.0] * 4
+        return {
+            'requests': len(latencies),
+            'errors': self._errors,
+            'elapsed_s': round(elapsed, 3),
+            'throughput_rps': len(latencies) / elapsed if elapsed else 0.0,
+            'concurrency': self.concurrency,
+            'arrival_rate': self.rate,
+            'latency_ms': {
+                'mean': float(latencies.mean()) if len(latencies) else 0.0,
+                'p50': float(percentiles[0]),
+                'p90': float(percentiles[1]),
+                'p95': float(percentiles[2]),
+                'p99': float(percentiles[3]),
+                'max': float(latencies.max()) if len(latencies) else 0.0,
+            },
+            'max_queue_depth': max((sample['queue_depth'] for sample in self.timeline), default=0),
+            'peak_rss_mb': max((sample['rss_mb'] for sample in self.timeline), default=round(current_rss_mb(), 1)),
+            'timeline': self.timeline,
+        }
+
+
+def format_report(report: Dict) -> str:
+    latency = report['latency_ms']
+    lines = [
+        f"Писем: {report['requests']}, ошибок: {report['errors']}, время: {report['elapsed_s']:.1f} с",
+        f"Пропускная способность: {report['throughput_rps']:.2f} писем/с "
+        f"(исполнителей: {report['concurrency']}, частота поступления: {report['arrival_rate'] or 'замкнутый цикл'})",
+        f"Задержка, мс: среднее {latency['mean']:.1f}, p50 {latency['p50']:.1f}, p90 {latency['p90']:.1f}, "
+        f"p95 {latency['p95']:.1f}, p99 {latency['p99']:.1f}, макс {latency['max']:.1f}",
+        f"Максимальная глубина очереди: {report['max_queue_depth']}, пиковая память: {report['peak_rss_mb']:.1f} МБ",
+        "",
+        f"{'время, с':>9} {'писем':>7} {'писем/с':>8} {'очередь':>8} {'RSS, МБ':>8}",
+    ]
+    for sample in report['timeline']:
+        line = (
+            f"{sample['elapsed']:>9.1f} {sample['completed']:>7} {sample['throughput']:>8.2f} "
+            f"{sample['queue_depth']:>8} {sample['rss_mb']:>8.1f}"
+        )
+        if sample.get('target_rss_mb') is not None:
+            line += f"  сервис: {sample['target_rss_mb']:.1f} МБ"
+        lines.append(line)
+    return "\n".join(lines)
+
+
+class _ClassifyHandler(BaseHTTPRequestHandler):
+    """
+    Обработчик POST запросов с байтами письма: имя файла передаётся в заголовке X-Filename
+    """
+    pipeline: ClassificationPipeline = None
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        data = self.rfile.read(length)
+        filename = unquote(self.headers.get('X-Filename', 'unknown.eml'))
+        try:
+            result = self.pipeline(filename, data)
+            status = 200
+        except Exception as e:
+            result = {'error': str(e)}
+            status = 500
+        body = json.dumps(result, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path != '/stats':
+            self.send_error(404)
+            return
+        body = json.dumps({'rss_mb': current_rss_mb()}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+def make_server(pipeline: ClassificationPipeline, host: str = '127.0.0.1', port: int = 8000) -> ThreadingHTTPServer:
+    """
+    Локальный HTTP сервис классификации, заменяющий боевой при нагрузочных прогонах
+    """
+    handler = type('ClassifyHandler', (_ClassifyHandler,), {'pipeline': pipeline})
+    return ThreadingHTTPServer((host, port), handler)
+
+
+def build_classifier(stub: bool, category_set: Optional[str], corpus_path: str, stub_delay: float = 0.0):
+    """
+    Классификатор для прогона: с заглушкой энкодера или с настоящей моделью
+    """
+    from backend.classifier import MailClassifier
+
+    model = StubEncoder(delay_per_text=stub_delay) if stub else None
+    classifier = MailClassifier(model=model)
+    if category_set:
+        classifier.load_category_set(category_set)
+    else:
+        load_default_categories(classifier, corpus_path, use_processes=False)
+    return classifier
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Нагрузочное тестирование классификации писем")
+    arg_parser.add_argument("--corpus", default=DEFAULT_EXAMPLES_PATH, help="Каталог с письмами для воспроизведения")
+    arg_parser.add_argument("--stub", action="store_true", help="Детерминированная заглушка вместо модели")
+    arg_parser.add_argument("--stub-delay", type=float, default=0.0, help="Имитация времени модели на письмо, с")
+    arg_parser.add_argument("--category-set", help="Файл набора категорий (.npz), иначе категории из --corpus")
+    arg_parser.add_argument("--warm-cache", action="store_true", help="Не сбрасывать кэш текста вложений")
+    subparsers = arg_parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="Запустить нагрузку")
+    run_parser.add_argument("--target", help="URL сервиса классификации; по умолчанию конвейер в процессе")
+    run_parser.add_argument("--concurrency", type=int, default=4)
+    run_parser.add_argument("--rate", type=float, help="Средняя частота поступления писем, писем/с")
+    run_parser.add_argument("--duration", type=float, default=30.0, help="Длительность подачи писем, с")
+    run_parser.add_argument("--requests", type=int, help="Максимальное число писем")
+    run_parser.add_argument("--sample-interval", type=float, default=1.0)
+    run_parser.add_argument("--json", help="Сохранить отчёт в JSON файл")
+
+    serve_parser = subparsers.add_parser("serve", help="Запустить локальный HTTP сервис классификации")
+    serve_parser.add_argument("--host", default="127.0.0.1")
+    serve_parser.add_argument("--port", type=int, default=8000)
+    args = arg_parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    if args.command == "serve" or not args.target:
+        classifier = build_classifier(args.stub, args.category_set, args.corpus, args.stub_delay)
+        pipeline = ClassificationPipeline(classifier, cold_cache=not args.warm_cache)
+
+    if args.command == "serve":
+        server = make_server(pipeline, args.host, args.port)
+        print(f"Сервис классификации: http://{args.host}:{args.port}/")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            server.shutdown()
+        return
+
+    generator = LoadGenerator(
+        HttpTarget(args.target) if args.target else pipeline,
+        load_corpus(args.corpus),
+        concurrency=args.concurrency,
+        rate=args.rate,
+        duration=args.duration,
+        max_requests=args.requests,
+        sample_interval=args.sample_interval,
+    )
+    report = generator.run()
+    print(format_report(report))
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
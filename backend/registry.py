@@ -0,0 +1,203 @@
+import hashlib
+import logging
+import os
+import re
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from backend.classifier import MailClassifier, load_encoder
+
+
+logger = logging.getLogger(__name__)
+
+
+def _legacy_name(name: str) -> str:
+    """
+    Имя файла набора в старом формате: разные имена могли давать один файл
+    """
+    return re.sub(r'[^\w\-]+', '_', name)
+
+
+def _safe_name(name: str) -> str:
+    """
+    Имя набора категорий, пригодное для имени файла. Короткий хэш исходного
+    имени различает наборы вроде «Team A» и «Team_A»
+    """
+    return f"{_legacy_name(name)}-{hashlib.sha1(name.encode('utf-8')).hexdigest()[:10]}"
+
+
+class ClassifierRegistry:
+    """
+    Реестр наборов категорий (тенантов), использующих одну общую модель.
+
+    Каждый тенант - это MailClassifier со своим порогом и своей матрицей
+    эмбеддингов, но без собственной копии энкодера. Загруженные наборы
+    хранятся в LRU-порядке; при превышении бюджета памяти наиболее давно
+    использованные наборы сохраняются на диск (если задан storage_dir)
+    и выгружаются из памяти.
+    """
+
+    def __init__(self, storage_dir: Optional[str] = None, memory_budget_mb: float = 256,
+                 threshold: float = 0.7, embedding_dtype: str = 'float16', model=None):
+        self.model = model if model is not None else load_encoder()
+        self.storage_dir = storage_dir
+        self.memory_budget = int(memory_budget_mb * 1024 * 1024)
+        self.threshold = threshold
+        self.embedding_dtype = embedding_dtype
+        self._tenants: "OrderedDict[str, MailClassifier]" = OrderedDict()
+        # Исходные имена наборов по именам их файлов на диске
+        self._file_names: Dict[str, str] = {}
+        self._lock = threading.RLock()
+        if storage_dir:
+            os.makedirs(storage_dir, exist_ok=True)
+
+    def _path(self, name: str) -> Optional[str]:
+        """
+        Путь к файлу набора категорий на диске
+        """
+        if not self.storage_dir:
+            return None
+        return os.path.join(self.storage_dir, f"{_safe_name(name)}.npz")
+
+    def _legacy_path(self, name: str) -> Optional[str]:
+        """
+        Путь к файлу набора в старом формате, если он есть и принадлежит этому набору
+        """
+        if not self.storage_dir:
+            return None
+        stem = _legacy_name(name)
+        path = os.path.join(self.storage_dir, f"{stem}.npz")
+        if os.path.exists(path) and self._file_name(stem) == name:
+            return path
+        return None
+
+    def get(self, name: str) -> MailClassifier:
+        """
+        Возвращает классификатор тенанта, загружая его с диска или создавая пустой
+        """
+        if not name:
+            raise ValueError("Не было передано имя набора категорий")
+        with self._lock:
+            if name in self._tenants:
+                self._tenants.move_to_end(name)
+                return self._tenants[name]
+
+            classifier = MailClassifier(
+                threshold=self.threshold,
+                embedding_dtype=self.embedding_dtype,
+                model=self.model,
+            )
+            path = self._path(name)
+            if path and not os.path.exists(path):
+                path = self._legacy_path(name)
+            if path and os.path.exists(path):
+                classifier.load_category_set(path)
+                logger.info(f"Набор категорий {name} загружен с диска")
+            self._tenants[name] = classifier
+            self._enforce_budget(keep=name)
+            return classifier
+
+    def save(self, name: str):
+        """
+        Сохраняет набор категорий тенанта на диск
+        """
+        with self._lock:
+            path = self._path(name)
+            if path and name in self._tenants:
+                legacy_path = self._legacy_path(name)
+                self._tenants[name].save_category_set(path, name=name)
+                self._file_names[_safe_name(name)] = name
+                # Набор переезжает в файл нового формата
+                if legacy_path:
+                    os.unlink(legacy_path)
+                    self._file_names.pop(_legacy_name(name), None)
+
+    def evict(self, name: str):
+        """
+        Выгружает набор категорий из памяти, предварительно сохранив его
+        """
+        with self._lock:
+            if name not in self._tenants:
+                return
+            if self.storage_dir:
+                self.save(name)
+            else:
+                logger.warning(f"Набор категорий {name} выгружен без сохранения: не задан storage_dir")
+            del self._tenants[name]
+
+    def remove(self, name: str):
+        """
+        Полностью удаляет набор категорий из памяти и с диска
+        """
+        with self._lock:
+            self._tenants.pop(name, None)
+            for path in (self._path(name), self._legacy_path(name)):
+                if path and os.path.exists(path):
+                    os.unlink(path)
+            self._file_names.pop(_safe_name(name), None)
+            self._file_names.pop(_legacy_name(name), None)
+
+    def _file_name(self, stem: str) -> str:
+        """
+        Исходное имя набора, сохранённого в файл stem.npz (для старых файлов - имя файла)
+        """
+        if stem not in self._file_names:
+            name = stem
+            try:
+                with np.load(os.path.join(self.storage_dir, f"{stem}.npz")) as arrays:
+                    if 'set_name' in arrays.files:
+                        name = str(arrays['set_name'])
+            except Exception as e:
+                logger.error(f"Ошибка при чтении набора категорий {stem}: {e}")
+            self._file_names[stem] = name
+        return self._file_names[stem]
+
+    def names(self) -> List[str]:
+        """
+        Имена всех наборов категорий: загруженных и сохранённых на диске
+        """
+        with self._lock:
+            names = list(self._tenants)
+            if self.storage_dir:
+                loaded = {_safe_name(name) for name in names}
+                for filename in sorted(os.listdir(self.storage_dir)):
+                    stem, ext = os.path.splitext(filename)
+                    if ext != '.npz' or stem in loaded:
+                        continue
+                    name = self._file_name(stem)
+                    # Выгруженный набор может лежать и в файле старого формата
+                    if name not in names:
+                        names.append(name)
+        return names
+
+    def memory_usage(self) -> Dict[str, int]:
+        """
+        Объём памяти матриц эмбеддингов загруженных наборов, в байтах
+        """
+        with self._lock:
+            return {name: clf.categories.nbytes for name, clf in self._tenants.items()}
+
+    def _enforce_budget(self, keep: Optional[str] = None):
+        """
+        Выгружает наиболее давно использованные наборы, пока не уложимся в бюджет
+        """
+        usage = sum(self.memory_usage().values())
+        for name in list(self._tenants):
+            if usage <= self.memory_budget:
+                break
+            if name == keep:
+                continue
+            usage -= self._tenants[name].categories.nbytes
+            logger.info(f"Набор категорий {name} выгружен из памяти по LRU")
+            self.evict(name)
+
+    def touch(self, name: str):
+        """
+        Отмечает изменение набора категорий: сохраняет его и пересчитывает бюджет
+        """
+        with self._lock:
+            self.save(name)
+            self._enforce_budget(keep=name)
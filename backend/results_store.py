@@ -0,0 +1,262 @@
+import csv
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import weakref
+from typing import Any, Dict, Iterator, List, Optional, TextIO
+
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+# Поля результата классификации в порядке колонок экспорта
+RESULT_FIELDS = [
+    'file_name',
+    'file_size',
+    'predicted_category',
+    'best_similarity',
+    'all_scores',
+    'data_for_classifier',
+    'timestamp',
+    'error',
+]
+
+# Поля, которые хранятся в базе в виде JSON
+JSON_FIELDS = {'all_scores'}
+
+# Эмбеддинги писем хранятся в половинной точности
+EMBEDDING_DTYPE = np.float16
+
+
+def _remove_database(conn: sqlite3.Connection, path: str):
+    """
+    Закрывает соединение и удаляет файл временной базы
+    """
+    conn.close()
+    for suffix in ('', '-journal', '-wal', '-shm'):
+        try:
+            os.unlink(path + suffix)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f"Не удалось удалить временную базу результатов {path + suffix}: {e}")
+
+
+class ResultsStore:
+    """
+    Хранилище результатов классификации во встроенной базе SQLite.
+
+    Результаты не держатся в памяти: интерфейс отдаёт страницы и потоково
+    выгружает экспорт, поэтому стоимость отрисовки зависит от размера
+    страницы, а не от числа обработанных писем.
+    """
+
+    def __init__(self, path: str = ':memory:', temporary: bool = False):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        # Временная база удаляется при закрытии хранилища или когда оно больше не используется
+        # (например, по окончании сессии интерфейса), а также при завершении процесса
+        self._finalizer = weakref.finalize(self, _remove_database, self._conn, path) if temporary else None
+        self._conn.row_factory = sqlite3.Row
+        columns = ', '.join(RESULT_FIELDS)
+        with self._conn:
+            self._conn.execute(
+                f"CREATE TABLE IF NOT EXISTS results (id INTEGER PRIMARY KEY AUTOINCREMENT, {columns}, embedding BLOB)"
+            )
+            # Базы, созданные до появления эмбеддингов, дополняем колонкой
+            existing = {row['name'] for row in self._conn.execute("PRAGMA table_info(results)")}
+            if 'embedding' not in existing:
+                self._conn.execute("ALTER TABLE results ADD COLUMN embedding BLOB")
+        # Эмбеддинги писем в памяти для переоценки (загружаются при первом обращении)
+        self._embedding_ids: Optional[List[int]] = None
+        self._embedding_rows: List[np.ndarray] = []
+        self._embedding_matrix: Optional[np.ndarray] = None
+
+    @classmethod
+    def temporary(cls, prefix: str = 'maillens_results_') -> 'ResultsStore':
+        """
+        Создаёт хранилище во временном файле, который удаляется вместе с хранилищем
+        """
+        fd, path = tempfile.mkstemp(prefix=prefix, suffix='.sqlite')
+        os.close(fd)
+        return cls(path, temporary=True)
+
+    def _row_to_result(self, row: sqlite3.Row) -> Dict[str, Any]:
+        result = {'id': row['id']}
+        for field in RESULT_FIELDS:
+            value = row[field]
+            if field in JSON_FIELDS and value is not None:
+                value = json.loads(value)
+            result[field] = value
+        return result
+
+    def add(self, result: Dict[str, Any], embedding: Optional[np.ndarray] = None) -> int:
+        """
+        Сохраняет результат классификации и эмбеддинг письма, возвращает идентификатор
+        """
+        values = []
+        for field in RESULT_FIELDS:
+            value = result.get(field)
+            if field in JSON_FIELDS and value is not None:
+                value = json.dumps(value, ensure_ascii=False)
+            values.append(value)
+        if embedding is not None:
+            embedding = np.asarray(embedding, dtype=EMBEDDING_DTYPE).ravel()
+            values.append(embedding.tobytes())
+        else:
+            values.append(None)
+        placeholders = ', '.join('?' for _ in range(len(RESULT_FIELDS) + 1))
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                f"INSERT INTO results ({', '.join(RESULT_FIELDS)}, embedding) VALUES ({placeholders})",
+                values,
+            )
+            if embedding is not None and self._embedding_ids is not None:
+                self._embedding_ids.append(cursor.lastrowid)
+                self._embedding_rows.append(embedding)
+        return cursor.lastrowid
+
+    def embeddings(self):
+        """
+        Возвращает идентификаторы результатов и матрицу эмбеддингов писем
+
+        Returns:
+            Tuple[список идентификаторов, матрица (число писем, размерность)]
+        """
+        with self._lock:
+            if self._embedding_ids is None:
+                self._embedding_ids = []
+                self._embedding_rows = []
+                cursor = self._conn.execute(
+                    "SELECT id, embedding FROM results WHERE embedding IS NOT NULL ORDER BY id"
+                )
+                for row in cursor:
+                    self._embedding_ids.append(row['id'])
+                    self._embedding_rows.append(np.frombuffer(row['embedding'], dtype=EMBEDDING_DTYPE))
+            # Новые строки добавляются к матрице, а не пересобирают её целиком
+            if self._embedding_rows:
+                new_rows = np.stack(self._embedding_rows)
+                if self._embedding_matrix is None:
+                    self._embedding_matrix = new_rows
+                else:
+                    self._embedding_matrix = np.concatenate([self._embedding_matrix, new_rows])
+                self._embedding_rows = []
+            return list(self._embedding_ids), self._embedding_matrix
+
+    def embedding(self, result_id: int) -> Optional[np.ndarray]:
+        """
+        Эмбеддинг письма по идентификатору результата или None, если он не сохранялся
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT embedding FROM results WHERE id = ?", (result_id,)).fetchone()
+        if row is None or row['embedding'] is None:
+            return None
+        return np.frombuffer(row['embedding'], dtype=EMBEDDING_DTYPE).astype(np.float32)
+
+    def rescore(self, classifier) -> int:
+        """
+        Переоценивает все сохранённые письма по их эмбеддингам одним умножением матриц.
+        Используется при смене порога или набора категорий, без повторного парсинга и энкодера
+
+        Returns:
+            Число переоценённых писем
+        """
+        if not classifier.categories:
+            return 0
+        ids, matrix = self.embeddings()
+        if not ids:
+            return 0
+
+        predictions = classifier.predict_embeddings(matrix.astype(np.float32))
+        updates = [
+            (
+                prediction['predicted_category'],
+                prediction['best_similarity'],
+                json.dumps(prediction['all_scores'], ensure_ascii=False),
+                result_id,
+            )
+            for result_id, prediction in zip(ids, predictions)
+        ]
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "UPDATE results SET predicted_category = ?, best_similarity = ?, all_scores = ? WHERE id = ?",
+                updates,
+            )
+        logger.info(f"Переоценено писем: {len(updates)}")
+        return len(updates)
+
+    def count(self) -> int:
+        """
+        Число сохранённых результатов
+        """
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+    def page(self, page: int, page_size: int = 50) -> List[Dict[str, Any]]:
+        """
+        Возвращает страницу результатов (нумерация страниц с 0)
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT * FROM results ORDER BY id LIMIT ? OFFSET ?",
+                (page_size, page * page_size),
+            ).fetchall()
+        return [self._row_to_result(row) for row in rows]
+
+    def iter_results(self, batch_size: int = 500) -> Iterator[Dict[str, Any]]:
+        """
+        Потоково перебирает все результаты пачками по batch_size
+        """
+        last_id = 0
+        while True:
+            with self._lock:
+                rows = self._conn.execute(
+                    "SELECT * FROM results WHERE id > ? ORDER BY id LIMIT ?",
+                    (last_id, batch_size),
+                ).fetchall()
+            if not rows:
+                break
+            for row in rows:
+                yield self._row_to_result(row)
+            last_id = rows[-1]['id']
+
+    def export_csv(self, stream: TextIO):
+        """
+        Потоково записывает все результаты в CSV
+        """
+        writer = csv.writer(stream)
+        writer.writerow(RESULT_FIELDS)
+        for result in self.iter_results():
+            writer.writerow([
+                json.dumps(result[field], ensure_ascii=False) if field in JSON_FIELDS else result[field]
+                for field in RESULT_FIELDS
+            ])
+
+    def export_jsonl(self, stream: TextIO):
+        """
+        Потоково записывает все результаты в JSONL
+        """
+        for result in self.iter_results():
+            result.pop('id')
+            stream.write(json.dumps(result, ensure_ascii=False) + "\n")
+
+    def clear(self):
+        """
+        Удаляет все результаты
+        """
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM results")
+            self._embedding_ids = []
+            self._embedding_rows = []
+            self._embedding_matrix = None
+
+    def close(self):
+        if self._finalizer is not None:
+            self._finalizer()
+        else:
+            self._conn.close()
@@ -0,0 +1,222 @@
+import json
+import logging
+import re
+import threading
+from collections import Counter, defaultdict
+from email.utils import parseaddr
+from typing import Dict, List, Optional
+
+
+logger = logging.getLogger(__name__)
+
+# Ссылки на группы и именованные группы меняют смысл в объединённом выражении
+GROUP_REFERENCE_REGEX = re.compile(r'\\[1-9]|\(\?P[<=]')
+
+
+def normalize_list_id(value: str) -> str:
+    """
+    Идентификатор рассылки из заголовка List-Id вида "Описание <list.example.com>"
+    """
+    match = re.search(r'<([^>]+)>', value)
+    return (match.group(1) if match else value).strip().lower()
+
+
+def _compiles(pattern: str) -> bool:
+    try:
+        re.compile(pattern, re.IGNORECASE)
+    except re.error:
+        return False
+    return True
+
+
+class SenderRule:
+    """
+    Правило быстрой классификации по отправителю и заголовкам письма.
+
+    Все заданные условия правила должны выполняться одновременно.
+    """
+
+    def __init__(self, name: str, category: str, sender_domains: List[str] = None,
+                 list_ids: List[str] = None, subject_pattern: str = None,
+                 headers: Dict[str, str] = None, confidence: float = 0.95):
+        if not name or not category:
+            raise ValueError("У правила должны быть заданы имя и категория")
+        if not (sender_domains or list_ids or subject_pattern or headers):
+            raise ValueError(f"У правила {name} не задано ни одного условия")
+        self.name = name
+        self.category = category
+        self.sender_domains = [domain.lower().lstrip('@') for domain in sender_domains or []]
+        self.list_ids = [normalize_list_id(list_id) for list_id in list_ids or []]
+        self.subject_pattern = subject_pattern
+        try:
+            self.subject_regex = re.compile(subject_pattern, re.IGNORECASE) if subject_pattern else None
+            self.headers = {header: re.compile(pattern, re.IGNORECASE) for header, pattern in (headers or {}).items()}
+        except re.error as e:
+            raise ValueError(f"Некорректное регулярное выражение в правиле {name}: {e}")
+        self.confidence = confidence
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> 'SenderRule':
+        return cls(**data)
+
+    def matches(self, domains: List[str], list_id: str, subject: str, headers: Dict[str, str]) -> bool:
+        """
+        Проверяет все условия правила
+        """
+        if self.sender_domains and not any(domain in self.sender_domains for domain in domains):
+            return False
+        if self.list_ids and list_id not in self.list_ids:
+            return False
+        if self.subject_regex and not self.subject_regex.search(subject):
+            return False
+        for header, regex in self.headers.items():
+            if not regex.search(headers.get(header, '')):
+                return False
+        return True
+
+
+def sender_domains(sender: str) -> List[str]:
+    """
+    Домен отправителя и все его родительские домены: a.b.example.com, b.example.com, example.com
+    """
+    address = parseaddr(sender)[1].lower()
+    if '@' not in address:
+        return []
+    parts = address.rsplit('@', 1)[1].split('.')
+    return ['.'.join(parts[i:]) for i in range(len(parts) - 1)]
+
+
+class SenderRuleIndex:
+    """
+    Скомпилированный индекс правил, применяемый до MailClassifier.predict.
+
+    Домены отправителей и List-Id ищутся в словарях, а темы сначала
+    отсеиваются одним объединённым регулярным выражением, поэтому письма
+    без совпадений проверяются почти независимо от числа правил. Письма, совпавшие с правилом,
+    не проходят через энкодер.
+    """
+
+    def __init__(self, rules: List[SenderRule] = None, min_confidence: float = 0.9):
+        self.min_confidence = min_confidence
+        self.rules: List[SenderRule] = list(rules or [])
+        self.hits: Counter = Counter()
+        self.checked = 0
+        self._lock = threading.Lock()
+        self._compile()
+
+    @classmethod
+    def from_file(cls, path: str, min_confidence: float = 0.9) -> 'SenderRuleIndex':
+        """
+        Загружает правила из JSON файла со списком правил
+        """
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        rules = []
+        for rule_data in data:
+            # Ошибка в одном правиле не должна отключать остальные
+            try:
+                rules.append(SenderRule.from_dict(rule_data))
+            except (ValueError, TypeError) as e:
+                logger.error(f"Правило пропущено: {e}")
+        logger.info(f"Загружено правил быстрой классификации: {len(rules)}")
+        return cls(rules, min_confidence=min_confidence)
+
+    def add_rule(self, rule: SenderRule):
+        self.rules.append(rule)
+        self._compile()
+
+    def _compile(self):
+        """
+        Строит словари доменов и List-Id и объединённое выражение-фильтр тем
+        """
+        self._by_domain = defaultdict(list)
+        self._by_list_id = defaultdict(list)
+        self._by_header = []
+        # Правила тем, которые проверяются только если тема прошла общий фильтр,
+        # и правила, которые в общий фильтр не встраиваются и проверяются всегда
+        self._by_subject = []
+        self._subject_always = []
+        subject_patterns = []
+        for index, rule in enumerate(self.rules):
+            for domain in rule.sender_domains:
+                self._by_domain[domain].append(index)
+            for list_id in rule.list_ids:
+                self._by_list_id[list_id].append(index)
+            if rule.subject_regex and not (rule.sender_domains or rule.list_ids):
+                pattern = f"(?:{rule.subject_pattern})"
+                if GROUP_REFERENCE_REGEX.search(rule.subject_pattern) or not _compiles(pattern):
+                    # Ссылки на группы и глобальные флаги вида (?i) ломают объединённое выражение
+                    self._subject_always.append(index)
+                else:
+                    self._by_subject.append(index)
+                    subject_patterns.append(pattern)
+            elif rule.headers and not (rule.sender_domains or rule.list_ids or rule.subject_regex):
+                self._by_header.append(index)
+        self._subject_regex = None
+        if subject_patterns:
+            try:
+                self._subject_regex = re.compile('|'.join(subject_patterns), re.IGNORECASE)
+            except re.error as e:
+                logger.warning(f"Объединённое выражение тем не собрано, темы проверяются по каждому правилу: {e}")
+                self._subject_always.extend(self._by_subject)
+                self._by_subject = []
+
+    def _candidates(self, domains: List[str], list_id: str, subject: str) -> set:
+        candidates = set(self._by_header)
+        candidates.update(self._subject_always)
+        for domain in domains:
+            candidates.update(self._by_domain.get(domain, ()))
+        if list_id:
+            candidates.update(self._by_list_id.get(list_id, ()))
+        if self._subject_regex is not None and self._subject_regex.search(subject):
+            # Объединённое выражение только отсеивает темы, которым не подходит ни одно правило:
+            # какое именно правило совпало, решают собственные выражения правил в match
+            candidates.update(self._by_subject)
+        return candidates
+
+    def match(self, parsed: Dict) -> Optional[Dict]:
+        """
+        Ищет правило для распарсенного письма (результат get_email_content)
+
+        Returns:
+            Результат в формате MailClassifier.predict с ключом 'rule' или None
+        """
+        headers = parsed.get('headers', {})
+        domains = sender_domains(parsed.get('sender', ''))
+        list_id = normalize_list_id(headers.get('List-Id', ''))
+        subject = parsed.get('raw_subject', '')
+
+        best = None
+        for index in self._candidates(domains, list_id, subject):
+            rule = self.rules[index]
+            if rule.confidence < self.min_confidence:
+                continue
+            if rule.matches(domains, list_id, subject, headers):
+                if best is None or rule.confidence > best.confidence:
+                    best = rule
+
+        with self._lock:
+            self.checked += 1
+            if best is not None:
+                self.hits[best.name] += 1
+        if best is None:
+            return None
+        return {
+            "predicted_category": best.category,
+            "best_similarity": float(best.confidence),
+            "all_scores": [{"category": best.category, "similarity": float(best.confidence)}],
+            "rule": best.name,
+        }
+
+    def stats(self) -> Dict:
+        """
+        Счётчики срабатываний правил
+        """
+        with self._lock:
+            total_hits = sum(self.hits.values())
+            return {
+                'checked': self.checked,
+                'hits': total_hits,
+                'hit_rate': total_hits / self.checked if self.checked else 0.0,
+                'per_rule': dict(self.hits),
+            }
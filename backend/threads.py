@@ -0,0 +1,162 @@
+import logging
+import re
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+# Строки, с которых начинается процитированная история переписки
+QUOTE_HEADER_PATTERNS = [
+    r'^-{2,}\s*(Original Message|Исходное сообщение)\s*-{2,}',
+    r'^On .{0,200}wrote:\s*$',
+    r'^.{0,200}(пишет|написал|написала|написал\(а\))\s*:\s*$',
+    r'^(From|От|От кого)\s*:.*$\n^(Sent|Date|Отправлено|Дата)\s*:',
+]
+QUOTE_HEADER_REGEX = re.compile('|'.join(f'(?:{pattern})' for pattern in QUOTE_HEADER_PATTERNS),
+                                re.IGNORECASE | re.MULTILINE)
+QUOTED_LINE_REGEX = re.compile(r'^[ \t]*>.*$\n?', re.MULTILINE)
+
+# Пересылаемые письма: их содержимое - не процитированная история, а суть письма
+FORWARD_SUBJECT_REGEX = re.compile(r'^\s*(?:(?:re|aw|ответ)\s*:\s*)*(?:fw|fwd|tr|wg|пересл)\s*:', re.IGNORECASE)
+FORWARD_MARKER_REGEX = re.compile(
+    r'^-{2,}\s*(?:Forwarded message|Пересылаемое сообщение|Перенаправленное сообщение)\s*-{2,}'
+    r'|^Begin forwarded message:|^Начало переадресованного сообщения:',
+    re.IGNORECASE | re.MULTILINE,
+)
+
+
+def is_forward(text: str, subject: str = '') -> bool:
+    """
+    Проверяет, пересылка ли это: по префиксу темы или по разделителю пересылаемого сообщения
+    """
+    return bool(FORWARD_SUBJECT_REGEX.match(subject or '') or FORWARD_MARKER_REGEX.search(text or ''))
+
+
+def strip_quoted_text(text: str, subject: str = '') -> str:
+    """
+    Оставляет только новую часть ответа: отрезает историю переписки после
+    заголовка цитаты («On ... wrote:», «-----Original Message-----»,
+    «... пишет:», блок From/Sent) и удаляет строки, начинающиеся с «>».
+    Пересылки не изменяются: блок From/Sent в них - это и есть содержимое.
+    Если после очистки ничего не осталось, возвращает исходный текст.
+    """
+    if not text or is_forward(text, subject):
+        return text
+
+    stripped = text.replace('\r\n', '\n')
+    match = QUOTE_HEADER_REGEX.search(stripped)
+    if match:
+        stripped = stripped[:match.start()]
+    stripped = QUOTED_LINE_REGEX.sub('', stripped).strip()
+    return stripped or text
+
+
+def _message_id(value: str) -> str:
+    return value.strip().strip('<>').strip().lower()
+
+
+def thread_parents(headers: Dict[str, str]) -> List[str]:
+    """
+    Идентификаторы родительских писем от ближайшего к самому первому
+    """
+    parents = []
+    if headers.get('In-Reply-To'):
+        parents.extend(re.findall(r'<[^>]+>', headers['In-Reply-To']) or [headers['In-Reply-To']])
+    if headers.get('References'):
+        parents.extend(reversed(re.findall(r'<[^>]+>', headers['References'])))
+    return [_message_id(parent) for parent in parents if parent.strip()]
+
+
+class ThreadIndex:
+    """
+    Индекс цепочек писем по заголовкам Message-ID / In-Reply-To / References.
+
+    Хранит эмбеддинг и результат классификации каждого письма, чтобы ответы
+    кодировали только новую часть текста и наследовали или смешивали
+    эмбеддинг и категорию родительского письма.
+    """
+
+    def __init__(self, max_entries: int = 100_000, blend_weight: float = 0.3, mode: str = 'blend'):
+        if mode not in ('blend', 'inherit', 'none'):
+            raise ValueError(f"Неподдерживаемый режим цепочек: {mode}. Допустимы blend, inherit, none")
+        self.max_entries = max_entries
+        # Вес эмбеддинга родительского письма при смешивании
+        self.blend_weight = blend_weight
+        self.mode = mode
+        self._entries: "OrderedDict[str, Dict]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def lookup(self, headers: Dict[str, str]) -> Optional[Dict]:
+        """
+        Ищет ближайшее известное родительское письмо
+        """
+        with self._lock:
+            for parent in thread_parents(headers):
+                if parent in self._entries:
+                    self._entries.move_to_end(parent)
+                    return self._entries[parent]
+        return None
+
+    def remember(self, headers: Dict[str, str], embedding: Optional[np.ndarray], prediction: Dict):
+        """
+        Запоминает эмбеддинг и результат письма по его Message-ID
+        """
+        message_id = _message_id(headers.get('Message-ID', ''))
+        if not message_id:
+            return
+        with self._lock:
+            self._entries[message_id] = {'embedding': embedding, 'prediction': prediction}
+            self._entries.move_to_end(message_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def reply_view(self, parsed: Dict) -> Dict:
+        """
+        Для ответа на письмо, уже известное индексу, возвращает копию разбора с телом
+        без процитированной истории (поле reply_body из get_email_content).
+        Остальные письма, включая пересылки и ответы на неизвестные письма, не меняются:
+        история в них - единственный источник контекста
+        """
+        if self.mode == 'none' or not parsed.get('reply_body'):
+            return parsed
+        if self.lookup(parsed.get('headers', {})) is None:
+            return parsed
+        return dict(parsed, body=parsed['reply_body'])
+
+    def blend(self, embedding: np.ndarray, parent: Optional[Dict]) -> np.ndarray:
+        """
+        Смешивает эмбеддинг новой части письма с эмбеддингом родителя
+        """
+        if parent is None or parent['embedding'] is None or self.mode != 'blend':
+            return embedding
+        blended = (1 - self.blend_weight) * embedding + self.blend_weight * parent['embedding']
+        return blended / np.linalg.norm(blended)
+
+    def classify(self, classifier, parsed: Dict, text: str) -> Tuple[Dict, Optional[np.ndarray]]:
+        """
+        Классифицирует письмо с учётом его цепочки. Текст ответа на известное
+        письмо стоит готовить из reply_view(parsed)
+
+        Returns:
+            Tuple[результат классификации, эмбеддинг письма или None при наследовании]
+        """
+        headers = parsed.get('headers', {})
+        parent = self.lookup(headers) if self.mode != 'none' else None
+
+        if parent is not None and self.mode == 'inherit':
+            # Ответ наследует категорию цепочки без обращения к энкодеру
+            prediction = dict(parent['prediction'], inherited=True)
+            self.remember(headers, parent['embedding'], prediction)
+            return prediction, parent['embedding']
+
+        embedding = self.blend(classifier.encode_emails([text])[0], parent)
+        prediction = classifier.predict_embeddings(embedding[None, :])[0]
+        self.remember(headers, embedding, prediction)
+        return prediction, embedding
@@ -0,0 +1,439 @@
+import argparse
+import hashlib
+import json
+import logging
+import os
+import queue
+import sqlite3
+import tempfile
+import threading
+import time
+from datetime import datetime
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from backend.email_index import EmailIndex
+from backend.email_parser import EmailParser, prepare_for_classification
+from backend.injection_guard import detect_injection
+from backend.results_store import ResultsStore
+from backend.sender_rules import SenderRuleIndex
+from backend.threads import ThreadIndex
+
+
+# Служебные проверки установленных библиотек для отслеживания каталога
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+    WATCHDOG_SUPPORT = True
+except ImportError:
+    WATCHDOG_SUPPORT = False
+    FileSystemEventHandler = object
+    logging.warning("watchdog not installed. Folder watcher will fall back to polling.")
+
+logger = logging.getLogger(__name__)
+
+EMAIL_EXTENSIONS = ('.eml', '.msg')
+
+
+def file_sha256(path: str, chunk_size: int = 1024 * 1024) -> str:
+    """
+    Хэш содержимого файла, читаемого блоками
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class FileManifest:
+    """
+    Манифест обработанных файлов: путь, размер, время изменения и хэш содержимого.
+
+    Хранится в SQLite и переживает перезапуски, поэтому уже обработанные
+    письма не классифицируются повторно. Отметки пачки фиксируются одной
+    транзакцией в save(), так что стоимость сохранения не растёт с размером манифеста.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        if os.path.exists(path) and not self._is_sqlite(path):
+            self._migrate_json(path)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, mtime REAL, sha256 TEXT)"
+            )
+
+    @staticmethod
+    def _is_sqlite(path: str) -> bool:
+        with open(path, 'rb') as f:
+            return f.read(16) == b'SQLite format 3\x00'
+
+    @staticmethod
+    def _migrate_json(path: str):
+        """
+        Переводит манифест прежнего формата (JSON) в SQLite по тому же пути
+        """
+        with open(path, 'r', encoding='utf-8') as f:
+            entries = json.load(f)
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        os.close(fd)
+        conn = sqlite3.connect(tmp_path)
+        with conn:
+            conn.execute("CREATE TABLE files (path TEXT PRIMARY KEY, size INTEGER, mtime REAL, sha256 TEXT)")
+            conn.executemany(
+                "INSERT INTO files VALUES (?, ?, ?, ?)",
+                [(file_path, entry['size'], entry['mtime'], entry['sha256']) for file_path, entry in entries.items()],
+            )
+        conn.close()
+        os.replace(tmp_path, path)
+        logger.info(f"Манифест {path} переведён из JSON в SQLite ({len(entries)} файлов)")
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+
+    def needs_processing(self, path: str) -> Optional[Dict]:
+        """
+        Проверяет, новый ли файл или изменённый.
+
+        Returns:
+            Метаданные файла, если его нужно обработать, иначе None
+        """
+        stat = os.stat(path)
+        with self._lock:
+            entry = self._conn.execute("SELECT size, mtime, sha256 FROM files WHERE path = ?", (path,)).fetchone()
+        if entry and entry[0] == stat.st_size and entry[1] == stat.st_mtime:
+            return None
+
+        # Размер или время изменились - сверяем хэш, чтобы не переобрабатывать копии
+        sha256 = file_sha256(path)
+        metadata = {'size': stat.st_size, 'mtime': stat.st_mtime, 'sha256': sha256}
+        if entry and entry[2] == sha256:
+            self.mark_processed(path, metadata)
+            return None
+        return metadata
+
+    def mark_processed(self, path: str, metadata: Dict):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO files (path, size, mtime, sha256) VALUES (?, ?, ?, ?)",
+                (path, metadata['size'], metadata['mtime'], metadata['sha256']),
+            )
+
+    def save(self):
+        """
+        Фиксирует на диске все отметки, сделанные с прошлого сохранения
+        """
+        with self._lock:
+            self._conn.commit()
+
+    def close(self):
+        self.save()
+        with self._lock:
+            self._conn.close()
+
+
+class _EmailEventHandler(FileSystemEventHandler):
+    """
+    Передаёт пути созданных и изменённых писем в очередь наблюдателя
+    """
+
+    def __init__(self, events: queue.Queue):
+        self.events = events
+
+    def on_created(self, event):
+        if not event.is_directory:
+            self.events.put(event.src_path)
+
+    def on_modified(self, event):
+        if not event.is_directory:
+            self.events.put(event.src_path)
+
+    def on_moved(self, event):
+        if not event.is_directory:
+            self.events.put(event.dest_path)
+
+
+class FolderWatcher:
+    """
+    Наблюдатель каталога, классифицирующий только новые или изменённые письма.
+
+    Изменения отслеживаются через inotify (watchdog), а при его отсутствии -
+    периодическим сканированием каталога. Письма обрабатываются
+    микро-пачками за один проход энкодера.
+    """
+
+    def __init__(self, folder: str, classifier, results: ResultsStore, manifest: FileManifest,
+                 batch_size: int = 16, poll_interval: float = 2.0, settle_seconds: float = 1.0,
+                 use_watchdog: bool = True, sender_rules: Optional[SenderRuleIndex] = None,
+                 threads: Optional[ThreadIndex] = None, index: Optional[EmailIndex] = None,
+                 tenant: str = 'default'):
+        self.folder = folder
+        self.classifier = classifier
+        self.results = results
+        self.manifest = manifest
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        # Файлы моложе settle_seconds могут быть ещё не дописаны
+        self.settle_seconds = settle_seconds
+        self.use_watchdog = use_watchdog and WATCHDOG_SUPPORT
+        self.parser = EmailParser()
+        # Правила отправителей применяются до энкодера
+        self.sender_rules = sender_rules
+        # Индекс цепочек: ответы смешиваются с эмбеддингом родительского письма
+        self.threads = threads if threads is not None else ThreadIndex()
+        # Постоянный индекс эмбеддингов для поиска похожих писем
+        self.index = index
+        # Набор категорий, под которым письма попадают в индекс: поиск в приложении фильтрует по нему
+        self.tenant = tenant
+        self._events: queue.Queue = queue.Queue()
+        self._pending: set = set()
+        self._stop = threading.Event()
+
+    def scan(self) -> List[str]:
+        """
+        Находит в каталоге все письма
+        """
+        paths = []
+        for root, _, files in os.walk(self.folder):
+            for filename in files:
+                if filename.lower().endswith(EMAIL_EXTENSIONS):
+                    paths.append(os.path.join(root, filename))
+        return sorted(paths)
+
+    def _collect_ready(self) -> List[tuple]:
+        """
+        Отбирает из ожидающих путей готовые к обработке новые или изменённые файлы
+        """
+        ready = []
+        now = time.time()
+        for path in sorted(self._pending):
+            try:
+                if now - os.stat(path).st_mtime < self.settle_seconds:
+                    continue
+                metadata = self.manifest.needs_processing(path)
+            except FileNotFoundError:
+                self._pending.discard(path)
+                continue
+            self._pending.discard(path)
+            if metadata is not None:
+                ready.append((path, metadata))
+            if len(ready) >= self.batch_size:
+                break
+        return ready
+
+    def process_batch(self, batch: List[tuple]) -> int:
+        """
+        Парсит и классифицирует пачку писем, сохраняет результаты и манифест
+        """
+        texts, entries = [], []
+        for path, metadata in batch:
+            filename = os.path.relpath(path, self.folder)
+            try:
+                with open(path, 'rb') as f:
+                    parsed = self.threads.reply_view(self.parser.get_email_content(f.read(), path))
+                text = detect_injection(prepare_for_classification(parsed))
+                prediction = self.sender_rules.match(parsed) if self.sender_rules is not None else None
+                if prediction is not None:
+                    self._add_result(filename, metadata, text, prediction)
+                    self.manifest.mark_processed(path, metadata)
+                    continue
+                texts.append(text)
+                entries.append((path, filename, metadata, text, parsed))
+            except Exception as e:
+                logger.error(f"Ошибка при обработке письма {path}: {e}")
+                self._add_error(path, filename, metadata, e)
+
+        # Эмбеддинги сохраняются вместе с результатами для последующей переоценки
+        embeddings, entries = self._encode(texts, entries)
+        embeddings = [
+            self.threads.blend(embedding, self.threads.lookup(entry[4].get('headers', {})))
+            for embedding, entry in zip(embeddings, entries)
+        ]
+        predictions = self.classifier.predict_embeddings(np.array(embeddings)) if embeddings else []
+        for (path, filename, metadata, text, parsed), prediction, embedding in zip(entries, predictions, embeddings):
+            self._add_result(filename, metadata, text, prediction, embedding)
+            self.threads.remember(parsed.get('headers', {}), embedding, prediction)
+            self.manifest.mark_processed(path, metadata)
+        if self.index is not None and embeddings:
+            timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            self.index.add_batch(np.array(embeddings), [
+                {
+                    'file_name': filename,
+                    'file_size': metadata['size'],
+                    'sha256': metadata['sha256'],
+                    'subject': parsed.get('raw_subject'),
+                    'sender': parsed.get('sender'),
+                    'predicted_category': prediction.get('predicted_category'),
+                    'best_similarity': prediction.get('best_similarity'),
+                    'tenant': self.tenant,
+                    'timestamp': timestamp,
+                }
+                for (path, filename, metadata, text, parsed), prediction in zip(entries, predictions)
+            ])
+
+        self.manifest.save()
+        logger.info(f"Классифицировано писем в пачке: {len(batch)}")
+        return len(batch)
+
+    def _encode(self, texts: List[str], entries: List[tuple]):
+        """
+        Кодирует тексты пачки. Если пачка не кодируется целиком, письма кодируются
+        по одному, и ошибку получают только те, на которых падает энкодер
+
+        Returns:
+            Tuple[эмбеддинги, записи закодированных писем]
+        """
+        if not texts:
+            return [], []
+        try:
+            return list(self.classifier.encode_emails(texts)), entries
+        except Exception as e:
+            logger.error(f"Ошибка энкодера на пачке из {len(texts)} писем, кодируем по одному: {e}")
+
+        embeddings, encoded = [], []
+        for text, entry in zip(texts, entries):
+            try:
+                embeddings.append(self.classifier.encode_emails([text])[0])
+                encoded.append(entry)
+            except Exception as e:
+                logger.error(f"Ошибка энкодера на письме {entry[0]}: {e}")
+                self._add_error(entry[0], entry[1], entry[2], e)
+        return embeddings, encoded
+
+    def _add_error(self, path: str, filename: str, metadata: Dict, error: Exception):
+        self.results.add({
+            'file_name': filename,
+            'file_size': metadata['size'],
+            'timestamp': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            'error': str(error),
+        })
+        self.manifest.mark_processed(path, metadata)
+
+    def _add_result(self, filename: str, metadata: Dict, text: str, prediction: Dict, embedding=None):
+        self.results.add({
+            'file_name': filename,
+            'file_size': metadata['size'],
+            'predicted_category': prediction.get('predicted_category'),
+            'best_similarity': prediction.get('best_similarity'),
+            'all_scores': prediction.get('all_scores'),
+            'data_for_classifier': text,
+            'timestamp': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            'error': prediction.get('error'),
+        }, embedding=embedding)
+
+    def process_pending(self) -> int:
+        """
+        Обрабатывает все готовые ожидающие файлы микро-пачками
+        """
+        processed = 0
+        while True:
+            batch = self._collect_ready()
+            if not batch:
+                return processed
+            processed += self.process_batch(batch)
+
+    def run_once(self) -> int:
+        """
+        Однократно сканирует каталог и обрабатывает новые или изменённые письма
+        """
+        self._pending.update(self.scan())
+        return self.process_pending()
+
+    def run(self):
+        """
+        Обрабатывает накопившиеся письма и далее следит за каталогом до вызова stop()
+        """
+        self.run_once()
+
+        observer = None
+        if self.use_watchdog:
+            observer = Observer()
+            observer.schedule(_EmailEventHandler(self._events), self.folder, recursive=True)
+            observer.start()
+            logger.info(f"Наблюдение за каталогом {self.folder} через inotify")
+        else:
+            logger.info(f"Наблюдение за каталогом {self.folder} опросом раз в {self.poll_interval} с")
+
+        try:
+            while not self._stop.is_set():
+                if observer is not None:
+                    self._drain_events()
+                else:
+                    self._stop.wait(self.poll_interval)
+                    self._pending.update(self.scan())
+                self.process_pending()
+        finally:
+            if observer is not None:
+                observer.stop()
+                observer.join()
+
+    def _drain_events(self):
+        """
+        Собирает события файловой системы за интервал ожидания
+        """
+        try:
+            path = self._events.get(timeout=self.poll_interval)
+        except queue.Empty:
+            return
+        while True:
+            if path.lower().endswith(EMAIL_EXTENSIONS):
+                self._pending.add(path)
+            try:
+                path = self._events.get_nowait()
+            except queue.Empty:
+                return
+
+    def stop(self):
+        self._stop.set()
+
+
+def main():
+    from backend.classifier import MailClassifier
+
+    arg_parser = argparse.ArgumentParser(description="Классификация новых писем из каталога")
+    arg_parser.add_argument("folder", help="Каталог, в который поступают письма")
+    arg_parser.add_argument("--category-set", required=True, help="Файл набора категорий (.npz)")
+    arg_parser.add_argument("--manifest", default="maillens_manifest.sqlite", help="Файл манифеста обработанных писем")
+    arg_parser.add_argument("--results", default="maillens_results.sqlite", help="База результатов классификации")
+    arg_parser.add_argument("--sender-rules", help="JSON файл правил классификации по отправителю")
+    arg_parser.add_argument("--index", help="Каталог индекса эмбеддингов для поиска похожих писем")
+    arg_parser.add_argument("--tenant", default="default",
+                            help="Набор категорий в приложении, к которому относятся письма индекса")
+    arg_parser.add_argument("--batch-size", type=int, default=16)
+    arg_parser.add_argument("--poll-interval", type=float, default=2.0)
+    arg_parser.add_argument("--polling", action="store_true", help="Не использовать inotify")
+    arg_parser.add_argument("--once", action="store_true", help="Обработать накопившиеся письма и завершиться")
+    args = arg_parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    classifier = MailClassifier()
+    classifier.load_category_set(args.category_set)
+    watcher = FolderWatcher(
+        args.folder,
+        classifier,
+        ResultsStore(args.results),
+        FileManifest(args.manifest),
+        batch_size=args.batch_size,
+        poll_interval=args.poll_interval,
+        use_watchdog=not args.polling,
+        sender_rules=SenderRuleIndex.from_file(args.sender_rules) if args.sender_rules else None,
+        index=EmailIndex(args.index) if args.index else None,
+        tenant=args.tenant,
+    )
+    if args.once:
+        watcher.run_once()
+    else:
+        try:
+            watcher.run()
+        except KeyboardInterrupt:
+            watcher.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,9 @@
 import sys
 import os
-import json
+import hashlib
+import tempfile
 import torch
 import streamlit as st
-import pandas as pd
 from datetime import datetime
 
 
@@ -11,12 +11,30 @@ os.environ["STREAMLIT_FRAGMENTS"] = "0"
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from backend.email_parser import parse_email, prepare_for_classification
-from backend.classifier import MailClassifier
+from backend.registry import ClassifierRegistry
 from backend.injection_guard import detect_injection
+from backend.attachment_cache import default_attachment_cache
+from backend.results_store import ResultsStore
+from backend.calibration import calibrate_thresholds
+from backend.linear_head import train_head
+from backend.sender_rules import SenderRuleIndex
+from backend.threads import ThreadIndex
+from backend.bootstrap import (
+    DEFAULT_EXAMPLES_PATH,
+    collect_example_files,
+    load_default_categories,
+    load_unknown_texts,
+    parse_examples,
+)
+from backend.email_index import EmailIndex
+
+
+RESULTS_PAGE_SIZE = 50
+SIMILAR_EMAILS_LIMIT = 10
 
 
 @st.cache_resource(show_spinner=True)
-def load_classifier_once():
+def load_registry_once():
     print("=" * 50)
     print("ЗАГРУЗКА МОДЕЛИ")
     
@@ -25,13 +43,17 @@ def load_classifier_once():
         torch.cuda.empty_cache()
         print(f"До загрузки: {torch.cuda.memory_allocated()/1e9:.2f} GB")
     
-    classifier = MailClassifier()
+    # Одна модель в памяти на все наборы категорий
+    registry = ClassifierRegistry(
+        storage_dir=os.environ.get("MAILLENS_CATEGORY_DIR", "category_sets"),
+        memory_budget_mb=float(os.environ.get("MAILLENS_CATEGORY_BUDGET_MB", 256)),
+    )
     
     if torch.cuda.is_available():
         print(f"После загрузки: {torch.cuda.memory_allocated()/1e9:.2f} GB")
     print("=" * 50)
     
-    return classifier
+    return registry
 
 st.set_page_config(page_title="MailLens", layout="wide")
 st.title("MailLens — интеллектуальная категоризация писем")
@@ -39,91 +61,80 @@ st.title("MailLens — интеллектуальная категоризаци
 def auto_load_categories_on_startup():
     """Автоматически загружает категории при первом запуске"""
     
-    default_cats = {
-        'Техническая поддержка': {
-            'folder_with_examples': 'Technical support',
-            'description': 'Письма от клиентов или сотрудников с запросами о работе систем, программ, оборудования: ошибки, сбои, вопросы по функционалу, просьбы о помощи, инциденты.',
-            },
-        'Финансовые операции, чеки и счета': {
-            'folder_with_examples': 'Financial transactions, checks and invoices',
-            'description': 'Счета на оплату, выставленные/полученные счета-фактуры, чеки, платёжные уведомления, запросы на возврат средств, подтверждения транзакций.',
-            },
-        'Вакансии и карьера': {
-            'folder_with_examples': 'Vacancies and careers',
-            'description': 'Резюме соискателей, письма от рекрутинговых агентств, запросы на стажировки, внутренние анонсы вакансий, приглашения на собеседования, запросы на оценку кандидатов.',
-            }, 
-        'Рекламная рассылка': {
-            'folder_with_examples': 'Promotional mailing',
-            'description': 'Письма с коммерческими предложениями, акциями, скидками, презентациями продуктов и услуг от внешних компаний или собственного маркетинга.',
-            }, 
-        'Новостные рассылки': {
-            'folder_with_examples': 'Newsletters',
-            'description': 'Информационные бюллетени: отраслевые новости, обновления законодательства, корпоративные анонсы, аналитика, обзоры рынка — без прямого призыва к действию.',
-            }, 
-        'Регистрация и подтверждение': {
-            'folder_with_examples': 'Registration and confirmation',
-            'description': 'Письма, связанные с созданием или верификацией аккаунтов: подтверждение email, сброс пароля, двухфакторная аутентификация, привязка устройств.',
-            }, 
-        'Транспорт и путешествия': {
-            'folder_with_examples': 'Transport and travel',
-            'description': 'Бронирование билетов и отелей, уведомления о перелётах/поездах на такси, запросы на командировки.',
-            }, 
-        'Неприемлемый контент': {
-            'folder_with_examples': 'Harm content',
-            'description': 'Спам с порнографией, насилием, лотереями, экстремизмом',
-            }, 
-        'Бизнес-корреспонденция': {
-            'folder_with_examples': 'Business and correspondence',
-            'description': 'Официальные письма от партнёров, поставщиков, клиентов и госорганов: предложения сотрудничества, переговоры, юридические запросы, договоры, претензии.',
-            }, 
-        'Системные и сервисные уведомления': {
-            'folder_with_examples': 'System and service notifications',
-            'description': 'Автоматические сообщения от IT-систем: отчёты, алерты, уведомления о бэкапах, обновлениях, ошибках в интеграциях, статусы задач из CRM/ERP и т.п.',
-            },
-    }
-    
     if st.session_state.auto_categories_loaded:
-        base_path = "emails_by_catrgories"
-        if os.path.exists(base_path):
-            categories_loaded = []
-            for category, info in default_cats.items():
-                if info['folder_with_examples'] in os.listdir(base_path):
-                    category_path = os.path.join(base_path, info['folder_with_examples'])
-                    
-                    if os.path.isdir(category_path):
-                        files = [f for f in os.listdir(category_path) 
-                                if f.endswith(('.eml', '.msg'))]
-                        
-                        if files:
-                            example_texts = []
-                            
-                            for filename in files:
-                                filepath = os.path.join(category_path, filename)
-                                with open(filepath, 'rb') as f:
-                                    parsed = parse_email(f.read(), filename)
-                                    text = prepare_for_classification(parsed)
-                                    example_texts.append(text)
-                            st.session_state.classifier.add_category(
-                                category, 
-                                description=info['description'],
-                                example_texts=example_texts,
-                            )
-                            categories_loaded.append(category)
+        if os.path.exists(DEFAULT_EXAMPLES_PATH):
+            progress_bar = st.progress(0.0, text="Загрузка стандартных категорий")
+            labels = {'parse': "Парсинг примеров", 'encode': "Кодирование промптов"}
+
+            def report(stage, done, total):
+                # Парсинг занимает первую половину полосы, кодирование - вторую
+                offset = 0.0 if stage == 'parse' else 0.5
+                progress_bar.progress(offset + 0.5 * done / total, text=f"{labels[stage]}: {done}/{total}")
+
+            categories_loaded = load_default_categories(
+                st.session_state.classifier, DEFAULT_EXAMPLES_PATH, progress=report
+            )
+            progress_bar.empty()
+            st.session_state.registry.touch(st.session_state.tenant)
             
             st.toast(f"Автоматически загружено {len(categories_loaded)} категорий", icon="✅")
     
     st.session_state.auto_categories_loaded = False
 
 
+@st.cache_resource
+def load_sender_rules():
+    """Загружает правила быстрой классификации по отправителю, если задан файл правил"""
+    path = os.environ.get("MAILLENS_SENDER_RULES")
+    if path and os.path.exists(path):
+        return SenderRuleIndex.from_file(path)
+    return None
+
+
+sender_rules = load_sender_rules()
+
+
+@st.cache_resource
+def load_email_index():
+    """Открывает постоянный индекс эмбеддингов классифицированных писем, общий для всех сессий"""
+    return EmailIndex(os.environ.get("MAILLENS_INDEX_DIR", "email_index"))
+
+
+email_index = load_email_index()
+
+
+@st.cache_data(show_spinner="Парсинг примеров категорий")
+def load_example_texts():
+    """Тексты примеров стандартных категорий и писем из папки Other для калибровки и обучения головы"""
+    examples = parse_examples(collect_example_files(DEFAULT_EXAMPLES_PATH))
+    return examples, load_unknown_texts(DEFAULT_EXAMPLES_PATH)
+
+
 # Инициализация хранилища результатов
-if "classifier" not in st.session_state:
-    st.session_state.classifier = load_classifier_once()
+if "registry" not in st.session_state:
+    st.session_state.registry = load_registry_once()
+if "tenant" not in st.session_state:
+    st.session_state.tenant = "default"
+# Классификатор выбранного набора категорий (может быть выгружен из памяти по LRU).
+# Сессия работает со своим представлением: способ оценки не меняет результаты других сессий
+tenant_classifier = st.session_state.registry.get(st.session_state.tenant)
+st.session_state.classifier = tenant_classifier.session_view()
 if "disabled_uploder" not in st.session_state:
     st.session_state.disabled_uploder = False
 if "uploader_key" not in st.session_state:
     st.session_state.uploader_key = 1
+if "results" not in st.session_state:
+    # Результаты сессии хранятся в SQLite, а не в списке в памяти.
+    # Файл базы удаляется вместе с состоянием сессии
+    st.session_state.results = ResultsStore.temporary()
+if "threads" not in st.session_state:
+    st.session_state.threads = ThreadIndex()
+if "result_sha256" not in st.session_state:
+    # SHA-256 писем по номеру результата: поиск похожих писем исключает само письмо
+    st.session_state.result_sha256 = {}
 if "auto_categories_loaded" not in st.session_state:
-    st.session_state.auto_categories_loaded = True
+    # Стандартные категории загружаются только в пустой набор
+    st.session_state.auto_categories_loaded = not st.session_state.classifier.categories
 if st.session_state.auto_categories_loaded:
     auto_load_categories_on_startup()
 
@@ -157,9 +168,22 @@ def add_catigory():
                 description=description,
                 example_texts=example_texts
             )
+            st.session_state.registry.touch(st.session_state.tenant)
             st.rerun()
 
 with st.sidebar:
+    st.header("Набор категорий")
+    tenant_names = st.session_state.registry.names()
+    if st.session_state.tenant not in tenant_names:
+        tenant_names.append(st.session_state.tenant)
+    tenant = st.selectbox("Текущий набор", tenant_names, index=tenant_names.index(st.session_state.tenant))
+    new_tenant = st.text_input("Новый набор категорий")
+    if st.button("Создать набор") and new_tenant:
+        tenant = new_tenant
+    if tenant != st.session_state.tenant:
+        st.session_state.tenant = tenant
+        st.rerun()
+
     st.header("Доступные для распознования категории")
     if st.session_state.classifier.categories:
         for category in st.session_state.classifier.categories:
@@ -173,22 +197,93 @@ with st.sidebar:
         add_catigory()
     if st.session_state.classifier.categories:
         if st.sidebar.button(f"Сбросить все категории"):
-            st.session_state.classifier.categories = {}
+            st.session_state.classifier.categories.clear()
+            st.session_state.registry.touch(st.session_state.tenant)
             st.rerun()
 
-    threshold = st.slider("Порог «Не определена»", 0.05, 0.90, 0.80, 0.005, 
+    # Слайдер начинается с сохранённого порога набора и меняет его только при явном изменении
+    tenant_threshold = min(max(float(tenant_classifier.threshold), 0.05), 0.90)
+    threshold = st.slider("Порог «Не определена»", 0.05, 0.90, tenant_threshold, 0.005, 
                           help="Чем ниже — тем больше писем будет классифицировано")
-    st.session_state.classifier.threshold = threshold
+    if threshold != tenant_threshold:
+        tenant_classifier.threshold = threshold
+        st.session_state.classifier.threshold = threshold
+        st.session_state.registry.touch(st.session_state.tenant)
+
+    if st.session_state.classifier.categories:
+        if st.button("Калибровать пороги по примерам",
+                     help="Подбирает порог и отрыв для каждой категории по её примерам (leave-one-out) и письмам из папки Other"):
+            examples, unknown_texts = load_example_texts()
+            report = calibrate_thresholds(st.session_state.classifier, examples, unknown_texts)
+            st.session_state.registry.touch(st.session_state.tenant)
+            st.toast(f"Откалиброваны пороги для {len(report)} категорий", icon="✅")
+        if st.button("Обучить голову классификатора",
+                     help="Обучает логистическую голову на примерах писем стандартных категорий, письма из папки Other - класс «Не определена»"):
+            examples, unknown_texts = load_example_texts()
+            try:
+                train_head(st.session_state.classifier, examples, unknown_texts)
+                st.session_state.registry.touch(st.session_state.tenant)
+                st.toast("Голова классификатора обучена", icon="✅")
+            except ValueError as e:
+                st.toast(str(e), icon="⚠️")
+        if st.session_state.classifier.categories.head_ready:
+            scorer = st.radio(
+                "Способ оценки", ["Близость к категориям", "Обученная голова"],
+                help="Обученная голова возвращает вероятности категорий, включая класс «Не определена»",
+            )
+            st.session_state.classifier.scorer = 'head' if scorer == "Обученная голова" else 'similarity'
+        elif st.session_state.classifier.categories.head is not None:
+            st.caption("Голова классификатора обучена не на всех категориях набора - обучите её заново")
+        if st.session_state.classifier.categories.thresholds:
+            st.session_state.classifier.use_calibration = st.checkbox(
+                "Использовать откалиброванные пороги", value=True,
+                help="Для откалиброванных категорий порог слайдера не применяется",
+            )
+
+    cache_stats = default_attachment_cache.stats()
+    st.caption(
+        f"Кэш вложений: {cache_stats['hits'] + cache_stats['disk_hits']} попаданий, "
+        f"{cache_stats['misses']} промахов ({cache_stats['hit_rate']:.0%})"
+    )
+    if sender_rules is not None:
+        rule_stats = sender_rules.stats()
+        st.caption(
+            f"Правила отправителей: {rule_stats['hits']} из {rule_stats['checked']} писем "
+            f"({rule_stats['hit_rate']:.0%}) классифицировано без модели"
+        )
+        if rule_stats['per_rule']:
+            st.json(rule_stats['per_rule'], expanded=False)
+
+def export_results(write_export) -> bytes:
+    """
+    Потоково выгружает результаты во временный файл и возвращает его содержимое.
+    Файл удаляется сразу после чтения: кнопка скачивания всё равно держит данные в памяти
+    """
+    with tempfile.TemporaryFile("w+", encoding="utf-8", newline="") as f:
+        write_export(f)
+        f.flush()
+        f.buffer.seek(0)
+        return f.buffer.read()
 
 def process_new_email(file):
     """
     Обрабатывает новое письмо и кэширует результат обработки
     """
     try:
-        parsed = parse_email(file.read(), file.name)
+        data = file.read()
+        # Ответ на письмо из уже известной цепочки оценивается по новой части без цитаты
+        parsed = st.session_state.threads.reply_view(parse_email(data, file.name))
         data_for_classifier = prepare_for_classification(parsed)
         data_for_classifier = detect_injection(data_for_classifier)
-        prediction = st.session_state.classifier.predict(data_for_classifier)
+        # Письма известных автоматических отправителей классифицируются правилами без энкодера
+        embedding = None
+        prediction = sender_rules.match(parsed) if sender_rules is not None else None
+        if prediction is None:
+            # Ответы кодируют только новую часть и смешиваются с эмбеддингом цепочки.
+            # Эмбеддинг письма сохраняется вместе с результатом для последующей переоценки
+            prediction, embedding = st.session_state.threads.classify(
+                st.session_state.classifier, parsed, data_for_classifier
+            )
         result = {
             "file_name": file.name,
             "file_size": file.size,
@@ -199,6 +294,22 @@ def process_new_email(file):
             "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
             'error': None
         }
+        result_id = st.session_state.results.add(result, embedding=embedding)
+        if embedding is not None:
+            sha256 = hashlib.sha256(data).hexdigest()
+            st.session_state.result_sha256[result_id] = sha256
+            # Эмбеддинг остаётся в индексе для поиска похожих писем в истории
+            email_index.add(embedding, {
+                "file_name": file.name,
+                "file_size": file.size,
+                "sha256": sha256,
+                "subject": parsed.get("raw_subject"),
+                "sender": parsed.get("sender"),
+                "predicted_category": prediction["predicted_category"],
+                "best_similarity": prediction["best_similarity"],
+                "tenant": st.session_state.tenant,
+                "timestamp": result["timestamp"],
+            })
     except Exception as e:
         st.error(f"Ошибка: {e}")
         result = {
@@ -211,7 +322,7 @@ def process_new_email(file):
             "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
             'error': str(e)
         }
-    st.session_state.results.append(result)
+        st.session_state.results.add(result)
 
 # Загрузка писем
 uploaded_files = st.file_uploader(
@@ -228,10 +339,31 @@ if uploaded_files:
         st.session_state.uploader_key += 1
         st.rerun()
 
-if "results" not in st.session_state:
-    st.session_state.results = []
-else:
-    for result in st.session_state.results:
+# === ПЕРЕОЦЕНКА ===
+# При смене порога, набора или состава категорий переоцениваем историю
+# по сохранённым эмбеддингам, без повторного парсинга и энкодера
+scoring_state = (
+    id(st.session_state.classifier.categories),
+    st.session_state.classifier.categories.version,
+    st.session_state.classifier.threshold,
+    st.session_state.classifier.use_calibration,
+    st.session_state.classifier.scorer,
+)
+if st.session_state.get("scoring_state") != scoring_state:
+    if st.session_state.get("scoring_state") is not None:
+        st.session_state.results.rescore(st.session_state.classifier)
+    st.session_state.scoring_state = scoring_state
+
+# === РЕЗУЛЬТАТЫ ===
+results_count = st.session_state.results.count()
+if results_count:
+    page_count = (results_count + RESULTS_PAGE_SIZE - 1) // RESULTS_PAGE_SIZE
+    page = st.number_input(
+        f"Страница результатов (всего писем: {results_count:,})",
+        min_value=1, max_value=page_count, value=page_count, step=1,
+    )
+    # Отрисовываем только текущую страницу результатов
+    for result in st.session_state.results.page(page - 1, RESULTS_PAGE_SIZE):
         with st.expander(f"Письмо: {result['file_name']} ({result['file_size']:,} байт)"):
             if result['error'] is not None:
                 st.error(f"Ошибка: {result['error']}")
@@ -241,28 +373,87 @@ else:
                 with st.expander(f"Оцениваемые данные:"):
                     st.text(result["data_for_classifier"], width='stretch')
 
-# === ЭКСПОРТ ===
-if st.session_state.results:
-    df = pd.DataFrame(st.session_state.results)
+# === ПОИСК ПОХОЖИХ ПИСЕМ ===
+if len(email_index):
+    with st.expander(f"Поиск похожих писем в истории (писем в индексе: {len(email_index):,})"):
+        search_mode = st.radio("Искать похожие", ["На текстовый запрос", "На письмо из результатов"], horizontal=True)
+        # Индекс общий для всех наборов категорий: поиск идёт только по письмам текущего набора
+        index_categories = email_index.categories(tenant=st.session_state.tenant)
+        search_category = st.selectbox("Категория", ["Все категории"] + index_categories)
+        search_category = None if search_category == "Все категории" else search_category
+        similar = None
+        if search_mode == "На текстовый запрос":
+            query = st.text_input("Текст запроса")
+            if query:
+                similar = email_index.search_text(
+                    st.session_state.classifier, query, k=SIMILAR_EMAILS_LIMIT, category=search_category,
+                    tenant=st.session_state.tenant
+                )
+        elif results_count:
+            # Письма текущей страницы с сохранёнными эмбеддингами
+            candidates = {
+                f"{result['file_name']} (№{result['id']})": result['id']
+                for result in st.session_state.results.page(page - 1, RESULTS_PAGE_SIZE)
+                if result['error'] is None
+            }
+            selected = st.selectbox("Письмо", list(candidates)) if candidates else None
+            query_embedding = st.session_state.results.embedding(candidates[selected]) if selected else None
+            if query_embedding is not None:
+                # Само письмо и его повторные загрузки в выдачу не попадают
+                similar = email_index.search(
+                    query_embedding, k=SIMILAR_EMAILS_LIMIT, category=search_category,
+                    tenant=st.session_state.tenant, exclude_sha256=st.session_state.result_sha256.get(candidates[selected])
+                )
+            elif selected:
+                st.info("Письмо классифицировано правилом, эмбеддинг для него не вычислялся")
+        if similar is not None:
+            if similar:
+                st.dataframe(
+                    [
+                        {
+                            "Близость": round(record['similarity'], 3),
+                            "Файл": record['file_name'],
+                            "Тема": record['subject'],
+                            "Отправитель": record['sender'],
+                            "Категория": record['predicted_category'],
+                            "Оценка": record['best_similarity'],
+                            "Дата": record['timestamp'],
+                        }
+                        for record in similar
+                    ],
+                    width='stretch',
+                )
+            else:
+                st.info("Похожих писем не найдено")
 
+# === ЭКСПОРТ ===
+if results_count:
     col1, col2, col3 = st.columns(3)
+    # Файлы экспорта формируются потоково и только по запросу пользователя
     with col1:
-        csv = df.to_csv(index=False).encode('utf-8')
-        st.download_button(
-            "Скачать результаты CSV",
-            csv,
-            "maillens_results.csv",
-            "text/csv"
-        )
+        if st.button("Сформировать CSV"):
+            st.session_state.export_csv = export_results(st.session_state.results.export_csv)
+        if st.session_state.get("export_csv"):
+            st.download_button(
+                "Скачать результаты CSV",
+                st.session_state.export_csv,
+                "maillens_results.csv",
+                "text/csv"
+            )
     with col2:
-        jsonl = "\n".join(json.dumps(r, ensure_ascii=False) for r in st.session_state.results)
-        st.download_button(
-            "Скачать результаты JSONL",
-            jsonl,
-            "maillens_results.jsonl",
-            "application/jsonlines"
-        )
+        if st.button("Сформировать JSONL"):
+            st.session_state.export_jsonl = export_results(st.session_state.results.export_jsonl)
+        if st.session_state.get("export_jsonl"):
+            st.download_button(
+                "Скачать результаты JSONL",
+                st.session_state.export_jsonl,
+                "maillens_results.jsonl",
+                "application/jsonlines"
+            )
     with col3:
         if st.button("Отчистить результаты"):
-            st.session_state.results = []
+            st.session_state.results.clear()
+            st.session_state.result_sha256 = {}
+            st.session_state.export_csv = None
+            st.session_state.export_jsonl = None
             st.rerun()
@@ -0,0 +1,29 @@
+import logging
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from backend.bootstrap import collect_example_files, _parse_example  # noqa: E402
+
+
+EXAMPLES_PATH = os.path.join(ROOT, "emails_by_catrgories")
+
+
+@pytest.fixture(scope="session")
+def example_texts():
+    """
+    Тексты примеров стандартных категорий, подготовленные для классификатора
+    """
+    logging.disable(logging.ERROR)
+    try:
+        return {
+            category: [_parse_example(path) for path in sorted(paths)]
+            for category, paths in collect_example_files(EXAMPLES_PATH).items()
+        }
+    finally:
+        logging.disable(logging.NOTSET)
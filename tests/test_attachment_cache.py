@@ -0,0 +1,16 @@
+from backend.attachment_cache import AttachmentTextCache
+from backend.email_parser import EmailParser
+
+
+def test_parsers_with_different_settings_do_not_share_cached_text():
+    cache = AttachmentTextCache()
+    short = EmailParser(attachment_cache=cache, max_attachment_chars=5)
+    full = EmailParser(attachment_cache=cache)
+    assert short.extract_text_from_attachment(b"hello world text", "a.txt") == "hello"
+    assert full.extract_text_from_attachment(b"hello world text", "a.txt") == "hello world text"
+
+
+def test_non_bytes_payload_does_not_fail_the_email():
+    # extract_msg отдаёт вложенные .msg объектом MSGFile, а не байтами
+    parser = EmailParser(attachment_cache=AttachmentTextCache())
+    assert parser.extract_text_from_attachment(object(), "nested.msg") == "Не удалось извлечь данные из вложения"
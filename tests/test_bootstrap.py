@@ -0,0 +1,69 @@
+import numpy as np
+
+import backend.bootstrap as bootstrap
+from backend.bootstrap import DEFAULT_CATEGORIES, collect_example_files, parse_examples
+from backend.classifier import MailClassifier
+from backend.loadtest import StubEncoder
+from conftest import EXAMPLES_PATH
+
+
+class CountingEncoder(StubEncoder):
+    """
+    Заглушка энкодера, считающая вызовы encode и закодированные тексты
+    """
+
+    def __init__(self, dim: int = 256):
+        super().__init__(dim=dim)
+        self.calls = 0
+        self.texts = 0
+
+    def encode(self, texts, *args, **kwargs):
+        self.calls += 1
+        self.texts += 1 if isinstance(texts, str) else len(texts)
+        return super().encode(texts, *args, **kwargs)
+
+
+def _categories(example_texts):
+    return {
+        name: {'description': DEFAULT_CATEGORIES[name]['description'], 'example_texts': texts}
+        for name, texts in example_texts.items()
+    }
+
+
+def test_add_categories_encodes_in_one_pass(example_texts):
+    categories = _categories(example_texts)
+    batched_encoder = CountingEncoder()
+    batched = MailClassifier(model=batched_encoder)
+    loaded = batched.add_categories(categories)
+
+    single_encoder = CountingEncoder()
+    single = MailClassifier(model=single_encoder)
+    for name, info in categories.items():
+        single.add_category(name, info['description'], info['example_texts'])
+
+    assert loaded == list(categories)
+    assert batched_encoder.calls == 1
+    assert single_encoder.calls == len(categories)
+    assert batched_encoder.texts == single_encoder.texts
+    assert batched.categories.keys() == single.categories.keys()
+    for name in categories:
+        np.testing.assert_allclose(
+            batched.categories.get_embeddings(name), single.categories.get_embeddings(name), atol=1e-2)
+
+
+def test_small_example_set_is_parsed_in_threads(monkeypatch):
+    def no_processes(*args, **kwargs):
+        raise AssertionError("пул процессов для маленького набора")
+
+    monkeypatch.setattr(bootstrap, 'ProcessPoolExecutor', no_processes)
+    files_by_category = {name: sorted(paths) for name, paths in collect_example_files(EXAMPLES_PATH).items()}
+    assert sum(len(paths) for paths in files_by_category.values()) < bootstrap.PROCESS_POOL_MIN_FILES
+
+    stages = []
+    texts = parse_examples(files_by_category, progress=lambda stage, done, total: stages.append((done, total)))
+
+    total = sum(len(paths) for paths in files_by_category.values())
+    assert stages[-1] == (total, total)
+    for name, paths in files_by_category.items():
+        expected = [bootstrap._parse_example(path) for path in paths]
+        assert texts[name] == expected
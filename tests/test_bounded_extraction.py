@@ -0,0 +1,163 @@
+import csv
+import io
+import zipfile
+from email.message import EmailMessage
+
+import pytest
+
+from backend import email_parser
+from backend.attachment_cache import AttachmentTextCache
+from backend.email_parser import EmailParser
+
+
+def _parser(**kwargs):
+    return EmailParser(attachment_cache=AttachmentTextCache(), **kwargs)
+
+
+def _counting_reader(monkeypatch):
+    """
+    Подменяет csv.reader в парсере и считает строки, которые из него прочитали
+    """
+    counter = {'rows': 0}
+    reader = csv.reader
+
+    def counting_reader(*args, **kwargs):
+        for row in reader(*args, **kwargs):
+            counter['rows'] += 1
+            yield row
+
+    monkeypatch.setattr(email_parser.csv, 'reader', counting_reader)
+    return counter
+
+
+def test_csv_stops_reading_rows_at_char_budget(monkeypatch):
+    data = "".join(f"{i};значение {i};комментарий\n" for i in range(100_000)).encode('utf-8')
+    counter = _counting_reader(monkeypatch)
+
+    text = _parser(max_attachment_chars=1000).extract_text_from_csv(data, "big.csv")
+
+    assert len(text) <= 1000
+    assert text.startswith("0 | значение 0 | комментарий")
+    assert counter['rows'] < 100
+
+
+def test_csv_detects_single_byte_cyrillic_from_prefix():
+    data = "Имя,Сумма\nИван,100\nМария,200\n".encode('cp1251')
+    text = _parser().extract_text_from_csv(data, "payments.csv")
+    assert text.splitlines() == ["Имя | Сумма", "Иван | 100", "Мария | 200"]
+
+
+def test_text_attachment_is_cut_at_char_budget():
+    data = ("строка текста\n" * 50_000).encode('utf-8')
+    text = _parser(max_attachment_chars=500).extract_text_from_txt(data, "log.txt")
+    assert len(text) <= 500
+
+
+def _pdf(page_texts, image_pages=()):
+    """
+    Минимальный PDF: страницы с текстом шрифтом Helvetica, а страницы из image_pages - без шрифтов
+    """
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>", None,
+               b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    kids = []
+    for index, text in enumerate(page_texts):
+        stream = f"BT /F1 12 Tf 72 720 Td ({text}) Tj ET".encode('latin-1')
+        objects.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream))
+        resources = b"<< >>" if index in image_pages else b"<< /Font << /F1 3 0 R >> >>"
+        objects.append(b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Resources %s /Contents %d 0 R >>"
+                       % (resources, len(objects)))
+        kids.append(len(objects))
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (
+        b" ".join(b"%d 0 R" % kid for kid in kids), len(kids))
+
+    data = b"%PDF-1.4\n"
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(data))
+        data += b"%d 0 obj\n%s\nendobj\n" % (number, body)
+    xref = len(data)
+    data += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    data += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    data += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    return data
+
+
+@pytest.fixture
+def extracted_pages(monkeypatch):
+    """
+    Считает страницы, текст которых действительно извлекался
+    """
+    pytest.importorskip("PyPDF2")
+    counter = {'pages': 0}
+    extract_text = email_parser.PyPDF2.PageObject.extract_text
+
+    def counting_extract_text(page, *args, **kwargs):
+        counter['pages'] += 1
+        return extract_text(page, *args, **kwargs)
+
+    monkeypatch.setattr(email_parser.PyPDF2.PageObject, 'extract_text', counting_extract_text)
+    return counter
+
+
+def test_pdf_stops_at_page_limit(extracted_pages):
+    data = _pdf([f"Page {i}" for i in range(10)])
+    text = _parser(max_pdf_pages=3).extract_text_from_pdf(data, "report.pdf")
+    assert text.split("\n") == ["Page 0", "Page 1", "Page 2"]
+    assert extracted_pages['pages'] == 3
+
+
+def test_pdf_stops_extracting_pages_at_char_budget(extracted_pages):
+    data = _pdf(["A" * 40] * 10)
+    text = _parser(max_attachment_chars=100).extract_text_from_pdf(data, "report.pdf")
+    assert len(text) <= 100
+    assert extracted_pages['pages'] == 3
+
+
+def test_pdf_pages_without_fonts_are_not_extracted(extracted_pages):
+    data = _pdf(["Scan 0", "Text 1", "Scan 2"], image_pages=(0, 2))
+    assert _parser().extract_text_from_pdf(data, "scan.pdf") == "Text 1"
+    assert extracted_pages['pages'] == 1
+
+
+def test_skipped_archive_members_count_against_char_budget():
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as archive:
+        for i in range(email_parser.MAX_ARCHIVE_MEMBERS):
+            archive.writestr(f"{'каталог/' * 10}image_{i}.png", b"\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR")
+
+    text = _parser(max_attachment_chars=500).extract_text_from_attachment(buffer.getvalue(), "images.zip")
+
+    assert len(text) <= 500
+    assert text.count("Бинарный файл") < 10
+
+
+def test_mime_parts_limit():
+    msg = EmailMessage()
+    msg['Subject'] = "Много частей"
+    msg.make_mixed()
+    for i in range(20):
+        part = EmailMessage()
+        part.set_content(f"часть {i}")
+        msg.attach(part)
+
+    # Корневая часть тоже считается: из пяти частей четыре - текстовые
+    result = _parser(max_mime_parts=5).parse_eml(msg.as_bytes(), "many.eml")
+
+    assert [f"часть {i}" in result['body_plain'] for i in range(6)] == [True] * 4 + [False] * 2
+
+
+def test_attachment_over_decoded_bytes_limit_keeps_metadata_only():
+    msg = EmailMessage()
+    msg['Subject'] = "Большое вложение"
+    msg.set_content("Текст письма")
+    msg.add_attachment(("большой файл " * 200).encode('utf-8'), maintype='text', subtype='plain', filename="big.txt")
+    msg.add_attachment("маленький файл".encode('utf-8'), maintype='text', subtype='plain', filename="small.txt")
+
+    content = _parser(max_decoded_bytes=1000).get_email_content(msg.as_bytes(), "big.eml")
+
+    big, small = content['attachments']
+    assert big['filename'] == "big.txt"
+    assert big['data'].startswith("Бинарный файл: big.txt")
+    assert "большой файл" not in big['data']
+    assert small['data'] == "маленький файл"
+    assert "Текст письма" in content['body']
@@ -0,0 +1,76 @@
+import numpy as np
+
+from backend.calibration import THRESHOLD_GRID, calibrate_thresholds, leave_one_out_scores, sweep_category
+from backend.classifier import MailClassifier
+from backend.loadtest import StubEncoder
+
+
+def _classifier(examples):
+    classifier = MailClassifier(model=StubEncoder(dim=256))
+    classifier.add_categories({name: {'example_texts': texts} for name, texts in examples.items()})
+    return classifier
+
+
+def test_tied_thresholds_resolve_to_the_upper_end():
+    # Позитивы категории 0 не ниже 0.8, негатив (метка -1) отнесён к ней с близостью 0.6
+    scores = np.array([[0.80, 0.20], [0.85, 0.30], [0.90, 0.10], [0.60, 0.20]], dtype=np.float32)
+    labels = np.array([0, 0, 0, -1])
+
+    threshold, margin, f1 = sweep_category(scores, labels, 0)
+
+    assert f1 == 1.0
+    assert margin == 0.0
+    assert threshold == THRESHOLD_GRID[THRESHOLD_GRID <= 0.80].max()
+
+
+def test_category_without_correct_assignments_has_zero_f1():
+    scores = np.array([[0.30, 0.70], [0.20, 0.90], [0.10, 0.80]], dtype=np.float32)
+    labels = np.array([0, 0, 1])
+
+    assert sweep_category(scores, labels, 0)[2] == 0.0
+    assert sweep_category(scores, labels, 2) is None
+
+
+def test_leave_one_out_excludes_own_row(example_texts):
+    classifier = _classifier(example_texts)
+    names = classifier.categories.keys()
+
+    scores, labels = leave_one_out_scores(classifier, example_texts)
+
+    name = names[0]
+    queries = classifier.encode_emails(example_texts[name])
+    rows = classifier.categories.get_embeddings(name)
+    for i, query in enumerate(queries):
+        # Строка 0 - промпт категории, строка i + 1 - промпт этого же примера
+        expected = np.delete(rows, i + 1, axis=0) @ query
+        assert np.isclose(scores[i, 0], expected.mean(), atol=1e-3)
+    assert list(labels[:len(queries)]) == [0] * len(queries)
+    # Близости к чужим категориям считаются по всем их строкам
+    assert np.allclose(scores[:len(queries), 1:], classifier.categories.category_scores(queries)[:, 1:], atol=1e-5)
+
+
+def test_examples_of_other_category_with_same_name_are_held_out(example_texts):
+    names = list(example_texts)
+    # Категория набора называется как папка примеров, но построена из других писем
+    tenant_examples = dict(example_texts)
+    tenant_examples[names[0]] = example_texts[names[1]]
+    classifier = _classifier(tenant_examples)
+
+    scores, labels = leave_one_out_scores(classifier, example_texts)
+
+    held_out = labels == 0
+    queries = classifier.encode_emails(example_texts[names[0]])
+    assert np.allclose(scores[held_out], classifier.categories.category_scores(queries), atol=1e-5)
+
+
+def test_calibrate_thresholds_stores_upper_thresholds(example_texts):
+    classifier = _classifier(example_texts)
+    negatives = ["Привет! Как прошли выходные? Давай созвонимся вечером"]
+
+    report = calibrate_thresholds(classifier, example_texts, negatives)
+
+    assert report
+    assert classifier.categories.thresholds == {name: values['threshold'] for name, values in report.items()}
+    for values in report.values():
+        assert 0.0 < values['threshold'] <= 1.0
+        assert values['f1'] > 0
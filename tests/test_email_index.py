@@ -0,0 +1,96 @@
+import multiprocessing
+
+import numpy as np
+import pytest
+
+from backend import email_index
+from backend.email_index import EmailIndex
+
+
+DIM = 16
+
+
+def _vectors(count, seed=0):
+    vectors = np.random.default_rng(seed).normal(size=(count, DIM)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def _metadata(count, prefix):
+    return [{'file_name': f"{prefix}_{i}.eml", 'sha256': f"{prefix}{i}"} for i in range(count)]
+
+
+def test_exclude_sha256_drops_every_copy_of_query(tmp_path):
+    index = EmailIndex(str(tmp_path))
+    vectors = _vectors(20)
+    index.add_batch(vectors, _metadata(20, 'a'))
+    # Повторная загрузка того же письма
+    index.add(vectors[3], {'file_name': 'again.eml', 'sha256': 'a3'})
+
+    results = index.search(vectors[3], k=5, exclude_sha256='a3')
+
+    assert len(results) == 5
+    assert all(record['sha256'] != 'a3' for record in results)
+    assert index.search(vectors[3], k=1)[0]['sha256'] == 'a3'
+
+
+def test_second_instance_sees_and_keeps_appends(tmp_path):
+    first = EmailIndex(str(tmp_path))
+    second = EmailIndex(str(tmp_path))
+    vectors = _vectors(10)
+
+    first.add_batch(vectors[:5], _metadata(5, 'first'))
+    rows = second.add_batch(vectors[5:], _metadata(5, 'second'))
+
+    assert rows == [5, 6, 7, 8, 9]
+    assert len(first) == 10
+    assert len(first.search(vectors[7], k=10)) == 10
+    assert first.search(vectors[7], k=1)[0]['file_name'] == 'second_2.eml'
+
+
+def _add_from_process(path, prefix, seed):
+    index = EmailIndex(path)
+    for i, vector in enumerate(_vectors(40, seed)):
+        index.add(vector, {'file_name': f"{prefix}_{i}.eml", 'sha256': f"{prefix}{i}"})
+    index.close()
+
+
+@pytest.mark.skipif(not email_index.FILE_LOCK_SUPPORT, reason="нет fcntl")
+def test_concurrent_writers_do_not_lose_rows(tmp_path):
+    processes = [
+        multiprocessing.Process(target=_add_from_process, args=(str(tmp_path), prefix, seed))
+        for seed, prefix in enumerate(('app', 'watcher'))
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(60)
+        assert process.exitcode == 0
+
+    index = EmailIndex(str(tmp_path))
+    assert len(index) == 80
+    records = index.get(list(range(80)))
+    assert sorted(record['file_name'] for record in records) == sorted(
+        f"{prefix}_{i}.eml" for prefix in ('app', 'watcher') for i in range(40)
+    )
+    # Каждая строка метаданных соответствует своему вектору
+    for record in records:
+        prefix, i = record['file_name'][:-4].split('_')
+        expected = _vectors(40, 0 if prefix == 'app' else 1)[int(i)]
+        assert np.allclose(index.vector(record['row']), expected, atol=1e-3)
+
+
+def test_search_is_limited_to_tenant(tmp_path):
+    index = EmailIndex(str(tmp_path))
+    vectors = _vectors(20)
+    index.add_batch(vectors[:10], [dict(record, tenant='Team A', predicted_category='Счета')
+                                   for record in _metadata(10, 'a')])
+    index.add_batch(vectors[10:], [dict(record, tenant='Team B', predicted_category='Рассылки')
+                                   for record in _metadata(10, 'b')])
+
+    results = index.search(vectors[12], k=20, tenant='Team A')
+
+    assert len(results) == 10
+    assert {record['tenant'] for record in results} == {'Team A'}
+    assert index.search(vectors[12], k=20, tenant='Team A', category='Рассылки') == []
+    assert index.categories(tenant='Team B') == ['Рассылки']
+    assert index.categories() == ['Рассылки', 'Счета']
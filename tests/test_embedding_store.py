@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+
+from backend.embedding_store import CompactEmbeddingStore
+from backend.loadtest import StubEncoder
+
+
+def _build_stores(example_texts, encoder):
+    stores = {dtype: CompactEmbeddingStore(dtype=dtype) for dtype in ('float32', 'float16', 'int8')}
+    embeddings = {}
+    for category, texts in example_texts.items():
+        embeddings[category] = encoder.encode(texts)
+        for store in stores.values():
+            store.add(category, embeddings[category])
+    return stores, embeddings
+
+
+@pytest.mark.parametrize("dtype, tolerance", [("float16", 1e-3), ("int8", 1e-2)])
+def test_compact_scores_match_float32(example_texts, dtype, tolerance):
+    encoder = StubEncoder()
+    stores, embeddings = _build_stores(example_texts, encoder)
+    queries = encoder.encode([text for texts in example_texts.values() for text in texts])
+
+    for category, category_embeddings in embeddings.items():
+        assert stores[dtype].parity_error(category, category_embeddings, queries) < tolerance
+
+    # Предсказание может смениться только там, где две категории почти равны и во float32
+    reference_scores = stores['float32'].category_scores(queries)
+    reference = reference_scores.argmax(axis=1)
+    compact = stores[dtype].category_scores(queries).argmax(axis=1)
+    rows = np.flatnonzero(compact != reference)
+    gaps = reference_scores[rows, reference[rows]] - reference_scores[rows, compact[rows]]
+    assert np.all(gaps < 2 * tolerance)
+    assert len(rows) <= 0.05 * len(queries)
+
+
+def test_compact_store_is_smaller_than_float32(example_texts):
+    stores, _ = _build_stores(example_texts, StubEncoder())
+    assert stores['float16'].nbytes < stores['float32'].nbytes
+    assert stores['int8'].nbytes < stores['float16'].nbytes
@@ -0,0 +1,65 @@
+import re
+import time
+
+import pytest
+
+from backend.html_benchmark import load_html_bodies
+from backend.html_text import html_to_text
+from conftest import EXAMPLES_PATH
+
+
+pytest.importorskip("html2text")
+
+from backend.email_parser import EmailParser  # noqa: E402
+
+
+# Адреса ссылок: html2text переносит их внутри текста, быстрый режим добавляет целиком
+MARKDOWN_LINK_REGEX = re.compile(r'\]\([^)]*\)|<https?:[^>]*>')
+URL_REGEX = re.compile(r'\(?https?://[^\s)]*\)?')
+WORD_REGEX = re.compile(r'[^\W\d_]{3,}')
+
+
+def _words(text: str) -> set:
+    return {word.lower() for word in WORD_REGEX.findall(text)}
+
+
+def test_quote_inside_attribute_name_does_not_break_tag():
+    document = '<p>Текст</p><img src="a.gif" width="1 border="0" onerror="this.style.display=\'none\'"><p>Дальше</p>'
+
+    assert html_to_text(document) == "Текст\nДальше"
+
+
+@pytest.mark.parametrize("document", [
+    '<b c=1 ' * 30_000,
+    '<p>Hello</p>' + 'a <b c=1 ' * 25_000,
+    '<a x="' * 40_000,
+    '<![CDATA[' * 30_000,
+])
+def test_unterminated_markup_is_linear(document):
+    # Обрезанное письмо с незакрытыми тегами: раньше каждый '<' просматривал остаток документа
+    started = time.perf_counter()
+    text = html_to_text(document)
+
+    assert time.perf_counter() - started < 1.0
+    assert len(text) < 100
+
+
+def test_unterminated_tag_drops_rest_of_document():
+    assert html_to_text('<p>Hello</p>a <b c=1 d="x') == "Hello\na"
+
+
+def test_fast_mode_matches_html2text_on_corpus():
+    converter = EmailParser(html_mode='html2text')
+    recalls = []
+    for filename, body_html in load_html_bodies(EXAMPLES_PATH):
+        fast = _words(URL_REGEX.sub(' ', html_to_text(body_html)))
+        reference = _words(MARKDOWN_LINK_REGEX.sub(']', converter.html_to_text(body_html)))
+        if not reference:
+            continue
+        # Быстрый режим не должен добавлять слов, которых нет в тексте html2text
+        assert len(fast & reference) >= 0.95 * len(fast), filename
+        recalls.append(len(fast & reference) / len(reference))
+
+    # Часть слов html2text теряется намеренно: скрытые элементы и обрывки перенесённых ссылок
+    assert len(recalls) > 50
+    assert sum(recalls) / len(recalls) >= 0.9
@@ -0,0 +1,78 @@
+import numpy as np
+import pytest
+
+from backend.classifier import MailClassifier
+from backend.linear_head import UNKNOWN_CLASS, train_head
+from backend.loadtest import StubEncoder
+
+
+def _classifier(example_texts):
+    classifier = MailClassifier(model=StubEncoder(dim=256))
+    classifier.add_categories({name: {'example_texts': texts} for name, texts in example_texts.items()})
+    return classifier
+
+
+def test_head_predicts_training_examples(example_texts):
+    classifier = _classifier(example_texts)
+    head = train_head(classifier, example_texts)
+    classifier.scorer = 'head'
+
+    assert head.classes == list(example_texts) + [UNKNOWN_CLASS]
+    assert classifier.categories.head_ready
+    texts = [text for texts in example_texts.values() for text in texts]
+    expected = [name for name, texts in example_texts.items() for _ in texts]
+    predicted = [prediction['predicted_category'] for prediction in classifier.predict_embeddings(
+        classifier.encode_emails(texts))]
+    assert np.mean(np.array(predicted) == np.array(expected)) >= 0.9
+
+
+def test_category_without_example_texts_is_trained_on_stored_rows(example_texts):
+    classifier = _classifier(example_texts)
+    classifier.add_category("Отпуск", "Заявления на отпуск", [
+        "Прошу предоставить ежегодный оплачиваемый отпуск с 1 июля на 14 дней",
+        "Заявление на отпуск за свой счёт с 5 по 9 августа",
+        "Согласуйте, пожалуйста, перенос отпуска на сентябрь",
+    ])
+
+    head = train_head(classifier, example_texts)
+    classifier.scorer = 'head'
+
+    assert "Отпуск" in head.classes
+    prediction = classifier.predict("Прошу предоставить отпуск с 1 июля, заявление на отпуск во вложении")
+    assert prediction['predicted_category'] == "Отпуск"
+
+
+def test_head_round_trips_through_category_set(example_texts, tmp_path):
+    classifier = _classifier(example_texts)
+    head = train_head(classifier, example_texts)
+    path = str(tmp_path / "set.npz")
+    classifier.save_category_set(path)
+
+    loaded = MailClassifier(model=classifier.model)
+    loaded.load_category_set(path)
+
+    queries = classifier.encode_emails(["Счёт на оплату во вложении", "Не могу войти в личный кабинет"])
+    assert loaded.categories.head.classes == head.classes
+    assert np.allclose(loaded.categories.head.predict_proba(queries), head.predict_proba(queries))
+
+
+def test_adding_category_invalidates_head(example_texts):
+    classifier = _classifier(example_texts)
+    train_head(classifier, example_texts)
+    classifier.scorer = 'head'
+
+    classifier.add_category("Отпуск", "Заявления на отпуск", ["Прошу предоставить отпуск"])
+
+    assert classifier.categories.head is None
+    assert not classifier.categories.head_ready
+    prediction = classifier.predict("Прошу предоставить отпуск")
+    # Без головы оценка идёт по близости ко всем категориям, включая новую
+    assert len(prediction['all_scores']) == len(example_texts) + 1
+
+
+def test_head_needs_two_categories():
+    classifier = MailClassifier(model=StubEncoder(dim=64))
+    classifier.add_category("Счета", "Счета на оплату", ["Счёт на оплату"])
+
+    with pytest.raises(ValueError):
+        train_head(classifier, {"Счета": ["Счёт на оплату"]})
@@ -0,0 +1,113 @@
+import threading
+
+import numpy as np
+import pytest
+
+from backend.classifier import MailClassifier
+from backend.loadtest import (
+    ClassificationPipeline,
+    HttpTarget,
+    LoadGenerator,
+    StubEncoder,
+    format_report,
+    load_corpus,
+    make_server,
+)
+from conftest import EXAMPLES_PATH
+
+
+LATENCY_KEYS = {'mean', 'p50', 'p90', 'p95', 'p99', 'max'}
+SAMPLE_KEYS = {'elapsed', 'completed', 'throughput', 'queue_depth', 'rss_mb'}
+
+
+@pytest.fixture(scope="module")
+def pipeline(example_texts):
+    classifier = MailClassifier(model=StubEncoder(dim=256, delay_per_text=0.002))
+    classifier.add_categories({name: {'example_texts': texts} for name, texts in example_texts.items()})
+    return ClassificationPipeline(classifier)
+
+
+class FailingTarget:
+    """
+    Цель, которая падает на failed.eml и возвращает ошибку на refused.eml
+    """
+
+    def __init__(self, pipeline):
+        self.pipeline = pipeline
+
+    def __call__(self, filename, data):
+        if filename == 'failed.eml':
+            raise RuntimeError("сбой цели")
+        if filename == 'refused.eml':
+            return {'error': "письмо отклонено"}
+        return self.pipeline(filename, data)
+
+
+def _corpus():
+    return load_corpus(EXAMPLES_PATH)[:4] + [('failed.eml', b''), ('refused.eml', b'')]
+
+
+def _check_report(report, requests):
+    assert report['requests'] == requests
+    assert set(report['latency_ms']) == LATENCY_KEYS
+    latency = report['latency_ms']
+    assert 0 < latency['p50'] <= latency['p90'] <= latency['p95'] <= latency['p99'] <= latency['max']
+    assert report['timeline']
+    for sample in report['timeline']:
+        assert set(sample) == SAMPLE_KEYS
+    elapsed = [sample['elapsed'] for sample in report['timeline']]
+    completed = [sample['completed'] for sample in report['timeline']]
+    assert elapsed == sorted(elapsed) and completed == sorted(completed)
+    assert completed[-1] <= requests
+    assert format_report(report).count("\n") == 5 + len(report['timeline'])
+
+
+def test_closed_loop_run(pipeline):
+    generator = LoadGenerator(FailingTarget(pipeline), _corpus(), concurrency=2, duration=30.0,
+                              max_requests=24, sample_interval=0.02)
+    report = generator.run()
+
+    _check_report(report, 24)
+    # Корпус из 6 писем проходится 4 раза, по 2 ошибки за проход
+    assert report['errors'] == 8
+    assert report['arrival_rate'] is None
+    assert report['max_queue_depth'] <= 2
+
+
+def test_poisson_open_loop_run(pipeline):
+    rate, requests = 200.0, 30
+    generator = LoadGenerator(FailingTarget(pipeline), _corpus(), concurrency=2, rate=rate, duration=30.0,
+                              max_requests=requests, sample_interval=0.02, seed=7)
+    report = generator.run()
+
+    _check_report(report, requests)
+    assert report['errors'] == 10
+    assert report['arrival_rate'] == rate
+    # Последнее письмо подаётся не раньше суммы интервалов пуассоновского потока
+    arrivals = np.random.default_rng(7).exponential(1.0 / rate, requests).sum()
+    assert report['elapsed_s'] >= arrivals - 1e-3
+
+
+def test_invalid_generator_settings(pipeline):
+    with pytest.raises(ValueError):
+        LoadGenerator(pipeline, _corpus(), concurrency=0)
+    with pytest.raises(ValueError):
+        LoadGenerator(pipeline, _corpus(), rate=0)
+
+
+def test_http_round_trip(pipeline):
+    server = make_server(pipeline, port=0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        target = HttpTarget(f"http://127.0.0.1:{server.server_address[1]}/", timeout=10.0)
+        filename, data = load_corpus(EXAMPLES_PATH)[0]
+        result = target(f"пример {filename}", data)
+
+        expected = pipeline(filename, data)
+        assert result['predicted_category'] == expected['predicted_category']
+        assert target.rss_mb() > 0
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
@@ -0,0 +1,36 @@
+import os
+import tracemalloc
+from email.message import EmailMessage
+
+from backend.attachment_cache import AttachmentTextCache
+from backend.email_parser import EmailParser
+
+
+def _email_with_large_attachments() -> bytes:
+    msg = EmailMessage()
+    msg['Subject'] = 'Отчёт'
+    msg['From'] = 'sender@example.com'
+    msg['To'] = 'receiver@example.com'
+    msg.set_content("Выгрузка во вложении")
+    msg.add_attachment(os.urandom(6 * 1024 * 1024), maintype='application', subtype='octet-stream',
+                       filename='dump.bin')
+    msg.add_attachment(("строка журнала\n" * 200_000).encode('utf-8'), maintype='text', subtype='plain',
+                       filename='journal.txt')
+    return msg.as_bytes()
+
+
+def test_large_attachment_peak_memory():
+    data = _email_with_large_attachments()
+    parser = EmailParser(attachment_cache=AttachmentTextCache(max_chars=0))
+
+    tracemalloc.start()
+    try:
+        content = parser.get_email_content(data, 'report.eml')
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    assert [attachment['filename'] for attachment in content['attachments']] == ['dump.bin', 'journal.txt']
+    # Декодированные данные вложения не должны копироваться: до освобождения
+    # вложений пиковая память была примерно в 3.5 раза больше самого письма
+    assert peak < 2.5 * len(data)
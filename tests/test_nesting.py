@@ -0,0 +1,101 @@
+import io
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from email.message import EmailMessage
+
+from backend.attachment_cache import AttachmentTextCache
+from backend.email_parser import MAX_MIME_DEPTH, MAX_NESTED_ARCHIVES, MAX_NESTED_EMAILS, EmailParser
+
+
+def _zip(name, data):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as archive:
+        archive.writestr(name, data)
+    return buffer.getvalue()
+
+
+def _nested_zip(levels):
+    """
+    Архив, в котором levels раз вложены архивы, а в самом глубоком лежит текстовый файл
+    """
+    data = _zip("note.txt", f"глубина {levels}".encode('utf-8'))
+    for level in range(levels - 1, 0, -1):
+        data = _zip(f"level{level + 1}.zip", data)
+    return data
+
+
+def test_archive_depth_limit():
+    parser = EmailParser(attachment_cache=AttachmentTextCache())
+
+    shallow = parser.extract_text_from_attachment(_nested_zip(MAX_NESTED_ARCHIVES), "a.zip")
+    deep = parser.extract_text_from_attachment(_nested_zip(MAX_NESTED_ARCHIVES + 1), "a.zip")
+
+    assert f"глубина {MAX_NESTED_ARCHIVES}" in shallow
+    assert "превышена глубина вложенности архивов" in deep
+    assert f"глубина {MAX_NESTED_ARCHIVES + 1}" not in deep
+
+
+def test_shared_parser_is_reentrant():
+    # Один парсер разбирает архивы разной глубины из нескольких потоков:
+    # результат не должен зависеть от того, что разбирается параллельно
+    parser = EmailParser(attachment_cache=AttachmentTextCache(max_chars=0))
+    archives = [_nested_zip(levels) for levels in (1, MAX_NESTED_ARCHIVES, MAX_NESTED_ARCHIVES + 1)] * 20
+    expected = [parser.extract_text_from_attachment(data, "a.zip") for data in archives]
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        results = list(pool.map(lambda data: parser.extract_text_from_attachment(data, "a.zip"), archives))
+
+    assert results == expected
+
+
+def _nested_multipart(levels):
+    """
+    Письмо из levels вложенных multipart частей, в самой глубокой - текст
+    """
+    part = EmailMessage()
+    part.set_content(f"глубина {levels}")
+    for _ in range(levels):
+        wrapper = EmailMessage()
+        wrapper.make_mixed()
+        wrapper.attach(part)
+        part = wrapper
+    part['Subject'] = "Вложенные части"
+    return part.as_bytes()
+
+
+def test_mime_depth_limit():
+    parser = EmailParser(attachment_cache=AttachmentTextCache())
+
+    shallow = parser.parse_eml(_nested_multipart(MAX_MIME_DEPTH), "a.eml")
+    deep = parser.parse_eml(_nested_multipart(MAX_MIME_DEPTH + 1), "a.eml")
+
+    assert f"глубина {MAX_MIME_DEPTH}" in shallow['body_plain']
+    assert deep['body_plain'] == ''
+
+
+def _nested_eml(levels):
+    """
+    Письмо, в которое levels раз вложены письма .eml, в самом глубоком - текст
+    """
+    data = None
+    for level in range(levels, -1, -1):
+        msg = EmailMessage()
+        msg['Subject'] = f"Уровень {level}"
+        msg.set_content(f"глубина {level}")
+        if data is not None:
+            msg.add_attachment(data, maintype='application', subtype='octet-stream', filename=f"level{level + 1}.eml")
+        data = msg.as_bytes()
+    return data
+
+
+def test_nested_email_depth_limit():
+    parser = EmailParser(attachment_cache=AttachmentTextCache())
+
+    shallow = parser.get_email_content(_nested_eml(MAX_NESTED_EMAILS), "a.eml")
+    deep = parser.get_email_content(_nested_eml(MAX_NESTED_EMAILS + 1), "a.eml")
+
+    assert f"глубина {MAX_NESTED_EMAILS}" in shallow['attachments'][0]['data']
+    assert "превышена глубина вложенности" not in shallow['attachments'][0]['data']
+    assert f"глубина {MAX_NESTED_EMAILS}" in deep['attachments'][0]['data']
+    assert f"level{MAX_NESTED_EMAILS + 1}.eml (превышена глубина вложенности)" in deep['attachments'][0]['data']
+    assert f"глубина {MAX_NESTED_EMAILS + 1}" not in deep['attachments'][0]['data']
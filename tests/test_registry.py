@@ -0,0 +1,83 @@
+import os
+
+import numpy as np
+
+from backend.classifier import MailClassifier
+from backend.loadtest import StubEncoder
+from backend.registry import ClassifierRegistry
+
+
+def _registry(storage_dir, memory_budget_mb=256):
+    return ClassifierRegistry(storage_dir=str(storage_dir), memory_budget_mb=memory_budget_mb,
+                              model=StubEncoder(dim=64))
+
+
+def _fill(registry, name, category):
+    classifier = registry.get(name)
+    classifier.add_category(category, f"Письма о {category}", [f"пример {category} {i}" for i in range(3)])
+    registry.touch(name)
+    return classifier
+
+
+def test_similar_names_get_separate_files(tmp_path):
+    registry = _registry(tmp_path)
+    _fill(registry, "Team A", "отпуск")
+    _fill(registry, "Team_A", "счета")
+    _fill(registry, "Team/A", "договоры")
+
+    assert len(os.listdir(tmp_path)) == 3
+    reloaded = _registry(tmp_path)
+    assert sorted(reloaded.names()) == sorted(["Team A", "Team_A", "Team/A"])
+    assert reloaded.get("Team A").categories.keys() == ["отпуск"]
+    assert reloaded.get("Team_A").categories.keys() == ["счета"]
+    assert reloaded.get("Team/A").categories.keys() == ["договоры"]
+
+
+def test_least_recently_used_set_is_evicted_to_disk(tmp_path):
+    registry = _registry(tmp_path)
+    _fill(registry, "a", "отпуск")
+    set_bytes = registry.memory_usage()["a"]
+    registry.memory_budget = int(2.5 * set_bytes)
+    _fill(registry, "b", "счета")
+    registry.get("a")
+    _fill(registry, "c", "договоры")
+
+    assert set(registry.memory_usage()) == {"a", "c"}
+    assert sum(registry.memory_usage().values()) <= registry.memory_budget
+    assert sorted(registry.names()) == ["a", "b", "c"]
+    assert registry.get("b").categories.keys() == ["счета"]
+    assert set(registry.memory_usage()) == {"b", "c"}
+
+
+def test_sets_persist_across_registries(tmp_path):
+    registry = _registry(tmp_path)
+    classifier = _fill(registry, "tenant", "отпуск")
+    classifier.threshold = 0.5
+    registry.touch("tenant")
+    embeddings = classifier.categories.get_embeddings("отпуск")
+
+    reloaded = _registry(tmp_path)
+    assert reloaded.names() == ["tenant"]
+    restored = reloaded.get("tenant")
+    assert restored.threshold == 0.5
+    np.testing.assert_array_equal(restored.categories.get_embeddings("отпуск"), embeddings)
+
+    reloaded.remove("tenant")
+    assert reloaded.names() == []
+    assert os.listdir(tmp_path) == []
+
+
+def test_legacy_file_is_loaded_and_migrated(tmp_path):
+    legacy = MailClassifier(model=StubEncoder(dim=64))
+    legacy.add_category("отпуск", "Письма об отпуске", ["пример"])
+    legacy.save_category_set(str(tmp_path / "Team_A.npz"), name="Team A")
+
+    registry = _registry(tmp_path)
+    assert registry.names() == ["Team A"]
+    assert registry.get("Team_A").categories.keys() == []
+    assert registry.get("Team A").categories.keys() == ["отпуск"]
+    registry.touch("Team A")
+
+    assert not (tmp_path / "Team_A.npz").exists()
+    assert sorted(registry.names()) == ["Team A", "Team_A"]
+    assert _registry(tmp_path).names() == ["Team A"]
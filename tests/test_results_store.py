@@ -0,0 +1,127 @@
+import csv
+import gc
+import io
+import json
+import os
+
+import numpy as np
+
+from backend.classifier import MailClassifier
+from backend.loadtest import StubEncoder
+from backend.results_store import RESULT_FIELDS, ResultsStore
+
+
+class CountingEncoder(StubEncoder):
+    """
+    Заглушка энкодера, считающая вызовы encode
+    """
+
+    def __init__(self, dim: int = 256):
+        super().__init__(dim=dim)
+        self.calls = 0
+
+    def encode(self, texts, *args, **kwargs):
+        self.calls += 1
+        return super().encode(texts, *args, **kwargs)
+
+
+def test_temporary_store_removes_its_file_on_close():
+    store = ResultsStore.temporary()
+    store.add({'file_name': 'a.eml', 'predicted_category': 'x'})
+    assert os.path.exists(store.path)
+    store.close()
+    assert not os.path.exists(store.path)
+
+
+def test_temporary_store_removes_its_file_when_dropped():
+    store = ResultsStore.temporary()
+    path = store.path
+    del store
+    gc.collect()
+    assert not os.path.exists(path)
+
+
+def test_rescore_uses_stored_embeddings_only(example_texts):
+    encoder = CountingEncoder()
+    classifier = MailClassifier(model=encoder, threshold=0.0)
+    classifier.add_categories({name: {'example_texts': texts} for name, texts in example_texts.items()})
+    texts = [texts[0] for texts in example_texts.values()]
+    embeddings = classifier.encode_emails(texts)
+    store = ResultsStore()
+    for i, (prediction, embedding) in enumerate(zip(classifier.predict_embeddings(embeddings), embeddings)):
+        store.add({'file_name': f"{i}.eml", **prediction}, embedding)
+    removed = store.page(0)[0]['predicted_category']
+    encoder.calls = 0
+
+    classifier.threshold = 1.01
+    assert store.rescore(classifier) == len(texts)
+    assert {result['predicted_category'] for result in store.page(0)} == {"Не определена"}
+
+    classifier.threshold = 0.0
+    del classifier.categories[removed]
+    assert store.rescore(classifier) == len(texts)
+
+    assert encoder.calls == 0
+    _, matrix = store.embeddings()
+    expected = classifier.predict_embeddings(matrix.astype(np.float32))
+    results = store.page(0)
+    assert [result['predicted_category'] for result in results] == [e['predicted_category'] for e in expected]
+    assert all(removed not in {score['category'] for score in result['all_scores']} for result in results)
+    assert results[0]['predicted_category'] != removed
+
+
+def _filled_store(count):
+    store = ResultsStore()
+    for i in range(count):
+        store.add({
+            'file_name': f"{i}.eml",
+            'predicted_category': "Счета" if i % 2 else "Не определена",
+            'best_similarity': i / count,
+            'all_scores': [{'category': "Счета", 'similarity': i / count}],
+            'error': "ошибка" if i == 1 else None,
+        })
+    return store
+
+
+def test_page_order_and_bounds():
+    store = _filled_store(7)
+
+    pages = [store.page(page, page_size=3) for page in range(4)]
+
+    assert [[result['file_name'] for result in page] for page in pages] == [
+        ["0.eml", "1.eml", "2.eml"], ["3.eml", "4.eml", "5.eml"], ["6.eml"], [],
+    ]
+    ids = [result['id'] for page in pages for result in page]
+    assert ids == sorted(ids)
+    assert pages[0][1]['all_scores'] == [{'category': "Счета", 'similarity': 1 / 7}]
+    assert store.page(100, page_size=3) == []
+    assert store.count() == 7
+
+
+def test_exports_stream_every_result_in_order():
+    # Больше одной пачки iter_results
+    count = 1203
+    store = _filled_store(count)
+
+    csv_stream = io.StringIO()
+    store.export_csv(csv_stream)
+    rows = list(csv.reader(io.StringIO(csv_stream.getvalue())))
+
+    assert rows[0] == RESULT_FIELDS
+    assert len(rows) == count + 1
+    first = dict(zip(RESULT_FIELDS, rows[2]))
+    assert first['file_name'] == "1.eml"
+    assert first['error'] == "ошибка"
+    assert json.loads(first['all_scores']) == [{'category': "Счета", 'similarity': 1 / count}]
+    assert [row[0] for row in rows[1:]] == [f"{i}.eml" for i in range(count)]
+
+    jsonl_stream = io.StringIO()
+    store.export_jsonl(jsonl_stream)
+    lines = jsonl_stream.getvalue().splitlines()
+
+    assert len(lines) == count
+    results = [json.loads(line) for line in lines]
+    assert all(set(result) == set(RESULT_FIELDS) for result in results)
+    assert [result['file_name'] for result in results] == [f"{i}.eml" for i in range(count)]
+    assert results[1]['all_scores'] == [{'category': "Счета", 'similarity': 1 / count}]
+    assert results[0]['error'] is None and results[1]['error'] == "ошибка"
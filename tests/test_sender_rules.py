@@ -0,0 +1,35 @@
+import json
+
+from backend.sender_rules import SenderRule, SenderRuleIndex
+
+
+def _parsed(subject, sender=''):
+    return {'raw_subject': subject, 'sender': sender, 'headers': {}}
+
+
+def test_most_confident_subject_rule_wins_regardless_of_rule_order():
+    low = SenderRule('low', 'Алерты', subject_pattern='alert', confidence=0.95)
+    high = SenderRule('high', 'Инциденты', subject_pattern='alert.*critical', confidence=0.99)
+    for rules in ([low, high], [high, low]):
+        assert SenderRuleIndex(rules).match(_parsed("alert: critical disk usage"))['rule'] == 'high'
+    assert SenderRuleIndex([low, high]).match(_parsed("alert: disk usage"))['rule'] == 'low'
+    assert SenderRuleIndex([low, high]).match(_parsed("weekly report")) is None
+
+
+def test_rules_that_do_not_fit_the_combined_filter_still_match():
+    flagged = SenderRule('flagged', 'Счета', subject_pattern='(?i)invoice', confidence=0.97)
+    repeated = SenderRule('repeated', 'Повторы', subject_pattern=r'(\w+) \1', confidence=0.96)
+    index = SenderRuleIndex([SenderRule('low', 'Алерты', subject_pattern='alert'), flagged, repeated])
+    assert index.match(_parsed("Invoice 42"))['rule'] == 'flagged'
+    assert index.match(_parsed("go go"))['rule'] == 'repeated'
+
+
+def test_invalid_rule_in_file_only_rejects_that_rule(tmp_path):
+    path = tmp_path / "rules.json"
+    path.write_text(json.dumps([
+        {'name': 'broken', 'category': 'X', 'subject_pattern': '(unclosed'},
+        {'name': 'shop', 'category': 'Рекламная рассылка', 'sender_domains': ['shop.example.com']},
+    ]), encoding='utf-8')
+    index = SenderRuleIndex.from_file(str(path))
+    assert [rule.name for rule in index.rules] == ['shop']
+    assert index.match(_parsed("Скидки", sender="news@mail.shop.example.com"))['rule'] == 'shop'
@@ -0,0 +1,56 @@
+import gzip
+import io
+import zipfile
+from email.message import EmailMessage
+
+import pytest
+
+from backend.attachment_cache import AttachmentTextCache
+from backend.email_parser import EmailParser, sniff_format
+
+
+@pytest.mark.parametrize("head, ext", [
+    (b"MZ is the start of every DOS executable", '.txt'),
+    (b"ID3 tags, notes for the release", '.log'),
+    (b"RIFF;wav;format\n", '.csv'),
+    (b"MM\xd0\xb0\xd0\xb9 report", '.txt'),
+])
+def test_weak_signature_does_not_override_text_extension(head, ext):
+    assert sniff_format(head, ext) in ('text', 'csv')
+
+
+@pytest.mark.parametrize("head, ext, kind", [
+    (b"MZ\x90\x00\x03\x00\x00\x00\x04\x00", '.txt', 'executable'),
+    (gzip.compress(b"text"), '.log', 'gzip'),
+    (b"%PDF-1.7\n%\xe2\xe3\xcf\xd3", '.txt', 'pdf'),
+    (b"PK\x03\x04\x14\x00", '.csv', 'zip'),
+    (b"MZ is the start", '', 'executable'),
+])
+def test_binary_or_structural_signature_wins(head, ext, kind):
+    assert sniff_format(head, ext) == kind
+
+
+def test_text_attachment_with_weak_signature_is_extracted():
+    msg = EmailMessage()
+    msg['Subject'] = 'Заметка'
+    msg['From'] = 'sender@example.com'
+    msg.set_content("См. вложение")
+    msg.add_attachment(b"MZ is the start of every DOS executable", maintype='application',
+                       subtype='octet-stream', filename='note.txt')
+    parser = EmailParser(attachment_cache=AttachmentTextCache())
+
+    content = parser.get_email_content(msg.as_bytes(), 'note.eml')
+
+    assert content['attachments'][0]['data'] == "MZ is the start of every DOS executable"
+
+
+def test_text_file_with_weak_signature_in_archive():
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as archive:
+        archive.writestr("note.txt", "MZ is the start of every DOS executable")
+    parser = EmailParser(attachment_cache=AttachmentTextCache())
+
+    text = parser.extract_text_from_attachment(buffer.getvalue(), "notes.zip")
+
+    assert "Бинарный файл" not in text
+    assert "MZ is the start of every DOS executable" in text
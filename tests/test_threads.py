@@ -0,0 +1,39 @@
+import glob
+import os
+
+import pytest
+
+from backend.email_parser import EmailParser
+from backend.threads import ThreadIndex, strip_quoted_text
+from conftest import EXAMPLES_PATH
+
+
+def _parse(name):
+    path = glob.glob(os.path.join(EXAMPLES_PATH, "**", name), recursive=True)[0]
+    with open(path, 'rb') as f:
+        return EmailParser().get_email_content(f.read(), name)
+
+
+@pytest.mark.parametrize("name", ["other_10.eml", "business_and_correspondence_4.eml", "Harm_content_10.eml"])
+def test_forwards_and_non_replies_keep_their_content(name):
+    parsed = _parse(name)
+    assert parsed['reply_body'] is None
+    assert ThreadIndex().reply_view(parsed) is parsed
+
+
+def test_forward_block_is_not_quoted_history():
+    text = "Смотри ниже\n\nFrom: Иван\nSent: Monday\nSubject: Счёт\n\nСчёт на оплату № 5"
+    assert strip_quoted_text(text, "FW: Счёт") == text
+    assert strip_quoted_text(text, "Re: Счёт") == "Смотри ниже"
+
+
+def test_reply_is_stripped_only_when_parent_is_known():
+    parsed = _parse("technical_support_1.eml")
+    assert parsed['reply_body'] and len(parsed['reply_body']) < len(parsed['body'])
+
+    threads = ThreadIndex()
+    assert threads.reply_view(parsed)['body'] == parsed['body']
+
+    parent_id = parsed['headers']['In-Reply-To']
+    threads.remember({'Message-ID': parent_id}, None, {'predicted_category': 'Техническая поддержка'})
+    assert threads.reply_view(parsed)['body'] == parsed['reply_body']
@@ -0,0 +1,84 @@
+import glob
+import json
+import os
+import shutil
+
+from backend.email_index import EmailIndex
+from backend.loadtest import StubEncoder
+from backend.results_store import ResultsStore
+from backend.watcher import FileManifest, FolderWatcher
+from conftest import EXAMPLES_PATH
+
+
+class FlakyClassifier:
+    """
+    Классификатор, энкодер которого падает на пачках и на одном из писем
+    """
+
+    def __init__(self, failing_call: int):
+        self.encoder = StubEncoder(dim=32)
+        self.failing_call = failing_call
+        self.calls = 0
+
+    def encode_emails(self, texts):
+        self.calls += 1
+        if len(texts) > 1 or self.calls == self.failing_call:
+            raise RuntimeError("encoder failure")
+        return self.encoder.encode(texts)
+
+    def predict_embeddings(self, embeddings):
+        return [{'predicted_category': 'x', 'best_similarity': 0.9, 'all_scores': []} for _ in embeddings]
+
+
+def _drop_folder(tmp_path, count=4):
+    folder = tmp_path / "inbox"
+    folder.mkdir()
+    for path in sorted(glob.glob(os.path.join(EXAMPLES_PATH, "Technical support", "*.eml")))[:count]:
+        shutil.copy(path, folder)
+    return str(folder)
+
+
+def test_encoder_failure_only_fails_the_affected_email(tmp_path):
+    folder = _drop_folder(tmp_path)
+    results = ResultsStore()
+    manifest = FileManifest(str(tmp_path / "manifest.sqlite"))
+    watcher = FolderWatcher(folder, FlakyClassifier(failing_call=3), results, manifest,
+                            settle_seconds=0, use_watchdog=False)
+
+    assert watcher.run_once() == 4
+    errors = [result['error'] for result in results.iter_results()]
+    assert errors.count("encoder failure") == 1
+    assert errors.count(None) == 3
+    assert len(manifest) == 4
+
+
+def test_json_manifest_is_migrated_and_files_are_not_reprocessed(tmp_path):
+    folder = _drop_folder(tmp_path, count=2)
+    # Манифест прежнего формата с уже обработанными файлами
+    legacy = {}
+    for filename in os.listdir(folder):
+        file_path = os.path.join(folder, filename)
+        stat = os.stat(file_path)
+        legacy[file_path] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'sha256': ''}
+    path = str(tmp_path / "manifest.json")
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(legacy, f)
+
+    manifest = FileManifest(path)
+    assert len(manifest) == 2
+    watcher = FolderWatcher(folder, FlakyClassifier(failing_call=0), ResultsStore(), manifest,
+                            settle_seconds=0, use_watchdog=False)
+    assert watcher.run_once() == 0
+
+
+def test_indexed_emails_record_tenant(tmp_path):
+    folder = _drop_folder(tmp_path, count=2)
+    index = EmailIndex(str(tmp_path / "index"))
+    watcher = FolderWatcher(folder, FlakyClassifier(failing_call=0), ResultsStore(),
+                            FileManifest(str(tmp_path / "manifest.sqlite")),
+                            settle_seconds=0, use_watchdog=False, index=index, tenant='Team A')
+
+    watcher.run_once()
+
+    assert len(index) == 2
+    assert {record['tenant'] for record in index.get([0, 1])} == {'Team A'}